@@ -7,7 +7,7 @@ from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from ztq_console.utils import models
 from ztq_console.utils.security import groupfinder
-from views import MENU_CONFIG
+from views import MENU_CONFIG, setup_server
 
 
 def main(global_config, frs_root='frs', init_dispatcher_config='true', \
@@ -17,6 +17,8 @@ def main(global_config, frs_root='frs', init_dispatcher_config='true', \
     
     # 是否启用sentinel
     enable_sentinel = settings.get('enable_sentinel', 'false').lower() == 'true'
+    # 连接池的配置, 切换服务器时也使用
+    ztq_core.set_pool_options(**ztq_core.read_pool_options(settings))
     # 如果启用sentinel，则关于redis的host,port,db都为对sentinel的配置
     if enable_sentinel:
         # 主机列表
@@ -46,6 +48,13 @@ def main(global_config, frs_root='frs', init_dispatcher_config='true', \
         # servers 作为必须的配置项
         # 取消原来的redis_host,redis_port,redis_db配置
         assert(servers)
+        # 从库, 格式: name:host:port:db, ......
+        replicas = {}
+        for replica in (settings.get('replicas', '') or '').split(','):
+            if not replica.strip(): continue
+            texts = replica.strip().split(':')
+            replicas[texts[0]] = {'host': texts[1], 'port': int(texts[2]),
+                                  'db': int(texts[3]) if len(texts) > 3 else 0}
         for server in servers.split(','):
             texts = server.split(':')
             # 单个server的配置项必须介于4-5之间
@@ -57,17 +66,46 @@ def main(global_config, frs_root='frs', init_dispatcher_config='true', \
                     'port'  : int(texts[2]),
                     'db'    : int(texts[3]),
                     'title' : texts[4] if len(texts) == 5 else texts[0],
+                    'replica' : replicas.get(texts[0], None),
                 })
         # 默认将列表中的第一个服务器作为默认服务器
         current_redis = MENU_CONFIG['servers'][0]
         MENU_CONFIG['current_redis'] = current_redis['name']
         #
         # 初始化Redis连接
-        ztq_core.setup_redis('default'
-                , current_redis['host']
-                , current_redis['port'], current_redis['db'])
+        setup_server(current_redis)
         MENU_CONFIG['enable_sentinel'] = False
 
+    # 队列分片, 控制台汇总显示各个分片上的队列
+    shards = [shard.strip().split(':') for shard in 
+                (settings.get('shards', '') or '').split(',') if shard.strip()]
+    for texts in shards:
+        ztq_core.setup_redis(texts[0], host=texts[1], port=int(texts[2]), 
+                db=int(texts[3]) if len(texts) > 3 else 0)
+    if shards:
+        ztq_core.setup_shards(['default'] + sorted(texts[0] for texts in shards))
+    for queue_shards in (settings.get('queue_shards', '') or '').split(','):
+        if not queue_shards.strip(): continue
+        queue_name, systems = queue_shards.strip().split(':', 1)
+        ztq_core.set_queue_shards(queue_name, systems.split('+'))
+
+    # 队列的优先级个数, 需要和worker的配置一致, 格式: 队列:优先级个数, ...
+    for queue_priorities in (settings.get('priorities', '') or '').split(','):
+        if not queue_priorities.strip(): continue
+        queue_name, levels = queue_priorities.strip().split(':')
+        ztq_core.set_queue_priorities(queue_name, int(levels))
+
+    # 配置的本地缓存
+    config_cache_ttl = (settings.get('config_cache_ttl', '') or '').strip()
+    if config_cache_ttl:
+        ztq_core.set_cache_ttl(float(config_cache_ttl))
+    ztq_core.start_cache_listener()
+
+    # worker的工作线程状态放在带过期时间的hash中, 需要和worker的配置一致
+    job_state_expire = int(settings.get('job_state_expire', '') or 0)
+    if job_state_expire:
+        ztq_core.use_job_state_hash(job_state_expire)
+
     # 初始化权重数据数据,如果权重配置已经存在则pass
     if init_dispatcher_config.lower() == 'true':
         # init_dispatcher_config 是因为控制台可能没有运行服务， 这里去读取redis数据，会导致控制台起不来
@@ -93,6 +131,9 @@ def main(global_config, frs_root='frs', init_dispatcher_config='true', \
     config.set_authentication_policy(authn_policy)
     config.set_authorization_policy(authz_policy)
     config.begin()
+    # 监控页面的读取发给从库
+    if settings.get('read_from_replica', 'false').lower() == 'true':
+        config.add_tween('ztq_console.views.replica_tween_factory')
     config.add_renderer('.html', pyramid_jinja2.renderer_factory)
     config.add_static_view('static', 'ztq_console:static')
     config.scan('ztq_console.views')  
@@ -26,8 +26,14 @@ def dispatch_single_queue(queue_name, from_right=True):
     """
     worker_config = ztq_core.get_worker_config()
     for worker_name, queue_config in worker_config.items():
-        if queue_config.get(queue_name, None):
-            queue_config[queue_name] = update_queue_config(queue_config[queue_name], from_right)
+        updated = False
+        # 一组线程可以同时监视多个队列
+        for queue_spec in queue_config.keys():
+            if queue_name in [name for name, weight in \
+                    ztq_core.split_queue_names(queue_spec)] and queue_config[queue_spec]:
+                queue_config[queue_spec] = update_queue_config(queue_config[queue_spec], from_right)
+                updated = True
+        if updated:
             worker_config[worker_name]= queue_config
             send_sync_command(worker_name)
             
@@ -6,8 +6,9 @@ Created on 2011-4-28
 
 @author: Zay
 '''
-import time, pprint, datetime
+import time, pprint, datetime, itertools
 import ztq_core
+from ztq_core.redis_wrap import PAGE_SIZE
 import urllib
 try:
     import json
@@ -48,7 +49,7 @@ def get_taskqueues_list():
     # 排序
     sort_queue_name = {}
     for queue_name, queue_config in queues_list.items():
-        sort_queue_name[queue_name] = len(ztq_core.get_error_queue(queue_name))
+        sort_queue_name[queue_name] = sum(len(queue) for queue in ztq_core.get_error_queues(queue_name))
     
     for queue_name in sorted(sort_queue_name, 
                             key=lambda x: sort_queue_name[x], 
@@ -57,8 +58,8 @@ def get_taskqueues_list():
         task_queue['name'] = queue_name
         #task_queue['tags'] = queue_config.get('tags',())
         queue = ztq_core.get_task_queue(queue_name)
-        # 任务数/错误数
-        task_queue['length'] = len(queue)
+        # 任务数/错误数, 分布在多个分片上的队列是所有分片的合计
+        task_queue['length'] = ztq_core.get_queue_length(queue_name)
         task_queue['error_length'] = sort_queue_name[queue_name]
 
         #任务首个时间
@@ -78,33 +79,62 @@ def get_taskqueues_list():
         # 获取worker工作线程配置
         workers_config = ztq_core.get_worker_config()
         task_queue['from_right'] = True
+        task_queue['workers'] = []
         for worker_name,worker_config in workers_config.items():
-            task_queue['workers'] = []
-            for config in worker_config.get(queue_name,[]):
-                task_queue['workers'].append([worker_name+':', config['interval']])
-                if 'from_right' in config:
-                    task_queue['from_right'] = config['from_right']
+            # 一组线程可以同时监视多个队列
+            for queue_spec, configs in worker_config.items():
+                if not queue_name in [name for name, weight in \
+                        ztq_core.split_queue_names(queue_spec)]:
+                    continue
+                for config in configs:
+                    task_queue['workers'].append([worker_name+':', config['interval']])
+                    if 'from_right' in config:
+                        task_queue['from_right'] = config['from_right']
         task_queue['buffer_length'] = len(ztq_core.get_buffer_queue(queue_name))
         yield task_queue
 
 def get_queues_jobs(queue_name):
-    queue = ztq_core.get_task_queue(queue_name)
-    for task_job_hash in queue.reverse():
-        task_job = ztq_core.get_task_hash(queue_name).get(task_job_hash)
-        tmp_job={}
-        tmp_job['_queue_name'] = queue_name
-        tmp_job['_id'] = urllib.quote(task_job_hash)
-        #tmp_job['_ori'] = task_job
-        tmp_job['_detail'] = pprint.pformat(task_job)
-        tmp_job['_created'] = datetime.datetime.fromtimestamp(task_job['runtime'].get('create', 0))
-        yield tmp_job
+    levels = ztq_core.get_queue_priorities(queue_name)
+    for system in ztq_core.get_queue_systems(queue_name):
+        # 从高到低每个优先级
+        for priority in range(levels - 1, -1, -1):
+            queue = ztq_core.get_task_queue(queue_name, system, priority)
+            for tmp_job in _get_queue_jobs(queue_name, queue, priority, levels > 1):
+                yield tmp_job
+
+def _get_queue_jobs(queue_name, queue, priority=0, check_priority=False):
+    task_hash = ztq_core.get_task_hash(queue_name, queue.system)
+    priority_hash = ztq_core.get_priority_hash(queue_name, queue.system)
+    task_job_hashes = queue.reverse()
+    while True:
+        # 每页用HMGET一次读取任务和优先级
+        page = list(itertools.islice(task_job_hashes, PAGE_SIZE))
+        if not page: break
+        task_jobs = task_hash.get_many(page)
+        if check_priority:
+            # 已经调整到其他优先级的, 是过期的位置
+            levels = priority_hash.get_many(page)
+            task_jobs = [task_job if (level or '0') == str(priority) else None
+                            for task_job, level in zip(task_jobs, levels)]
+        for task_job_hash, task_job in zip(page, task_jobs):
+            if task_job is None: continue
+            yield _format_queue_job(queue_name, task_job_hash, task_job)
+
+def _format_queue_job(queue_name, task_job_hash, task_job):
+    tmp_job={}
+    tmp_job['_queue_name'] = queue_name
+    tmp_job['_id'] = urllib.quote(task_job_hash)
+    #tmp_job['_ori'] = task_job
+    tmp_job['_detail'] = pprint.pformat(task_job)
+    tmp_job['_created'] = datetime.datetime.fromtimestamp(task_job['runtime'].get('create', 0))
+    return tmp_job
 
 def get_all_error_jobs(sindex=0, eindex=-1):
     queues_list = ztq_core.get_queue_config()
     index = 0
     count = eindex - sindex
     for queue_name in queues_list.keys():
-        error_len = len(ztq_core.get_error_queue(queue_name))
+        error_len = sum(len(queue) for queue in ztq_core.get_error_queues(queue_name))
         if error_len == 0: continue
         # 确定从哪里开始
         index += error_len
@@ -121,11 +151,27 @@ def get_error_queue(error_queue_name, sindex=0, eindex=-1):
     """ 模板问题的原因 """
     yield get_error_queue_jobs(error_queue_name, sindex, eindex)
 
+def _get_error_keys(error_queue_name, sindex=0, eindex=-1):
+    """ 所有分片上的错误队列连在一起, 取出第sindex到第eindex个(包括eindex, -1表示到最后)的
+    (system, hash_key)
+    """
+    for error_queue in ztq_core.get_error_queues(error_queue_name):
+        length = len(error_queue)
+        last = length - 1 if eindex < 0 else min(eindex, length - 1)
+        if 0 <= sindex <= last:
+            for hash_key in error_queue[sindex:last]:
+                yield error_queue.system, hash_key
+        # 下一个分片从哪里开始
+        sindex = max(sindex - length, 0)
+        if eindex >= 0:
+            eindex -= length
+            if eindex < 0: break
+
 def get_error_queue_jobs(error_queue_name, sindex=0, eindex=-1):
-    error_queue = ztq_core.get_error_queue(error_queue_name)
     workers_state = ztq_core.get_worker_state()
-    for hash_key in error_queue[sindex:eindex]:
-        error_job = ztq_core.get_error_hash(error_queue_name)[hash_key]
+    for system, hash_key in _get_error_keys(error_queue_name, sindex, eindex):
+        error_job = ztq_core.get_error_hash(error_queue_name, system).get(hash_key)
+        if error_job is None: continue
         tmp_job={}
         tmp_job['json'] = json.dumps(error_job)
         tmp_job['_queue_name'] = error_queue_name
@@ -35,6 +35,26 @@ MENU_CONFIG = {'title':u'ZTQ队列监控后台',
                      ]
         }
 
+def setup_server(server):
+    """ 连接到一个(不使用sentinel的)服务器, 有从库时也连接从库 """
+    ztq_core.setup_redis('default', host=server['host'], port=server['port'], db=server.get('db', 1))
+    replica = server.get('replica', None)
+    if replica:
+        ztq_core.setup_replica('default', host=replica['host'], port=replica['port'], db=replica['db'])
+
+def replica_tween_factory(handler, registry):
+    """ GET 请求的只读查询发给从库, 减少主库的压力, 操作仍然写主库
+    app.ini 中 read_from_replica = true 时启用
+    """
+    max_lag = float(registry.settings.get('replica_max_lag', '') or ztq_core.redis_wrap.REPLICA_MAX_LAG)
+
+    def replica_tween(request):
+        if request.method != 'GET':
+            return handler(request)
+        with ztq_core.read_from_replica(max_lag):
+            return handler(request)
+    return replica_tween
+
 @view_config(renderer='mainpage.html', permission='view')
 def main_view(request):
     """后台管理首页
@@ -98,7 +118,7 @@ def switch_redis(request):
     for server in MENU_CONFIG['servers']:
         if isinstance(server, dict):
             if server['name'] == redis_key:
-                ztq_core.setup_redis('default', host=server['host'], port=server['port'], db=server.get('db', 1))
+                setup_server(server)
                 MENU_CONFIG['current_redis'] = redis_key
                 break
         elif isinstance(server, (str, unicode)):
@@ -196,8 +216,8 @@ def task_queues(request):
     # 计算原子队列,原始队列和错误队列的总长度
     queues_list = ztq_core.get_queue_config()
     for queue_name, queue_config in queues_list.items():
-        task_job_length += len(ztq_core.get_task_queue(queue_name))
-        error_job_length += len(ztq_core.get_error_queue(queue_name))
+        task_job_length += ztq_core.get_queue_length(queue_name)
+        error_job_length += sum(len(queue) for queue in ztq_core.get_error_queues(queue_name))
     task_queues = utils.get_taskqueues_list()
     
     return {'task_queues':task_queues,
@@ -250,19 +270,36 @@ def task_jobs_handler(request):
     queue_name  = request.matchdict['id']
     url_action = request.params.get('action','')
     job_hash_id = urllib.unquote(request.params.get('hash_id').encode('utf8'))
-    if url_action in valid_action:
+    # 任务所在的分片
+    system = ztq_core.get_queue_system(queue_name, job_hash_id)
+    levels = ztq_core.get_queue_priorities(queue_name)
+    if url_action in valid_action and levels > 1:
+        # 有优先级的队列, 调整到最高或者默认优先级, 删除时列表中的位置出队时跳过, 都是常数时间
+        if url_action == 'high_priority':
+            ztq_core.set_task_priority(queue_name, job_hash_id, levels - 1, to_front=True)
+        elif url_action == 'low_priority':
+            ztq_core.set_task_priority(queue_name, job_hash_id, 0)
+        elif url_action == 'delete':
+            priority_hash = ztq_core.get_priority_hash(queue_name, system)
+            if ztq_core.get_task_hash(queue_name, system).pop(job_hash_id) is not None:
+                # 列表中的位置过期了, 计入过期个数
+                ztq_core.get_redis(system).hincrby(priority_hash.name, 
+                        ztq_core.PRIORITY_STALE_FIELD, 1)
+            del priority_hash[job_hash_id]
+        return HTTPFound(location = '/taskqueues/'+queue_name)
+    elif url_action in valid_action:
         if url_action == 'high_priority':
-            job_queue = ztq_core.get_task_queue(queue_name)
+            job_queue = ztq_core.get_task_queue(queue_name, system)
             job_queue.remove(job_hash_id)
             job_queue.push(job_hash_id, to_left=False)
         elif url_action == 'low_priority':
-            job_queue = ztq_core.get_task_queue(queue_name)
+            job_queue = ztq_core.get_task_queue(queue_name, system)
             job_queue.remove(job_hash_id)
             job_queue.push(job_hash_id)
         elif url_action == 'delete':
-            job_queue = ztq_core.get_task_queue(queue_name)
+            job_queue = ztq_core.get_task_queue(queue_name, system)
             job_queue.remove(job_hash_id)
-            job_hash = ztq_core.get_task_hash(queue_name)
+            job_hash = ztq_core.get_task_hash(queue_name, system)
             job_hash.pop(job_hash_id)
         return HTTPFound(location = '/taskqueues/'+queue_name)
     else: 
@@ -366,12 +403,9 @@ def redo_all_error_for_queue(request):
     """
     queue_id = request.matchdict['id']
 
-    while 1:
-        error_task = ztq_core.pop_error(queue_id, timeout=-1)
-        if error_task is None:
-            break
-        error_task['runtime'] = {'queue':queue_id, 'create':int(time.time())}
-        ztq_core.push_runtime_task(queue_id, error_task)
+    # 在服务端成批的放回任务队列, 配置了 redo_rate 时按这个速度(每秒的任务数)依次放回
+    redo_rate = float(request.registry.settings.get('redo_rate', '') or 0)
+    ztq_core.redo_errors(queue_id, rate=redo_rate or None)
 
     return HTTPFound(location = '/taskqueues')
 
@@ -381,12 +415,13 @@ def del_all_error_for_queue(request):
     """
     queue_id = request.matchdict['id']
 
-    error_hash = ztq_core.get_error_hash(queue_id)
-    error_queue = ztq_core.get_error_queue(queue_id)
+    for system in ztq_core.get_queue_systems(queue_id):
+        error_hash = ztq_core.get_error_hash(queue_id, system)
+        error_queue = ztq_core.get_error_queue(queue_id, system)
 
-    client = ztq_core.get_redis()
-    client.delete(error_queue.name)
-    client.delete(error_hash.name)
+        client = ztq_core.get_redis(system)
+        client.delete(error_queue.name)
+        client.delete(error_hash.name)
 
     return HTTPFound(location = '/taskqueues')
 
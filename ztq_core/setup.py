@@ -6,7 +6,7 @@ here = os.path.abspath(os.path.dirname(__file__))
 README = open(os.path.join(here, 'README.txt')).read()
 CHANGES = open(os.path.join(here, 'CHANGES.txt')).read()
 
-requires = [ 'redis>=2.4.9', 'transaction',]
+requires = [ 'redis>=2.10.0', 'transaction',]
 
 if not os.sys.platform.startswith('win'):
     requires.append('hiredis')
@@ -31,5 +31,6 @@ setup(name='ztq_core',
           'Topic :: Internet :: WWW/HTTP',
           ],
 	  install_requires = requires,
+      extras_require = {'msgpack': ['msgpack'], 'lz4': ['lz4']},
 )
 
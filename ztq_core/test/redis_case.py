@@ -0,0 +1,35 @@
+#coding:utf-8
+'''
+需要redis的测试的公共设置
+
+ZTQ_TEST_REDIS 指定测试用的redis: host:port:db, 默认是 127.0.0.1:6379:9,
+分片的测试还会用到后面的几个db, 每个测试开始时都会清空这些db。
+连不上redis时跳过测试
+'''
+import os
+import unittest
+import ztq_core
+from ztq_core import model, redis_wrap, task
+
+class RedisTestCase(unittest.TestCase):
+    # 测试用到的system, 依次使用从指定的db开始的几个db
+    systems = ('default',)
+
+    def setUp(self):
+        host, port, db = (os.environ.get('ZTQ_TEST_REDIS', '127.0.0.1:6379:9').split(':') 
+                            + ['6379', '9'])[:3]
+        for index, system in enumerate(self.systems):
+            ztq_core.setup_redis(system, host, int(port), int(db) + index, socket_timeout=5)
+            try:
+                ztq_core.get_redis(system).flushdb()
+            except ztq_core.ConnectionError:
+                self.skipTest('redis %s:%s is not available' % (host, port))
+            redis_wrap.invalidate_cache(system=system, publish=False)
+        self.redis = ztq_core.get_redis()
+
+    def tearDown(self):
+        # 恢复模块级别的配置
+        ztq_core.setup_shards(None)
+        for config in (model.QUEUE_SHARDS, model.QUEUE_SHARD_KEYS, model.QUEUE_SERIALIZERS, 
+                       model.QUEUE_PRIORITIES, task.QUEUE_IDENTITY):
+            config.clear()
@@ -0,0 +1,83 @@
+#coding:utf-8
+'''
+测试说明:
+批量执行: worker一次取出同一个方法的多个任务一起执行, 每个任务单独记录成功或者失败
+'''
+import unittest
+import ztq_core
+from ztq_core import async, model
+from redis_case import RedisTestCase
+
+try:
+    from ztq_worker import job_thread
+    from ztq_worker.config_manager import CONFIG, register_batch_queue
+except ImportError:
+    job_thread = None
+
+calls = []
+
+@async(queue='bq', batch=True)
+def index(items):
+    # 执行中每个任务都记录在工作线程状态里
+    calls.append(len(model.get_job_state('w1')))
+    return [ValueError('bad', 'x') if args[0] == 3 else None for args, kw in items]
+
+@async(queue='bq2', batch=True)
+def index_bad_result(items):
+    return True
+
+@unittest.skipIf(job_thread is None, 'ztq_worker is not installed')
+class TestBatchQueue(RedisTestCase):
+
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        CONFIG['server']['alias'] = 'w1'
+        register_batch_queue('bq', 10)
+        register_batch_queue('bq2', 10)
+        del calls[:]
+
+    def tearDown(self):
+        RedisTestCase.tearDown(self)
+        for queue_name in ('bq', 'bq2'):
+            CONFIG['batch_queue'].pop(queue_name, None)
+
+    def run_once(self, queue_name):
+        thread = job_thread.JobThread(queue_name, 0)
+        queue_name, task_md5, task = thread.pop_task(-1)
+        return thread.run_job(task, queue_name, task_md5)
+
+    def test_batch(self):
+        for i in range(5):
+            index(i)
+        self.assertEqual(self.run_once('bq'), 5)
+        self.assertEqual(calls, [5])
+        # 只有返回异常的那个任务失败了
+        self.assertEqual(len(model.get_error_queue('bq')), 1)
+        self.assertEqual(model.get_error_hash('bq').values()[0]['args'], [3])
+        self.assertEqual(len(model.get_job_state('w1')), 0)
+
+    def test_bad_result(self):
+        """ 返回的不是和任务一一对应的列表时, 全部失败, 而不是当作其中一个的结果 """
+        for i in range(3):
+            index_bad_result(i)
+        self.assertEqual(self.run_once('bq2'), 3)
+        self.assertEqual(len(model.get_error_queue('bq2')), 3)
+        reason = ''.join(model.get_error_hash('bq2').values()[0]['runtime']['reason'])
+        self.assertTrue('should return None or a list of 3 results' in reason)
+
+    def test_restart(self):
+        """ worker异常退出时正在批量执行的任务, 重新启动后全部重新执行 """
+        thread = job_thread.JobThread('bq', 0)
+        job_state = model.get_job_state('w1')
+        for i in range(3):
+            task = ztq_core.gen_task('index', i)
+            task['runtime'] = {'queue': 'bq', 'thread': thread.getName(), 'worker': 'w1'}
+            task['process'] = {'pid': -1, 'start': 0}
+            job_state[thread.get_batch_state_name(i)] = task
+        thread._stop = True
+        thread.run()
+        self.assertEqual(calls, [3])
+        self.assertEqual(len(model.get_job_state('w1')), 0)
+
+if __name__ == '__main__':
+    unittest.main()
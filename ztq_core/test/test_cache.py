@@ -0,0 +1,48 @@
+#coding:utf-8
+'''
+测试说明:
+配置的本地缓存: 缓存期间读本地的复本, 写入时失效, 过期后重新读取
+'''
+import time
+import ztq_core
+from ztq_core import model, redis_wrap
+from redis_case import RedisTestCase
+
+class TestCache(RedisTestCase):
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.ttl = redis_wrap.CACHE_TTL
+
+    def tearDown(self):
+        redis_wrap.set_cache_ttl(self.ttl)
+        super(TestCache, self).tearDown()
+
+    def test_cached_dict(self):
+        redis_wrap.set_cache_ttl(60)
+        config = model.get_queue_config()
+        config['cq'] = {'name':'cq', 'title':'a'}
+        self.assertEqual(config['cq']['title'], 'a')
+
+        # 直接修改服务器, 缓存期间读到的还是旧的
+        source = ztq_core.get_dict(config.name)
+        source['cq'] = {'name':'cq', 'title':'b'}
+        self.assertEqual(config['cq']['title'], 'a')
+        ztq_core.invalidate_cache(config.name, publish=False)
+        self.assertEqual(config['cq']['title'], 'b')
+
+        # 读到的是复本, 修改了不影响缓存
+        config['cq']['title'] = 'c'
+        self.assertEqual(config['cq']['title'], 'b')
+        # 写入时失效
+        config['cq'] = {'name':'cq', 'title':'d'}
+        self.assertEqual(config['cq']['title'], 'd')
+
+    def test_ttl(self):
+        redis_wrap.set_cache_ttl(0.2)
+        config = model.get_queue_config()
+        config['cq'] = {'name':'cq', 'title':'a'}
+        self.assertEqual(config['cq']['title'], 'a')
+        ztq_core.get_dict(config.name)['cq'] = {'name':'cq', 'title':'b'}
+        time.sleep(0.3)
+        self.assertEqual(config['cq']['title'], 'b')
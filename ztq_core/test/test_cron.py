@@ -0,0 +1,106 @@
+#coding:utf-8
+'''
+测试说明:
+定时任务的cron表达式解析和下次执行时间的计算, 不需要连接redis;
+TestFireCrons 测试执行定时任务, 错误的定时任务不影响其他的
+'''
+import unittest
+import time
+import datetime
+import ztq_core
+from ztq_core import model, cron
+from ztq_core.cron import parse_cron, next_fire_time
+from redis_case import RedisTestCase
+
+def timestamp(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+class TestCron(unittest.TestCase):
+
+    def test_parse(self):
+        """ 各种字段的写法 """
+        minutes, hours, days, months, weekdays, days_limited, weekdays_limited = \
+                parse_cron('*/15 9-12,18 1 jan-mar mon-fri')
+        self.assertEqual(minutes, set([0, 15, 30, 45]))
+        self.assertEqual(hours, set([9, 10, 11, 12, 18]))
+        self.assertEqual(days, set([1]))
+        self.assertEqual(months, set([1, 2, 3]))
+        self.assertEqual(weekdays, set([1, 2, 3, 4, 5]))
+        self.assertTrue(days_limited and weekdays_limited)
+
+        # 7 也是星期天, a/n 到最大值
+        self.assertEqual(parse_cron('0 0 * * 7')[4], set([0]))
+        self.assertEqual(parse_cron('0 0 * * 5-7')[4], set([0, 5, 6]))
+        self.assertEqual(parse_cron('50/5 * * * *')[0], set([50, 55]))
+        self.assertEqual(parse_cron('@hourly'), parse_cron('0 * * * *'))
+
+    def test_invalid(self):
+        for expression in ('* * * *', '60 * * * *', '* 5-2 * * *', '*/0 * * * *',
+                           '* * * foo *'):
+            self.assertRaises(ValueError, parse_cron, expression)
+        # 永远不会执行
+        self.assertRaises(ValueError, next_fire_time, '0 0 30 2 *', time.time())
+
+    def test_next_fire_time(self):
+        after = timestamp(2024, 1, 31, 23, 59, 30)
+        self.assertEqual(next_fire_time('* * * * *', after), timestamp(2024, 2, 1, 0, 0))
+        self.assertEqual(next_fire_time('30 1 * * *', after), timestamp(2024, 2, 1, 1, 30))
+        # 2024-02-29 是星期四
+        self.assertEqual(next_fire_time('0 12 29 2 *', after), timestamp(2024, 2, 29, 12, 0))
+        self.assertEqual(next_fire_time('0 12 29 2 *', timestamp(2024, 3, 1)),
+                         timestamp(2028, 2, 29, 12, 0))
+        # 总是在after之后
+        self.assertEqual(next_fire_time('0 * * * *', timestamp(2024, 1, 1, 5, 0)),
+                         timestamp(2024, 1, 1, 6, 0))
+
+    def test_day_and_weekday(self):
+        """ 日和星期都限制了, 满足一个就可以 """
+        after = timestamp(2024, 1, 1)    # 星期一
+        self.assertEqual(next_fire_time('0 0 15 * fri', after), timestamp(2024, 1, 5))
+        self.assertEqual(next_fire_time('0 0 * * fri', after), timestamp(2024, 1, 5))
+        self.assertEqual(next_fire_time('0 0 15 * *', after), timestamp(2024, 1, 15))
+
+    def test_interval_and_legacy(self):
+        after = timestamp(2024, 1, 1, 10, 20)
+        self.assertEqual(next_fire_time(300, after), after + 300)
+        self.assertEqual(next_fire_time({'interval': 60}, after), after + 60)
+        self.assertEqual(next_fire_time({'minute': 3, 'hour': 1}, after),
+                         timestamp(2024, 1, 2, 1, 3))
+        self.assertEqual(next_fire_time({'hour': 1}, after), timestamp(2024, 1, 2, 1, 0))
+        self.assertEqual(next_fire_time({'minute': 30}, after), timestamp(2024, 1, 1, 10, 30))
+
+class TestFireCrons(RedisTestCase):
+
+    def test_invalid_legacy(self):
+        """ 迁移旧格式时, 错误的移到无法执行的定时任务中 """
+        cron_set = model.get_cron_set()
+        cron_set.add({'func_name':'f', 'cron_info':{'hour':25}, 'queue':'cq', 'args':[], 'kw':{}})
+        cron_set.add({'func_name':'g', 'cron_info':{'hour':1}, 'queue':'cq', 'args':[], 'kw':{}})
+        self.assertEqual(cron.migrate_crons(), 1)
+        self.assertEqual(len(cron_set), 0)
+        self.assertEqual(len(model.get_cron_hash()), 1)
+        invalid = model.get_invalid_cron_hash().values()
+        self.assertEqual([item['func_name'] for item in invalid], ['f'])
+
+    def test_fire_errors(self):
+        """ 表达式错误的移走, 放入队列出错的跳过这一次, 都不影响其他的定时任务 """
+        ztq_core.add_cron(60, 'cq:ok')
+        ztq_core.add_cron(60, 'cq:bad_priority', ztq_priority=5)
+        ztq_core.add_cron(60, 'cq:bad_info')
+        cron_hash = model.get_cron_hash()
+        for cron_id, item in cron_hash.items():
+            if item['func_name'] == 'bad_info':
+                cron_hash[cron_id] = dict(item, cron_info='* * *')
+        index = model.get_cron_index()
+        for cron_id in cron_hash.keys():
+            index.add(cron_id, time.time() - 1)
+
+        fired, next_time = cron.fire_crons()
+        self.assertEqual(fired, 1)
+        self.assertEqual(ztq_core.pop_task('cq', timeout=-1)['func'], 'ok')
+        self.assertEqual(len(cron_hash), 2)
+        self.assertEqual(len(model.get_invalid_cron_hash()), 1)
+        self.assertTrue(next_time > time.time())
+
+if __name__ == '__main__':
+    unittest.main()
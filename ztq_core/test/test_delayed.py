@@ -0,0 +1,94 @@
+#coding:utf-8
+'''
+测试说明:
+延时任务: ztq_eta/ztq_countdown 放到延时任务中, 到期后由 promote_delayed 放到任务队列
+'''
+import time
+import ztq_core
+from ztq_core import model
+from redis_case import RedisTestCase
+
+class TestDelayed(RedisTestCase):
+
+    def test_promote(self):
+        """ 只移动到期的任务, 索引中记录每个队列最早的到期时间 """
+        now = time.time()
+        ztq_core.push_task('dq:f', 1, ztq_eta=now - 1)
+        ztq_core.push_task('dq:f', 2, ztq_countdown=0.2)
+        ztq_core.push_task('dq:f', 3, ztq_countdown=60)
+        ztq_core.push_task('dq2:f', 4, ztq_countdown=30)
+        self.assertEqual(ztq_core.has_task('dq', ztq_core.gen_task('f', 3)), 'delayed')
+        # 已经到期的直接放入队列
+        self.assertEqual(len(model.get_task_queue('dq')), 1)
+        self.assertEqual(len(model.get_delayed_set('dq')), 2)
+
+        moved, first = ztq_core.promote_delayed()
+        self.assertEqual(moved, 0)
+        self.assertTrue(now < first < now + 1)
+        time.sleep(0.3)
+        moved, first = ztq_core.promote_delayed()
+        self.assertEqual(moved, 1)
+        self.assertTrue(now + 29 < first < now + 31)
+        self.assertEqual([task['args'][0] for task in ztq_core.pop_tasks('dq', 10, timeout=-1)], 
+                         [1, 2])
+        self.assertEqual(len(model.get_delayed_hash('dq')), 1)
+
+    def test_signal(self):
+        """ 加入了更早到期的任务时通知延时任务线程 """
+        ztq_core.push_task('dq:f', 1, ztq_countdown=60)
+        self.assertTrue(ztq_core.wait_delayed_signal(timeout=1))
+        ztq_core.push_task('dq:f', 2, ztq_countdown=120)
+        start = time.time()
+        self.assertFalse(ztq_core.wait_delayed_signal(timeout=1))
+        self.assertTrue(time.time() - start >= 0.9)
+
+    def test_redo_errors(self):
+        """ 错误队列的任务放回任务队列, 或者间隔一段时间放到延时任务中 """
+        for i in range(3):
+            ztq_core.push_runtime_error('dq', ztq_core.gen_task('f', i))
+        self.assertEqual(ztq_core.redo_errors('dq', batch_size=2), 3)
+        self.assertEqual(len(model.get_task_queue('dq')), 3)
+        self.assertEqual(len(model.get_error_queue('dq')), 0)
+
+        for i in range(3):
+            ztq_core.push_runtime_error('dq2', ztq_core.gen_task('f', i))
+        self.assertEqual(ztq_core.redo_errors('dq2', rate=10), 3)
+        self.assertEqual(len(model.get_delayed_set('dq2')), 3)
+
+    def test_redo_errors_runtime(self):
+        """ 重做的任务重置运行信息, 不再带着上次出错的原因、worker和创建时间 """
+        task = ztq_core.gen_task('f', 1)
+        task['runtime'] = {'queue':'dq', 'create':1, 'worker':'w1', 'thread':'t1', 
+                           'end':2, 'return':300, 'reason':['Traceback']}
+        ztq_core.push_runtime_error('dq', task)
+        self.assertEqual(ztq_core.redo_errors('dq'), 1)
+        runtime = model.get_task_hash('dq').values()[0]['runtime']
+        self.assertEqual(sorted(runtime.keys()), ['create', 'queue'])
+        self.assertEqual(runtime['queue'], 'dq')
+        self.assertTrue(runtime['create'] >= int(time.time()) - 1)
+
+        # 已经删除了的错误不再重做
+        ztq_core.push_runtime_error('dq', ztq_core.gen_task('f', 2))
+        del model.get_error_hash('dq')[model.get_error_queue('dq')[0]]
+        self.assertEqual(ztq_core.redo_errors('dq'), 0)
+        self.assertEqual(len(model.get_error_queue('dq')), 0)
+
+    def test_push_tasks_countdown(self):
+        """ 批量加入时, 全部或者单个任务指定的到期时间不会留在任务的kw中 """
+        results = ztq_core.push_tasks('dq:f', [((1,), {}), ((2,), {'ztq_countdown':60}), 
+                                               ((3,), {'ztq_countdown':-1})])
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual(len(model.get_delayed_set('dq')), 1)
+        tasks = ztq_core.pop_tasks('dq', 10, timeout=-1)
+        self.assertEqual(sorted(task['args'][0] for task in tasks), [1, 3])
+        self.assertEqual([task['kw'] for task in tasks], [{}, {}])
+
+        ztq_core.push_tasks('dq:f', [((4,), {}), ((5,), {})], ztq_eta=time.time() + 60)
+        self.assertEqual(len(model.get_delayed_set('dq')), 3)
+        self.assertEqual(ztq_core.pop_tasks('dq', 10, timeout=-1), [])
+        delayed = model.get_delayed_hash('dq')
+        self.assertTrue(all(task['kw'] == {} for task in delayed.values()))
+
+    def test_buffer_task_eta(self):
+        self.assertRaises(ValueError, ztq_core.push_buffer_task, 'dq:f', 1, ztq_countdown=60)
+        self.assertEqual(len(model.get_buffer_queue('dq')), 0)
@@ -0,0 +1,96 @@
+#coding:utf-8
+'''
+测试说明:
+工作线程: 重新执行worker异常退出时没有结束的任务, 取任务之前先取得限流许可
+'''
+import time
+import threading
+import unittest
+import ztq_core
+from ztq_core import async, model
+from redis_case import RedisTestCase
+
+try:
+    from ztq_worker import job_thread
+    from ztq_worker.config_manager import CONFIG
+except ImportError:
+    job_thread = None
+
+@async(queue='mq2')
+def fail_job(value):
+    raise ValueError(value)
+
+@async(queue='cq')
+def limited_job(value):
+    pass
+
+@async(queue='mq1')
+def free_job(value):
+    pass
+
+@unittest.skipIf(job_thread is None, 'ztq_worker is not installed')
+class TestJobThread(RedisTestCase):
+
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        CONFIG['server']['alias'] = 'w1'
+
+    def tearDown(self):
+        ztq_core.set_queue_limits('cq')
+        RedisTestCase.tearDown(self)
+
+    def test_restart_multi_queue(self):
+        """ 监视多个队列的线程, 重新执行的任务按任务所在的队列处理 """
+        thread = job_thread.JobThread('mq1,mq2', 0)
+        task = ztq_core.gen_task('fail_job', 1)
+        task['runtime'] = {'queue': 'mq2', 'thread': thread.getName(), 'worker': 'w1'}
+        task['process'] = {'pid': -1, 'start': 0}
+        model.get_job_state('w1')[thread.getName()] = task
+        thread._stop = True
+        thread.run()
+        self.assertEqual(len(model.get_error_queue('mq2')), 1)
+        self.assertEqual(model.get_error_hash('mq2').values()[0]['runtime']['queue'], 'mq2')
+        self.assertEqual(len(model.get_error_queue('mq1,mq2')), 0)
+        self.assertEqual(len(model.get_job_state('w1')), 0)
+
+    def test_capacity_before_pop(self):
+        """ 并发数满了时任务留在队列中, 取得许可后才取出来 """
+        ztq_core.set_queue_limits('cq', concurrency=1)
+        other = ztq_core.acquire_capacity('cq', 'other', timeout=-1)
+        limited_job(1)
+        thread = job_thread.JobThread('cq', 0)
+        popped = []
+        waiter = threading.Thread(target=lambda: popped.append(thread.pop_task(2)))
+        waiter.start()
+        time.sleep(0.5)
+        self.assertEqual(ztq_core.get_queue_length('cq'), 1)
+        self.assertEqual(ztq_core.ping_task(limited_job, 1), 'queue')
+
+        ztq_core.release_capacity('cq', other)
+        waiter.join(5)
+        queue_name, task_md5, task = popped[0]
+        self.assertEqual(task['args'], [1])
+        self.assertEqual(len(model.get_semaphore_set('cq')), 1)
+        # 执行完释放
+        thread.run_job(task, queue_name, task_md5)
+        self.assertEqual(len(model.get_semaphore_set('cq')), 0)
+
+    def test_capacity_multi_queue(self):
+        """ 监视多个队列时, 只从有许可的队列中取, 没有用到的许可马上释放 """
+        ztq_core.set_queue_limits('cq', concurrency=1)
+        other = ztq_core.acquire_capacity('cq', 'other', timeout=-1)
+        limited_job(1)
+        free_job(2)
+        thread = job_thread.JobThread('cq,mq1', 0)
+        queue_name, task_md5, task = thread.pop_task(-1)
+        self.assertEqual((queue_name, task['args']), ('mq1', [2]))
+        self.assertEqual(ztq_core.get_queue_length('cq'), 1)
+
+        ztq_core.release_capacity('cq', other)
+        thread.run_job(task, queue_name, task_md5)
+        queue_name, task_md5, task = thread.pop_task(-1)
+        self.assertEqual(queue_name, 'cq')
+        self.assertEqual(len(model.get_semaphore_set('cq')), 1)
+
+if __name__ == '__main__':
+    unittest.main()
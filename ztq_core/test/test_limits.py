@@ -0,0 +1,70 @@
+#coding:utf-8
+'''
+测试说明:
+队列限流: 令牌桶限速, 分布式信号量限制并发数, 批处理每个任务占用一个并发数和一个令牌
+'''
+import time
+import ztq_core
+from ztq_core import model
+from redis_case import RedisTestCase
+
+class TestLimits(RedisTestCase):
+
+    def test_concurrency(self):
+        ztq_core.set_queue_limits('lq', concurrency=3)
+        capacity = ztq_core.acquire_capacity('lq', 'w:a', 2, timeout=-1)
+        self.assertTrue(capacity)
+        semaphore = model.get_semaphore_set('lq')
+        self.assertEqual(len(semaphore), 2)
+
+        # 批处理占用了2个, 只剩1个
+        self.assertFalse(ztq_core.acquire_capacity('lq', 'w:b', 2, timeout=-1))
+        self.assertTrue(ztq_core.acquire_capacity('lq', 'w:b', 1, timeout=-1))
+        self.assertFalse(ztq_core.acquire_capacity('lq', 'w:c', 1, timeout=-1))
+
+        # 释放一批, 每个任务一个
+        self.assertEqual(ztq_core.release_capacity('lq', capacity), 2)
+        self.assertEqual(len(semaphore), 1)
+        self.assertTrue(ztq_core.acquire_capacity('lq', 'w:c', 2, timeout=-1))
+        self.assertEqual(ztq_core.release_capacity('lq', capacity), 0)
+
+    def test_acquire_more(self):
+        """ 在已经取得的许可上补足, 取不到时原来的许可不变 """
+        ztq_core.set_queue_limits('lq', concurrency=3)
+        capacity = ztq_core.acquire_capacity('lq', 'w:a', timeout=-1)
+        more = ztq_core.acquire_capacity('lq', 'w:a', 3, timeout=-1, acquired=capacity)
+        self.assertEqual(len(more[2]), 3)
+        self.assertEqual(ztq_core.release_capacity('lq', more), 3)
+
+        capacity = ztq_core.acquire_capacity('lq', 'w:a', timeout=-1)
+        self.assertTrue(ztq_core.acquire_capacity('lq', 'w:b', 2, timeout=-1))
+        self.assertEqual(ztq_core.acquire_capacity('lq', 'w:a', 2, timeout=-1, 
+                                                   acquired=capacity), None)
+        self.assertEqual(len(model.get_semaphore_set('lq')), 3)
+        self.assertEqual(ztq_core.release_capacity('lq', capacity), 1)
+
+    def test_release_after_config_change(self):
+        """ 按取得时的持有者释放, 中间修改了并发数也不会漏掉 """
+        ztq_core.set_queue_limits('lq', concurrency=3)
+        capacity = ztq_core.acquire_capacity('lq', 'w:a', 2, timeout=-1)
+        ztq_core.set_queue_limits('lq', concurrency=1)
+        self.assertEqual(ztq_core.release_capacity('lq', capacity), 2)
+        ztq_core.set_queue_limits('lq')
+        self.assertEqual(len(model.get_semaphore_set('lq')), 0)
+
+    def test_batch_larger_than_burst(self):
+        """ 需要的令牌超过令牌桶容量时, 分几次取得 """
+        ztq_core.set_queue_limits('lq', rate_limit=20, rate_burst=5)
+        start = time.time()
+        self.assertTrue(ztq_core.acquire_capacity('lq', 'w:a', 10))
+        # 第一次取5个, 剩下5个需要等 5 / 20 秒
+        self.assertTrue(time.time() - start >= 0.2)
+
+        # 令牌用完了, 不等待时取不到
+        self.assertFalse(ztq_core.acquire_capacity('lq', 'w:b', 5, timeout=-1))
+
+    def test_release_on_partial_tokens(self):
+        """ 超时时只取得了一部分令牌, 放弃已经占用的并发数 """
+        ztq_core.set_queue_limits('lq', rate_limit=1, rate_burst=2, concurrency=5)
+        self.assertFalse(ztq_core.acquire_capacity('lq', 'w:a', 4, timeout=0.5))
+        self.assertEqual(len(model.get_semaphore_set('lq')), 0)
@@ -0,0 +1,39 @@
+#coding:utf-8
+'''
+测试说明:
+连接池的配置: 只有限制了最大连接数时才使用阻塞的连接池, 不需要连接redis
+'''
+import unittest
+from ztq_core import redis_wrap
+
+class TestPool(unittest.TestCase):
+
+    def setUp(self):
+        self.options = dict(redis_wrap.POOL_OPTIONS)
+
+    def tearDown(self):
+        redis_wrap.POOL_OPTIONS.update(self.options)
+        redis_wrap.SYSTEMS.pop('pool_test', None)
+        redis_wrap.BLOCKING_SYSTEMS.pop('pool_test', None)
+
+    def test_blocking_pool_unbounded(self):
+        """ 设置了pool_timeout, 阻塞命令的连接池没有限制最大连接数时不限制 """
+        redis_wrap.set_pool_options(max_connections=10, pool_timeout=5)
+        redis_wrap.setup_redis('pool_test', 'localhost', 6379)
+        pool = redis_wrap.SYSTEMS['pool_test'].connection_pool
+        self.assertTrue(isinstance(pool, redis_wrap.StatsBlockingConnectionPool))
+        self.assertEqual(pool.max_connections, 10)
+        pool = redis_wrap.BLOCKING_SYSTEMS['pool_test'].connection_pool
+        self.assertFalse(isinstance(pool, redis_wrap.StatsBlockingConnectionPool))
+
+    def test_blocking_pool_limited(self):
+        redis_wrap.set_pool_options(pool_timeout=5, blocking_max_connections=100)
+        redis_wrap.setup_redis('pool_test', 'localhost', 6379)
+        self.assertFalse(isinstance(redis_wrap.SYSTEMS['pool_test'].connection_pool, 
+                                    redis_wrap.StatsBlockingConnectionPool))
+        pool = redis_wrap.BLOCKING_SYSTEMS['pool_test'].connection_pool
+        self.assertTrue(isinstance(pool, redis_wrap.StatsBlockingConnectionPool))
+        self.assertEqual(pool.max_connections, 100)
+
+if __name__ == '__main__':
+    unittest.main()
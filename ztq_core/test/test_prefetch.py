@@ -0,0 +1,82 @@
+#coding:utf-8
+'''
+测试说明:
+预取: 一次往返取出多个任务, 放回队列, 唤醒工作线程, worker异常退出后放回预取的任务
+'''
+import time
+import unittest
+import ztq_core
+from ztq_core import model
+from redis_case import RedisTestCase
+
+try:
+    from ztq_worker import job_thread
+except ImportError:
+    job_thread = None
+
+class TestPrefetch(RedisTestCase):
+
+    def test_pop_and_requeue(self):
+        ztq_core.push_tasks('pq:f', [((i,), {}) for i in range(10)])
+        tasks = ztq_core.pop_tasks('pq', 4, timeout=-1)
+        self.assertEqual([task['args'][0] for task in tasks], [0, 1, 2, 3])
+        self.assertEqual(len(model.get_task_hash('pq')), 6)
+
+        # 放回出队端, 保持原来的顺序
+        ztq_core.requeue_tasks('pq', tasks[1:])
+        tasks = ztq_core.pop_tasks('pq', 20, timeout=-1)
+        self.assertEqual([task['args'][0] for task in tasks], range(1, 10))
+        self.assertEqual(ztq_core.pop_tasks('pq', 20, timeout=-1), [])
+
+    def test_wake_up(self):
+        """ 取到唤醒用的空任务时不再阻塞等待 """
+        model.get_task_queue('pq').push('')
+        start = time.time()
+        self.assertEqual(ztq_core.pop_tasks('pq', 5, timeout=3), [])
+        self.assertTrue(time.time() - start < 1)
+
+    @unittest.skipIf(job_thread is None, 'ztq_worker is not installed')
+    def test_crash_recovery(self):
+        """ 预取的任务记录在服务器上, worker重新启动时放回队列 """
+        job_thread.CONFIG['server']['alias'] = 'w1'
+        job_thread.CONFIG.setdefault('prefetch_queue', {})['pq'] = 5
+        try:
+            ztq_core.push_tasks('pq:f', [((i,), {}) for i in range(8)])
+            thread = job_thread.JobThread('pq', 0)
+            queue_name, task_md5, task = thread.pop_task(-1)
+            self.assertEqual(task['args'][0], 0)
+            saved = model.get_prefetch_state('w1')[thread.getName()]
+            self.assertEqual([item['args'][0] for item in saved['tasks']], [0, 1, 2, 3, 4])
+
+            # worker异常退出了, 重新启动
+            self.assertEqual(job_thread.requeue_prefetched_state('w1'), 5)
+            self.assertEqual(len(model.get_prefetch_state('w1')), 0)
+            tasks = ztq_core.pop_tasks('pq', 20, timeout=-1)
+            self.assertEqual(sorted(task['args'][0] for task in tasks), range(8))
+        finally:
+            del job_thread.CONFIG['prefetch_queue']['pq']
+
+    @unittest.skipIf(job_thread is None, 'ztq_worker is not installed')
+    def test_save_once(self):
+        """ 每次预取只记录一次, 执行每个任务时不再重写, 取完了删除记录 """
+        job_thread.CONFIG['server']['alias'] = 'w1'
+        job_thread.CONFIG.setdefault('prefetch_queue', {})['pq'] = 3
+        try:
+            ztq_core.push_tasks('pq:f', [((i,), {}) for i in range(3)])
+            thread = job_thread.JobThread('pq', 0)
+            prefetch_state = model.get_prefetch_state('w1')
+            for i in range(3):
+                queue_name, task_md5, task = thread.pop_task(-1)
+                self.assertEqual(task['args'][0], i)
+                if i < 2:
+                    # 先把记录改掉, 执行任务时没有重写
+                    prefetch_state[thread.getName()] = {'queue': 'pq', 'tasks': []}
+                thread.run_job(task, queue_name, task_md5)
+                if i < 2:
+                    self.assertEqual(prefetch_state[thread.getName()]['tasks'], [])
+            self.assertEqual(len(prefetch_state), 0)
+        finally:
+            del job_thread.CONFIG['prefetch_queue']['pq']
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#coding:utf-8
+'''
+测试说明:
+优先级队列: 高优先级先出队, 调整优先级时原来的位置延迟删除, 过期位置不计入队列长度,
+延时任务和重试的任务保持优先级
+'''
+import time
+import ztq_core
+from ztq_core import model
+from redis_case import RedisTestCase
+
+class TestPriority(RedisTestCase):
+
+    def setUp(self):
+        super(TestPriority, self).setUp()
+        ztq_core.set_queue_priorities('pq', 3)
+
+    def push(self, value, **kw):
+        ztq_core.push_task('pq:f', value, **kw)
+        return ztq_core.get_task_id('pq', ztq_core.gen_task('f', value))
+
+    def pop_values(self):
+        return [task['args'][0] for task in ztq_core.pop_tasks('pq', 100, timeout=-1)]
+
+    def test_order(self):
+        self.push(1)
+        self.push(2, ztq_priority=2)
+        self.push(3, ztq_priority=1)
+        self.assertEqual(ztq_core.get_queue_length('pq'), 3)
+        task = ztq_core.pop_task('pq', timeout=-1)
+        self.assertEqual(task['args'][0], 2)
+        self.assertEqual(task['runtime']['priority'], 2)
+        self.assertEqual(self.pop_values(), [3, 1])
+        self.assertRaises(ValueError, self.push, 4, ztq_priority=3)
+
+    def test_lazy_deletion(self):
+        """ 调整优先级后原来的位置过期了, 出队时跳过, 不计入队列长度 """
+        md5s = [self.push(value) for value in range(5)]
+        self.assertTrue(ztq_core.set_task_priority('pq', md5s[3], 2))
+        self.assertTrue(ztq_core.set_task_priority('pq', md5s[3], 1))
+        self.assertFalse(ztq_core.set_task_priority('pq', md5s[3], 1))
+        self.assertEqual(sum(len(queue) for queue in model.get_task_queues('pq')), 7)
+        self.assertEqual(ztq_core.get_queue_length('pq'), 5)
+
+        self.assertEqual(ztq_core.pop_task('pq', timeout=-1)['args'][0], 3)
+        self.assertEqual(ztq_core.get_queue_length('pq'), 4)
+        self.assertEqual(self.pop_values(), [0, 1, 2, 4])
+        self.assertEqual(ztq_core.get_queue_length('pq'), 0)
+        # 过期位置都出队了, 过期个数也清零了
+        self.assertEqual(sum(len(queue) for queue in model.get_task_queues('pq')), 0)
+        self.assertEqual(len(model.get_priority_hash('pq')), 0)
+
+    def test_pop_by_md5(self):
+        md5s = [self.push(value) for value in range(3)]
+        ztq_core.set_task_priority('pq', md5s[1], 2)
+        ztq_core.set_task_priority('pq', md5s[1], 0)
+        self.assertEqual(ztq_core.get_queue_length('pq'), 3)
+        self.assertEqual(ztq_core.pop_task('pq', md5s[1])['args'][0], 1)
+        self.assertEqual(ztq_core.get_queue_length('pq'), 2)
+        self.assertEqual(self.pop_values(), [0, 2])
+        self.assertEqual(len(model.get_priority_hash('pq')), 0)
+
+    def test_buffer_fill(self):
+        """ buffer按实际的任务数补足任务队列 """
+        md5s = [self.push(value) for value in range(2)]
+        ztq_core.set_task_priority('pq', md5s[0], 2)
+        for value in range(10, 15):
+            ztq_core.push_buffer_task('pq:f', value)
+        self.assertEqual(ztq_core.promote_buffer('pq', 4), 2)
+        self.assertEqual(ztq_core.get_queue_length('pq'), 4)
+
+    def test_delayed_priority(self):
+        """ 延时任务和重试的任务到期后放回原来的优先级 """
+        self.push(1, ztq_priority=2, ztq_eta=time.time() + 0.2)
+        self.push(2)
+        self.assertEqual(self.pop_values(), [2])
+        time.sleep(0.3)
+        self.assertEqual(ztq_core.promote_delayed()[0], 1)
+        task = ztq_core.pop_tasks('pq', 10, timeout=-1)[0]
+        self.assertEqual(task['runtime']['priority'], 2)
+
+        self.push(3)
+        ztq_core.retry_task('pq', task, 0)
+        ztq_core.promote_delayed()
+        self.assertEqual(self.pop_values(), [1, 3])
+        self.assertEqual(len(model.get_delayed_priority_hash('pq')), 0)
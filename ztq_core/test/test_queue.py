@@ -0,0 +1,142 @@
+#coding:utf-8
+'''
+测试说明:
+任务队列的原子入队/出队、去重、多个队列出队、buffer、脚本丢失时的pipeline, 以及可靠模式的取出/确认/放回
+'''
+import time
+import threading
+import ztq_core
+from ztq_core import model
+from ztq_core.redis_wrap import register_script, execute_pipeline
+from redis_case import RedisTestCase
+
+class TestPushPop(RedisTestCase):
+
+    def test_push_dedup(self):
+        """ hash写入和列表push在一个脚本中完成, 相同的任务只有一个 """
+        self.assertEqual(ztq_core.push_task('tq:f', 1, a=2), 1)
+        self.assertEqual(ztq_core.push_task('tq:f', 1, a=2), 0)
+        self.assertEqual(ztq_core.push_tasks('tq:f', [((1,), {'a':2}), ((2,), {})]), 
+                         [False, True])
+        self.assertEqual(len(model.get_task_queue('tq')), 2)
+        self.assertEqual(len(model.get_task_hash('tq')), 2)
+        self.assertEqual(ztq_core.has_task('tq', ztq_core.gen_task('f', 2)), 'queue')
+
+        # 先进先出
+        self.assertEqual(ztq_core.pop_task('tq', timeout=-1)['args'], [1])
+        self.assertEqual(ztq_core.pop_task('tq', timeout=-1)['args'], [2])
+        self.assertEqual(ztq_core.pop_task('tq', timeout=-1), None)
+        self.assertEqual(len(model.get_task_hash('tq')), 0)
+
+    def test_concurrent_pop(self):
+        """ 多个线程同时出队, 每个任务只被取出一次 """
+        ztq_core.push_tasks('tq:f', [((i,), {}) for i in range(200)])
+        got = []
+        def worker():
+            while True:
+                task = ztq_core.pop_task('tq', timeout=-1)
+                if task is None: break
+                got.append(task['args'][0])
+        threads = [threading.Thread(target=worker) for i in range(5)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(sorted(got), range(200))
+
+    def test_pop_by_md5(self):
+        ztq_core.push_tasks('tq:f', [((i,), {}) for i in range(3)])
+        task_md5 = ztq_core.get_task_id('tq', ztq_core.gen_task('f', 1))
+        self.assertEqual(ztq_core.pop_task('tq', task_md5)['args'], [1])
+        self.assertEqual(list(model.get_task_queue('tq')), 
+                         [ztq_core.get_task_id('tq', ztq_core.gen_task('f', i)) for i in (2, 0)])
+
+    def test_pop_any(self):
+        """ 排在前面的队列优先, 都为空时阻塞等待 """
+        ztq_core.push_task('low:f', 1)
+        ztq_core.push_task('high:f', 2)
+        self.assertEqual(ztq_core.pop_any_task(['high', 'low'], timeout=-1)[0], 'high')
+        self.assertEqual(ztq_core.pop_any_task(['high', 'low'], timeout=-1)[0], 'low')
+
+        timer = threading.Timer(0.2, ztq_core.push_task, ('low:f', 3))
+        timer.start()
+        queue_name, task = ztq_core.pop_any_task(['high', 'low'], timeout=2)
+        self.assertEqual((queue_name, task['args']), ('low', [3]))
+
+    def test_server_identity(self):
+        """ 服务端生成id的队列不去重 """
+        ztq_core.set_queue_identity('tq', 'server')
+        ztq_core.push_task('tq:f', 1)
+        ztq_core.push_task('tq:f', 1)
+        self.assertEqual(len(model.get_task_queue('tq')), 2)
+        self.assertEqual(ztq_core.has_task('tq', ztq_core.gen_task('f', 1)), 'none')
+
+    def test_buffer(self):
+        """ buffer中的任务按任务队列的空位移过去 """
+        for i in range(5):
+            ztq_core.push_buffer_task('tq:f', i)
+        ztq_core.push_task('tq:f', 100)
+        self.assertEqual(ztq_core.promote_buffer('tq', 3), 2)
+        self.assertEqual(len(model.get_buffer_queue('tq')), 3)
+        self.assertEqual(len(model.get_task_queue('tq')), 3)
+        self.assertEqual(ztq_core.promote_buffer('tq', 3), 0)
+
+    def test_pipeline_noscript(self):
+        """ 脚本丢失时, 重新加载后按原来的顺序再执行, 脚本不会跑到后面的命令之后 """
+        set_value = register_script('test:set_value', "return redis.call('SET', KEYS[1], ARGV[1])")
+        self.redis.script_flush()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set('tk', 'a')
+        set_value(keys=('tk',), args=('b',), client=pipe)
+        pipe.delete('tk')
+        results = execute_pipeline(pipe, self.redis)
+        self.assertEqual(results[0], True)
+        self.assertEqual(results[2], 1)
+        self.assertEqual(self.redis.get('tk'), None)
+
+    def test_buffer_signal(self):
+        """ 每个buffer队列一个信号, 只等待自己管理的队列时不会取走其他队列的信号 """
+        ztq_core.push_buffer_task('tq:f', 1)
+        ztq_core.push_buffer_task('tq:f', 2)
+        ztq_core.push_buffer_task('tq2:f', 1)
+        self.assertEqual(len(model.get_buffer_signal_queue('tq')), 1)
+        self.assertEqual(ztq_core.wait_buffer_signal(['tq2'], timeout=1), 'tq2')
+        self.assertEqual(ztq_core.wait_buffer_signal(['tq2'], timeout=1), None)
+        self.assertEqual(ztq_core.wait_buffer_signal(['tq', 'tq2'], timeout=1), 'tq')
+
+        # 任务完成时, buffer为空就不通知
+        ztq_core.promote_buffer('tq2', 10)
+        self.assertEqual(ztq_core.signal_buffer('tq2'), 0)
+        self.assertEqual(ztq_core.signal_buffer('tq'), 1)
+
+class TestReliable(RedisTestCase):
+
+    def test_claim_ack(self):
+        """ 取出的任务在处理中列表里, hash中的任务保留到确认 """
+        ztq_core.push_tasks('rq:f', [((i,), {}) for i in range(2)])
+        task_md5, task = ztq_core.claim_task('rq', 'w:1', timeout=-1)
+        self.assertEqual(task['args'], [0])
+        self.assertEqual(list(model.get_processing_queue('rq', 'w:1')), [task_md5])
+        self.assertTrue(task_md5 in [key for key, value in model.get_task_hash('rq').items()])
+
+        self.assertTrue(ztq_core.ack_task('rq', task_md5, 'w:1'))
+        self.assertEqual(len(model.get_processing_queue('rq', 'w:1')), 0)
+        self.assertEqual(len(model.get_task_hash('rq')), 1)
+
+    def test_blocking_claim(self):
+        timer = threading.Timer(0.2, ztq_core.push_task, ('rq:f', 1))
+        timer.start()
+        task_md5, task = ztq_core.claim_task('rq', 'w:1', timeout=2)
+        self.assertEqual(task['args'], [1])
+        self.assertEqual(list(model.get_processing_queue('rq', 'w:1')), [task_md5])
+
+    def test_requeue_dead(self):
+        """ 心跳过期的worker处理中的任务放回队列的出队端, 活着的不动 """
+        ztq_core.push_tasks('rq:f', [((i,), {}) for i in range(3)])
+        model.set_heartbeat('w:alive', 60)
+        ztq_core.claim_task('rq', 'w:dead', timeout=-1)
+        ztq_core.claim_task('rq', 'w:alive', timeout=-1)
+
+        self.assertEqual(ztq_core.requeue_dead_consumers(), 1)
+        self.assertEqual(len(model.get_processing_queue('rq', 'w:dead')), 0)
+        self.assertEqual(len(model.get_processing_queue('rq', 'w:alive')), 1)
+        self.assertEqual(ztq_core.pop_task('rq', timeout=-1)['args'], [0])
+        self.assertEqual(ztq_core.pop_task('rq', timeout=-1)['args'], [2])
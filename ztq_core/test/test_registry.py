@@ -0,0 +1,44 @@
+#coding:utf-8
+'''
+测试说明:
+DictFu 的登记集合: 遍历时清除已经不存在的key, 第一次使用时用SCAN补全登记
+'''
+import ztq_core
+from ztq_core import redis_wrap
+from redis_case import RedisTestCase
+
+class TestRegistry(RedisTestCase):
+
+    def test_prune(self):
+        """ 过期或者被直接删除的key, items()之后从登记中删除 """
+        states = ztq_core.get_dict('ztq:test:state:', registry='ztq:test:set:state')
+        states['a'] = {'v':1}
+        states['b'] = {'v':2}
+        self.redis.delete('ztq:test:state:a')
+        self.assertEqual(len(states), 2)
+        self.assertEqual(states.items(), [('b', {'v':2})])
+        self.assertEqual(len(states), 1)
+        self.assertEqual(states.keys(), ['b'])
+
+    def test_rebuild(self):
+        self.redis.set('ztq:test:old:a', '1')
+        self.redis.set('ztq:test:old:b', '2')
+        redis_wrap._CHECKED_REGISTRIES.clear()
+        redis_wrap.rebuild_registry('ztq:test:set:old', 'ztq:test:old:')
+        self.assertEqual(self.redis.smembers('ztq:test:set:old'), set(['a', 'b']))
+        self.assertTrue(self.redis.sismember(redis_wrap.REBUILT_REGISTRIES, 'ztq:test:set:old'))
+
+        # SCAN中途出错的, 下次重新补全
+        redis_wrap._CHECKED_REGISTRIES.clear()
+        scan_keys = redis_wrap.scan_keys
+        def broken_scan(*args, **kw):
+            raise ztq_core.ConnectionError('broken')
+        redis_wrap.scan_keys = broken_scan
+        try:
+            self.assertRaises(ztq_core.ConnectionError, redis_wrap.rebuild_registry, 
+                              'ztq:test:set:new', 'ztq:test:old:')
+        finally:
+            redis_wrap.scan_keys = scan_keys
+        self.assertFalse(self.redis.sismember(redis_wrap.REBUILT_REGISTRIES, 'ztq:test:set:new'))
+        redis_wrap.rebuild_registry('ztq:test:set:new', 'ztq:test:old:')
+        self.assertEqual(self.redis.scard('ztq:test:set:new'), 2)
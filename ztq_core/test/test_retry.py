@@ -0,0 +1,58 @@
+#coding:utf-8
+'''
+测试说明:
+出错自动重试: 重试策略、指数退避, 重试的任务放到延时任务中
+'''
+import time
+import unittest
+import ztq_core
+from ztq_core import model
+from redis_case import RedisTestCase
+
+try:
+    from ztq_worker import job_thread, config_manager
+except ImportError:
+    job_thread = None
+
+@unittest.skipIf(job_thread is None, 'ztq_worker is not installed')
+class TestRetryPolicy(unittest.TestCase):
+
+    def tearDown(self):
+        config_manager.CONFIG.pop('retry_queue', None)
+
+    def get_countdown(self, e, retries=0):
+        task = {'func':'retry_func', 'runtime':{'retries':retries}}
+        return job_thread.get_retry_countdown('rq', task, e)
+
+    def test_retry_on(self):
+        """ retry_on 可以是异常类型、元组或者列表 """
+        for retry_on in (IOError, (IOError, KeyError), [IOError, KeyError]):
+            config_manager.register_retry_queue('rq', retry_on=retry_on)
+            self.assertTrue(self.get_countdown(IOError()) is not None)
+            self.assertTrue(self.get_countdown(ValueError()) is None)
+
+    def test_backoff(self):
+        config_manager.register_retry_queue('rq', max_retries=3, countdown=2, max_countdown=5)
+        self.assertTrue(1 <= self.get_countdown(ValueError()) <= 2)
+        self.assertTrue(2.5 <= self.get_countdown(ValueError(), 2) <= 5)
+        self.assertTrue(self.get_countdown(ValueError(), 3) is None)
+
+class TestRetryTask(RedisTestCase):
+
+    def test_retry_task(self):
+        """ 重试的任务放到延时任务中, 到期后放回任务队列 """
+        ztq_core.push_task('rq:f', 1)
+        task = ztq_core.pop_task('rq', timeout=-1)
+        task['runtime']['retries'] = 1
+        self.assertEqual(ztq_core.retry_task('rq', task, 0.2), 1)
+        self.assertEqual(ztq_core.has_task('rq', task), 'delayed')
+        self.assertEqual(ztq_core.pop_task('rq', timeout=-1), None)
+
+        time.sleep(0.3)
+        self.assertEqual(ztq_core.promote_delayed()[0], 1)
+        task = ztq_core.pop_task('rq', timeout=-1)
+        self.assertEqual(task['args'], [1])
+        self.assertEqual(task['runtime']['retries'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
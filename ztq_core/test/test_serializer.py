@@ -0,0 +1,40 @@
+#coding:utf-8
+'''
+测试说明:
+带头的序列化方式: 头中记录编码和压缩方式, 老格式的数据和新格式可以共存
+'''
+import json
+import ztq_core
+from ztq_core import model, redis_wrap
+from ztq_core.redis_wrap import dump_method, load_method, SERIALIZE_HEADER
+from redis_case import RedisTestCase
+
+class TestSerializer(RedisTestCase):
+
+    def test_header(self):
+        data = dump_method['json+zlib']({'a':1})
+        self.assertEqual(data[:4], SERIALIZE_HEADER + 'j-')
+        self.assertEqual(load_method['json+zlib'](data), {'a':1})
+
+        # 超过阀值才压缩
+        item = {'a':'x' * 2000}
+        data = dump_method['json+zlib'](item)
+        self.assertEqual(data[:4], SERIALIZE_HEADER + 'jz')
+        self.assertTrue(len(data) < 200)
+        self.assertEqual(load_method['json+zlib'](data), item)
+
+    def test_mixed_formats(self):
+        """ 老的json数据和新格式的数据都能读取 """
+        self.assertEqual(load_method['json+zlib'](json.dumps([1, 2])), [1, 2])
+        self.assertEqual(load_method['json'](dump_method['pickle2']({'b':2})), {'b':2})
+        self.assertEqual(load_method['pickle'](dump_method['json+zlib']([3])), [3])
+
+    def test_queue_serializer(self):
+        """ 队列的序列化方式, 入队出队的结果不变 """
+        model.set_queue_serializer('sq', 'pickle2+zlib')
+        ztq_core.push_task('sq:f', u'中文', data='y' * 3000)
+        value = self.redis.hvals(model.get_task_hash('sq').name)[0]
+        self.assertEqual(value[:4], SERIALIZE_HEADER + 'pz')
+        task = ztq_core.pop_task('sq', timeout=-1)
+        self.assertEqual(task['args'], (u'中文',))
+        self.assertEqual(task['kw'], {'data':'y' * 3000})
@@ -0,0 +1,74 @@
+#coding:utf-8
+'''
+测试说明:
+队列分片: 按队列名选择system, 以及分布在多个system上的队列按任务标识路由
+'''
+import unittest
+import ztq_core
+from ztq_core import model
+from redis_case import RedisTestCase
+
+class TestShards(RedisTestCase):
+    systems = ('default', 's2', 's3')
+
+    def setUp(self):
+        RedisTestCase.setUp(self)
+        ztq_core.setup_shards(list(self.systems))
+
+    def test_queue_routing(self):
+        """ 同一个队列名总是同一个system, 分片key相同的队列在一起 """
+        systems = set(model.get_queue_system('q%d' % i) for i in range(50))
+        self.assertEqual(systems, set(self.systems))
+        self.assertEqual(model.get_queue_system('q1'), model.get_queue_system('q1'))
+        model.set_queue_shard_key('q2', 'q1')
+        self.assertEqual(model.get_queue_system('q2'), model.get_queue_system('q1'))
+
+    def test_distributed_queue(self):
+        ztq_core.set_queue_shards('hot', list(self.systems))
+        ztq_core.push_tasks('hot:f', [((i,), {}) for i in range(60)])
+        lengths = [len(queue) for queue in model.get_task_queues('hot')]
+        self.assertEqual(sum(lengths), 60)
+        self.assertTrue(all(lengths))
+        self.assertEqual(ztq_core.has_task('hot', ztq_core.gen_task('f', 5)), 'queue')
+
+        got = set()
+        while True:
+            task = ztq_core.pop_task('hot', timeout=-1)
+            if task is None: break
+            got.add(task['args'][0])
+        self.assertEqual(got, set(range(60)))
+
+    def test_server_ids(self):
+        """ 服务端生成的id不会在不同的system上重复, 并且能按id找到所在的system """
+        ztq_core.set_queue_shards('hot', list(self.systems))
+        ztq_core.set_queue_identity('hot', 'server')
+        for i in range(30):
+            ztq_core.push_task('hot:f', i)
+
+        ids = set()
+        for system in self.systems:
+            for task_md5 in model.get_task_queue('hot', system):
+                self.assertEqual(model.get_queue_system('hot', task_md5), system)
+                ids.add(task_md5)
+        self.assertEqual(len(ids), 30)
+
+        # 可靠模式确认时, 从任务所在的system上删除
+        consumer = 'w:1'
+        claimed = [ztq_core.claim_task('hot', consumer, timeout=-1) for i in range(30)]
+        for task_md5, task in claimed:
+            self.assertTrue(ztq_core.ack_task('hot', task_md5, consumer))
+        for system in self.systems:
+            self.assertEqual(len(model.get_task_hash('hot', system)), 0)
+            self.assertEqual(len(model.get_processing_queue('hot', consumer, system)), 0)
+
+    def test_server_id_delayed(self):
+        ztq_core.set_queue_shards('hot', list(self.systems))
+        ztq_core.set_queue_identity('hot', 'server')
+        for i in range(10):
+            ztq_core.push_task('hot:f', i, ztq_countdown=60)
+        for system in self.systems:
+            for task_md5 in model.get_delayed_set('hot', system):
+                self.assertEqual(model.get_queue_system('hot', task_md5), system)
+
+if __name__ == '__main__':
+    unittest.main()
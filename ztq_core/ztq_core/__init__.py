@@ -4,6 +4,7 @@ from redis_wrap import (
         get_list, 
         get_hash, 
         get_set, 
+        get_sorted_set, 
         setup_redis, 
         setup_sentinel,
         get_key, 
@@ -13,18 +14,55 @@ from redis_wrap import (
         ConnectionError,
         ResponseError,
         set_default_sentinel,
+        write_batch,
+        get_blocking_redis,
+        set_pool_options,
+        read_pool_options,
+        get_pool_stats,
+        setup_replica,
+        read_from_replica,
+        get_read_redis,
+        setup_shards,
+        get_shard,
+        get_shard_systems,
+        set_cache_ttl,
+        invalidate_cache,
+        start_cache_listener,
     )
 
 from task import (
         task_registry, 
         register, 
         push_task, 
+        push_tasks, 
         has_task, 
+        set_task_priority,
+        get_queue_length,
         pop_task,
+        pop_any_task,
+        pop_tasks,
+        requeue_tasks,
         pop_error,
+        claim_task,
+        ack_task,
+        requeue_dead_consumers,
         push_runtime_error,
         gen_task, 
-        push_runtime_task
+        split_queue_names,
+        get_task_id,
+        set_queue_identity,
+        order_queue_names,
+        push_runtime_task,
+        push_buffer_task,
+        signal_buffer,
+        wait_buffer_signal,
+        promote_buffer,
+        promote_delayed,
+        retry_task,
+        redo_errors,
+        wait_delayed_signal,
+        acquire_capacity,
+        release_capacity,
     )
 
 from model import *
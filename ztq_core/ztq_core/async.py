@@ -1,7 +1,7 @@
 # -*- encoding:utf-8 -*-
 
 import types
-from task import register, push_task, has_task, gen_task, push_buffer_task
+from task import register, push_task, push_tasks, has_task, gen_task, push_buffer_task
 import transaction
 import redis_wrap
 
@@ -42,6 +42,41 @@ def push_task_to_queue(task_name, args, kw, on_commit=False, buffer=False):
         else:
             push_task(task_name, *args, **kw)
 
+def _setup_key(kw, key_func, args):
+    """ 用async(key=...)指定的方法, 根据参数生成去重的key """
+    if key_func is None or 'ztq_key' in kw: return
+    task_kw = dict((name, value) for name, value in kw.iteritems() 
+                        if not name.startswith('ztq_'))
+    kw['ztq_key'] = key_func(*args, **task_kw)
+
+def _setup_map(new_func, func, default_queue, key_func=None):
+    """ 为async装饰后的方法添加批量加入队列的方法::
+
+        say_hello.map(['a', 'b', 'c'])
+        say_hello.starmap([('a', 1), ('b', 2)], ztq_queue='hello', ztq_chunk_size=1000)
+
+    返回每个任务是否新加入了队列的列表, 事务模式下在提交后才加入, 返回None
+    """
+    def starmap(iterable, **kw):
+        redis_wrap.random_hash_key()
+        on_commit= kw.pop('ztq_transaction', use_transaction) 
+        queue_name = kw.pop('ztq_queue', default_queue)
+        task_name = "%s:%s" % (queue_name, func.__name__)
+        _setup_callback(kw)
+        tasks = ((tuple(args), {}) for args in iterable)
+        if key_func is not None:
+            tasks = ((args, {'ztq_key':key_func(*args)}) for args, task_kw in tasks)
+        if on_commit:
+            add_after_commit_hook(push_tasks, (task_name, list(tasks)), kw)
+        else:
+            return push_tasks(task_name, tasks, **kw)
+
+    def _map(iterable, **kw):
+        return starmap(((item,) for item in iterable), **kw)
+
+    new_func.map = _map
+    new_func.starmap = starmap
+
 def async(*_args, **_kw):
     """ 这是一个decorator，事务提交的时候，提交到job队列，异步执行 
 
@@ -59,12 +94,47 @@ def async(*_args, **_kw):
         def say_hello(name):
             print 'hello, ', name
 
+    key 是一个方法, 根据任务的参数生成去重的key, 同一个key的任务在队列中只有一个,
+    也可以在调用时用 ztq_key 直接指定::
+
+        @async(queue='index', key=lambda doc_id, **kw: doc_id)
+        def index(doc_id, title=''):
+            ...
+
+    green=True 表示这个任务可以在协程中运行(worker 的 runtime = gevent 时),
+    否则 gevent 方式下会放到线程池中执行::
+
+        @async(queue='urlopen', green=True)
+        def fetch(url):
+            urllib2.urlopen(url)
+
+    batch=True 表示这个任务可以批量执行, worker 一次取出多个任务, 用 [(args, kw), ...] 调用,
+    返回None表示全部成功, 或者返回一一对应的列表, 其中的异常对象表示这个任务失败了,
+    一次最多的个数和等待时间见 ztq_worker.register_batch_queue::
+
+        @async(queue='index', batch=True)
+        def index(items):
+            for args, kw in items:
+                add_document(*args, **kw)
+            commit()
+
+        index(doc)  # 和一般的任务一样加入队列
+
+    retry 表示出错后自动重试, 可以是最多重试的次数, 或者重试策略, 会覆盖worker中队列的重试策略,
+    见 ztq_worker.register_retry_queue::
+
+        @async(queue='mail', retry={'max_retries':5, 'countdown':2, 'retry_on':(IOError,)})
+        def send(to, body):
+            ...
+
     使用方法
     ================
     支持如下几种::
 
         say_hello('asdfa')
         say_hello('asdfa', ztq_queue="asdfa", ztq_transaction=False)
+        say_hello('asdfa', ztq_countdown=60)    # 60秒后执行, 也可以用 ztq_eta 指定时间戳
+        say_hello('asdfa', ztq_priority=2)      # 队列设置了优先级个数时, 指定优先级
 
     """
     if len(_args) == 1 and not _kw and isinstance(_args[0], types.FunctionType): # 不带参数的形式
@@ -82,10 +152,15 @@ def async(*_args, **_kw):
 
         new_func1.__raw__ = func
         new_func1._ztq_queue = 'default'
+        _setup_map(new_func1, func, 'default')
         register(func)
         return new_func1
     else:
         _queue_name = _kw.get('queue', 'default')
+        _green = _kw.get('green', False)
+        _batch = _kw.get('batch', False)
+        _key_func = _kw.get('key', None)
+        _retry = _kw.get('retry', None)
         def _async(func):
             def new_func(*args, **kw):
                 # 每次被async装饰的方法执行时，都生成一个随机key
@@ -96,11 +171,17 @@ def async(*_args, **_kw):
                 queue_name = kw.pop('ztq_queue', _queue_name)
                 buffer = kw.pop('ztq_buffer', False)
                 task_name = "%s:%s" % (queue_name, func.__name__)
+                _setup_key(kw, _key_func, args)
                 _setup_callback(kw)
                 push_task_to_queue(task_name, args, kw, on_commit=on_commit, buffer=buffer)
 
             new_func.__raw__ = func
             new_func._ztq_queue = _queue_name
+            new_func._ztq_key_func = _key_func
+            _setup_map(new_func, func, _queue_name, _key_func)
+            if _green: func._ztq_green = True
+            if _batch: func._ztq_batch = True
+            if _retry is not None: func._ztq_retry = _retry
             register(func)
             return new_func
         return _async
@@ -114,6 +195,7 @@ def ping_task(func, *args, **kw):
     to_front = kw.pop('ztq_first', False)
     on_commit = kw.pop('ztq_transaction', None)
     run = kw.pop('ztq_run', False)
+    _setup_key(kw, getattr(func, '_ztq_key_func', None), args)
     task = gen_task(func.__raw__.__name__, *args, **kw)
     result = has_task(queue_name, task, to_front=to_front)
     if result == 'none' and run:
@@ -1,87 +1,356 @@
 #coding:utf-8
 
-""" 有一个定时执行的list: ztq:list:cron
+""" 定时任务
 
-放进去的工作，会定期自动执行
+定时任务保存在 ztq:hash:cron 中, 下次执行的时间放在有序集合 ztq:zset:cron 中,
+定时线程一直睡眠到最早的执行时间, 加入了更早执行的任务时由信号唤醒, 没有到期的任务不需要任何开销。
+
+cron_info 可以是:
+
+- 标准的cron表达式: '分 时 日 月 星期', 比如 '*/5 9-18 * * mon-fri', 以及 '@daily' 等
+- 间隔秒数: 300, 或者 {'interval': 300}
+- 旧的格式: {'minute':3, 'hour':3}, 没有hour表示每小时
+
+多个进程同时运行定时线程也没有关系, 每次执行前用脚本比较并修改下次执行的时间,
+只有一个进程能取得这一次执行, 放入相关的队列
 """
 from threading import Thread
 import datetime
 import time
+import logging
+from hashlib import md5
 import model
+from redis_wrap import dump_method, register_script, get_blocking_redis, \
+        ConnectionError, ResponseError
 from task import split_full_func_name, push_task
 
+logger = logging.getLogger("ztq_core")
 
-def has_cron(func):
-    if type(func) == str:
-        func_name = func
+# cron表达式各个字段的取值范围
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+CRON_NAMES = (
+        {},
+        {},
+        {},
+        dict((name, index + 1) for index, name in enumerate(
+            ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+             'jul', 'aug', 'sep', 'oct', 'nov', 'dec'))),
+        dict((name, index) for index, name in enumerate(
+            ('sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'))),
+        )
+
+CRON_ALIASES = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+        }
+
+# 找下次执行时间时最多往后找几年, 比如 2月29日 最多要找8年
+CRON_MAX_YEARS = 9
+
+def _parse_value(value, names):
+    value = value.lower()
+    if value in names: return names[value]
+    return int(value)
+
+def _parse_field(field, index):
+    """ 解析cron表达式的一个字段, 返回取值的集合 """
+    low, high = CRON_FIELDS[index]
+    names = CRON_NAMES[index]
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            step = int(step)
+            if step < 1: raise ValueError('invalid cron step: %s' % field)
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [_parse_value(value, names) for value in part.split('-', 1)]
+        else:
+            start = _parse_value(part, names)
+            # a/n 表示从a开始到最大值
+            end = high if step > 1 else start
+        # 星期的7也表示星期天
+        if start > end or start < low or end > (7 if index == 4 else high):
+            raise ValueError('invalid cron field: %s' % field)
+        values.update(value % 7 if index == 4 else value
+                        for value in range(start, end + 1, step))
+    return frozenset(values)
+
+def parse_cron(expression):
+    """ 解析cron表达式: '分 时 日 月 星期'
+
+    返回 (分, 时, 日, 月, 星期) 各自取值的集合, 以及日和星期是否限制了:
+    两个都限制了的时候, 满足其中一个就可以, 和标准的cron一样
+    """
+    expression = CRON_ALIASES.get(expression.strip().lower(), expression)
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError('cron expression needs 5 fields: %s' % expression)
+    values = tuple(_parse_field(field, index) for index, field in enumerate(fields))
+    return values + (not fields[2].startswith('*'), not fields[4].startswith('*'))
+
+def _legacy_expression(cron_info):
+    """ 旧的 {'minute':3, 'hour':3} 格式转换为cron表达式 """
+    hour = int(cron_info.get('hour', -1))
+    return '%d %s %s %s %s' % (int(cron_info.get('minute', 0)),
+            '*' if hour == -1 else hour,
+            cron_info.get('day', '*'), cron_info.get('month', '*'), cron_info.get('weekday', '*'))
+
+def get_cron_interval(cron_info):
+    """ 间隔执行的定时任务返回间隔秒数, 否则返回None """
+    if isinstance(cron_info, (int, long, float)):
+        interval = cron_info
+    elif isinstance(cron_info, dict) and 'interval' in cron_info:
+        interval = cron_info['interval']
     else:
-        func_name = func.__raw__.__name__
-    for cron in model.get_cron_set():
-        if cron['func_name'] == func_name:
-            return True
-    return False
+        return None
+    if interval <= 0:
+        raise ValueError('cron interval must be positive: %s' % interval)
+    return interval
+
+def next_fire_time(cron_info, after):
+    """ 计算 after(时间戳) 之后下一次执行的时间戳, 按本地时间计算 """
+    interval = get_cron_interval(cron_info)
+    if interval is not None:
+        return after + interval
+
+    if isinstance(cron_info, dict):
+        cron_info = _legacy_expression(cron_info)
+    minutes, hours, days, months, weekdays, days_limited, weekdays_limited = \
+            parse_cron(cron_info)
+
+    def match_day(t):
+        in_days = t.day in days
+        in_weekdays = (t.weekday() + 1) % 7 in weekdays
+        if days_limited and weekdays_limited:
+            return in_days or in_weekdays
+        return in_days and in_weekdays
+
+    t = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0)
+    t += datetime.timedelta(minutes=1)
+    last_year = t.year + CRON_MAX_YEARS
+    while t.year <= last_year:
+        if t.month not in months:
+            # 下个月的第一天
+            if t.month == 12:
+                t = t.replace(year=t.year + 1, month=1, day=1, hour=0, minute=0)
+            else:
+                t = t.replace(month=t.month + 1, day=1, hour=0, minute=0)
+            continue
+        if not match_day(t):
+            t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            continue
+        later = [minute for minute in minutes if minute >= t.minute]
+        if not later:
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            continue
+        t = t.replace(minute=min(later))
+        return time.mktime(t.timetuple())
+    raise ValueError('cron expression never fires: %s' % cron_info)
+
+def _catch_up_time(cron_info, due, now):
+    """ 这次执行后的下次执行时间, 错过了多次的只补执行一次 """
+    interval = get_cron_interval(cron_info)
+    if interval is not None:
+        return due + interval * (int((now - due) // interval) + 1)
+    return next_fire_time(cron_info, max(due, now))
+
+# 加入定时任务, 已经存在的保留原来的执行时间; 比所有的都早执行时, 通知定时线程
+# KEYS[1]: 定时任务hash, KEYS[2]: 执行时间有序集合, KEYS[3]: 信号列表
+# ARGV[1]: cron_id, ARGV[2]: 序列化后的定时任务, ARGV[3]: 第一次执行的时间
+ADD_CRON_SCRIPT = register_script('ztq:add_cron', """
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+if redis.call('ZRANGE', KEYS[2], 0, 0)[1] == ARGV[1] then
+    redis.call('DEL', KEYS[3])
+    redis.call('LPUSH', KEYS[3], ARGV[3])
+end
+return 1
+""")
+
+# 取得一次执行: 执行时间还是读到的时间才改成下次执行的时间, 多个进程中只有一个能成功
+# KEYS[1]: 执行时间有序集合, KEYS[2]: 定时任务hash
+# ARGV[1]: cron_id, ARGV[2]: 读到的执行时间, ARGV[3]: 下次执行的时间
+# 返回定时任务, 没有取得时返回nil
+CLAIM_CRON_SCRIPT = register_script('ztq:claim_cron', """
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or tonumber(score) ~= tonumber(ARGV[2]) then
+    return nil
+end
+local cron = redis.call('HGET', KEYS[2], ARGV[1])
+if not cron then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    return nil
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return cron
+""")
+
+def _get_func_name(func):
+    if type(func) == str:
+        return func
+    return func.__raw__.__name__
+
+def _find_crons(func_name):
+    return [cron_id for cron_id, cron in model.get_cron_hash().items()
+                if cron['func_name'] == func_name]
+
+def has_cron(func):
+    return bool(_find_crons(_get_func_name(func)))
 
 def add_cron(cron_info, full_func, *args, **kw):
-    """ 定时执行 
+    """ 定时执行
 
-    cron_info： {'minute':3, 'hour':3,}
+    cron_info： '30 1 * * *', 300(间隔秒数) 或者 {'minute':3, 'hour':3,}
     """
-    cron_set = model.get_cron_set()
     if type(full_func) == str:
         queue_name, func_name = split_full_func_name(full_func)
     else:
         queue_name = full_func._ztq_queue
         func_name = full_func.__raw__.__name__
-    cron_set.add({'func_name':func_name, 
+    return _add_cron({'func_name':func_name,
                 'cron_info':cron_info,
                 'queue': queue_name,
                 'args':args,
                 'kw':kw})
 
+def _add_cron(cron):
+    """ 同样的定时任务只保存一个, 返回是否新加入了 """
+    cron_hash = model.get_cron_hash()
+    value = cron_hash.dumps(cron)
+    cron_id = md5(dump_method['json'](cron)).hexdigest()
+    # 表达式错误时在这里就抛出异常
+    first = next_fire_time(cron['cron_info'], time.time())
+    return bool(ADD_CRON_SCRIPT(
+            keys=(cron_hash.name, model.get_cron_index().name,
+                  model.get_cron_signal_queue().name),
+            args=(cron_id, value, repr(first))))
+
 def remove_cron(func):
+    cron_index = model.get_cron_index()
+    cron_hash = model.get_cron_hash()
+    for cron_id in _find_crons(_get_func_name(func)):
+        cron_index.remove(cron_id)
+        del cron_hash[cron_id]
+
+def _park_cron(cron_id, cron, error):
+    """ 无法执行的定时任务移到 model.get_invalid_cron_hash, 不再执行 """
+    logger.error('ERROR: invalid cron %s: %s' % (cron, error))
+    model.get_invalid_cron_hash()[cron_id] = dict(cron, error=str(error))
+    model.get_cron_index().remove(cron_id)
+    del model.get_cron_hash()[cron_id]
+
+def migrate_crons():
+    """ 把旧版本 ztq:set:cron 中的定时任务迁移过来, 返回迁移的个数
+
+    格式错误的移到 model.get_invalid_cron_hash, 不影响其他的
+    """
     cron_set = model.get_cron_set()
-    if type(func) == str:
-        func_name = func
-    else:
-        func_name = func.__raw__.__name__
-    for cron in cron_set:
-        if cron['func_name'] == func_name:
-            cron_set.remove(cron)
+    migrated = 0
+    for cron in list(cron_set):
+        try:
+            _add_cron(cron)
+            migrated += 1
+        except (ValueError, TypeError, KeyError), e:
+            cron_id = md5(dump_method['json'](cron)).hexdigest()
+            logger.error('ERROR: invalid cron %s: %s' % (cron, e))
+            model.get_invalid_cron_hash()[cron_id] = dict(cron, error=str(e)) \
+                    if isinstance(cron, dict) else {'cron':cron, 'error':str(e)}
+        cron_set.remove(cron)
+    return migrated
+
+# 每次处理的到期定时任务个数
+CRON_BATCH_SIZE = 100
+
+def fire_crons(batch_size=CRON_BATCH_SIZE):
+    """ 把到期的定时任务放入相关的队列, 返回 (执行的个数, 最早的下次执行时间) """
+    cron_index = model.get_cron_index()
+    cron_hash = model.get_cron_hash()
+    keys = (cron_index.name, cron_hash.name)
+    fired = 0
+    while True:
+        now = time.time()
+        due = cron_index.range_by_score('-inf', now, 0, batch_size, withscores=True)
+        if not due: break
+        for (cron_id, due_time), cron in zip(due,
+                cron_hash.get_many([cron_id for cron_id, due_time in due])):
+            if cron is None:
+                cron_index.remove(cron_id)
+                continue
+            try:
+                next_time = _catch_up_time(cron['cron_info'], due_time, now)
+            except (ValueError, TypeError, KeyError), e:
+                # 表达式错误, 再也不会执行了
+                _park_cron(cron_id, cron, e)
+                continue
+            if not CLAIM_CRON_SCRIPT(keys=keys, args=(cron_id, repr(due_time), repr(next_time))):
+                # 别的进程已经执行了
+                continue
+            try:
+                push_task(cron['queue'] + ':' + cron['func_name'], *cron['args'], **cron['kw'])
+            except (ConnectionError, ResponseError):
+                raise
+            except Exception, e:
+                # 这一次没有放入队列, 不影响其他的定时任务和下一次执行
+                logger.exception('ERROR: cron %s push error: %s' % (cron_id, e))
+                continue
+            fired += 1
+        if len(due) < batch_size: break
+
+    first = cron_index.first()
+    return fired, first[1] if first is not None else None
+
+# 没有定时任务时, 最多等待多久检查一次(秒), 防止信号丢失
+CRON_MAX_WAIT = 60
 
 class CronThread(Thread):
-    """ 定时检查cron列表，如果满足时间条件，放入相关的队列 """
-    def __init__(self):
+    """ 睡眠到最早的执行时间, 把到期的定时任务放入相关的队列 """
+    def __init__(self, max_wait=CRON_MAX_WAIT):
         super(CronThread, self).__init__()
+        self.max_wait = max_wait
 
     def run(self):
-        """
-            获取cron_info信息格式:{'minute':3, 'hour':3,}
-        """
-        cron_set = model.get_cron_set()
+        migrated = False
         while True:
-            # 遍历cron列表检查并检查定时执行信息
-            for cron in cron_set:
-                execute_flag = self.check_cron_info(cron['cron_info'])
-                if execute_flag:
-                    push_task(cron['queue'] + ':' + cron['func_name'], *cron['args'], **cron['kw'])
-
-            time.sleep(55)
-
-    def check_cron_info(self, cron_info):
-        """检查定时执行信息是否满足条件
-        """
-        time_now = datetime.datetime.now()
-        hour_cron = int(cron_info.get('hour', -1)) 
-        if hour_cron != -1:
-            hour_now = int(time_now.hour)
-            if hour_now != hour_cron:
-                return False
-
-        minute_cron = int(cron_info.get('minute', 0))
-        minute_now = int(time_now.minute)
-        if minute_cron != minute_now:
-            return False
-        return True
+            try:
+                if not migrated:
+                    migrate_crons()
+                    migrated = True
+                fired, next_time = fire_crons()
+                self.wait(next_time)
+            except (ConnectionError, ResponseError), e:
+                logger.error('ERROR: cron error: %s' % str(e))
+                time.sleep(3)
+            except Exception, e:
+                # 线程不能退出, 否则所有的定时任务都不再执行了
+                logger.exception('ERROR: cron error: %s' % str(e))
+                time.sleep(3)
+
+    def wait(self, next_time):
+        """ 等到 next_time, 或者收到信号 """
+        wait = self.max_wait
+        if next_time is not None:
+            wait = min(wait, next_time - time.time())
+        if wait <= 0: return
+        if wait < 1:
+            # 阻塞命令的超时只能是整数秒
+            time.sleep(wait)
+        else:
+            get_blocking_redis().brpop(model.get_cron_signal_queue().name, int(wait))
 
 def start_cron():
     cron_thread = CronThread()
@@ -1,31 +1,166 @@
 #coding:utf-8
+import time
+import random
 from redis_wrap import get_set, get_key, set_key, \
-get_queue, get_dict, get_keys, get_limit_queue, get_hash
+get_queue, get_dict, get_keys, get_limit_queue, get_hash, rebuild_registry, \
+HashRing, get_shard, get_shard_systems, get_cached, get_cached_dict, invalidate_cache, \
+get_sorted_set
+import copy
+
+# 序列化方式, 见 redis_wrap.register_serializer
+# 队列的任务hash和错误hash: queue_name -> serialized_type
+QUEUE_SERIALIZERS = {}
+# 工作日志和工作线程状态
+STATE_SERIALIZER = 'json'
+
+def set_queue_serializer(queue_name, serialized_type):
+    """ 设置队列的任务和错误信息的序列化方式, 比如 'msgpack+zlib'
+
+    读取时根据数据头解码, 所以写入方和读取方的配置不一样也没关系
+    """
+    QUEUE_SERIALIZERS[queue_name] = serialized_type
+
+# 队列的优先级个数: queue_name -> levels, 没有设置的队列只有一个级别
+QUEUE_PRIORITIES = {}
+
+def set_queue_priorities(queue_name, levels):
+    """ 设置队列的优先级个数, 每个优先级是一个单独的列表, 0 是默认的最低级别, levels - 1 最高
+
+    出队时用一个阻塞调用同时等待所有的级别, 总是先取高级别的任务;
+    加入任务的应用、worker和控制台的配置需要一致
+    """
+    levels = int(levels)
+    if levels < 1:
+        raise ValueError('priority levels must be at least 1: %s' % levels)
+    QUEUE_PRIORITIES[queue_name] = levels
+
+def get_queue_priorities(queue_name):
+    return QUEUE_PRIORITIES.get(queue_name, 1)
+
+def set_state_serializer(serialized_type):
+    """ 设置工作日志和工作线程状态的序列化方式 """
+    global STATE_SERIALIZER
+    STATE_SERIALIZER = serialized_type
+
+# 分片 -------------------------------------------------------------------
+# 队列的分片key, 分片key相同的队列在同一个system上: queue_name -> shard_key
+QUEUE_SHARD_KEYS = {}
+# 分布在多个system上的队列: queue_name -> HashRing
+QUEUE_SHARDS = {}
+
+def set_queue_shard_key(queue_name, shard_key):
+    """ 用shard_key代替队列名选择system, 用于让几个队列在同一个system上 """
+    QUEUE_SHARD_KEYS[queue_name] = shard_key
+
+def set_queue_shards(queue_name, systems):
+    """ 很忙的队列分布到多个system上, 按任务标识分配, 工作线程轮流从各个system取任务
+
+    任务的hash、错误、运行索引都和任务在同一个system上。
+    也可以用于迁移: 新的system放在前面, 老的system上的任务取完之后再去掉
+    """
+    QUEUE_SHARDS[queue_name] = HashRing(systems)
+
+def get_queue_systems(queue_name):
+    """ 队列分布的所有system, 第一个是队列的主system """
+    if queue_name in QUEUE_SHARDS:
+        return list(QUEUE_SHARDS[queue_name].nodes)
+    return [get_shard(QUEUE_SHARD_KEYS.get(queue_name, queue_name))]
+
+def get_queue_system(queue_name, task_md5=None):
+    """ 队列中一个任务所在的system
+
+    task_md5 为None时返回队列的主system, 为''(服务端生成id)时随机选择一个,
+    服务端生成的id带有所在的system, 见 get_task_id_suffix
+    """
+    ring = QUEUE_SHARDS.get(queue_name, None)
+    if ring is None:
+        return get_shard(QUEUE_SHARD_KEYS.get(queue_name, queue_name))
+    if task_md5 is None:
+        return ring.nodes[0]
+    if not task_md5:
+        return random.choice(ring.nodes)
+    if task_md5.startswith('#'):
+        number, _, system = task_md5[1:].partition('@')
+        if number.isdigit() and system in ring.nodes:
+            return system
+    return ring.get_node(task_md5)
+
+def get_task_id_suffix(queue_name, system):
+    """ 服务端生成id的后缀
+
+    每个system上的计数器是独立的, 分布在多个system上的队列, 生成的id是 #计数@system,
+    不会重复, 也能按id找到任务所在的system
+    """
+    if queue_name in QUEUE_SHARDS:
+        return '@' + system
+    return ''
+
+def get_all_systems():
+    """ 分片和分布队列用到的所有system """
+    systems = get_shard_systems()
+    for ring in QUEUE_SHARDS.values():
+        systems.extend(system for system in ring.nodes if system not in systems)
+    return systems
+
+# 队列的登记集合: (队列key的前缀, 登记集合), 加入任务时登记队列名, 不需要用KEYS查找
+QUEUE_REGISTRIES = (('ztq:queue:task:', 'ztq:set:queue:task'),
+                    ('ztq:queue:error:', 'ztq:set:queue:error'))
+
+# 高优先级的任务列表, 后面是 队列名:优先级, 登记为所属的任务队列
+PRIORITY_QUEUE_PREFIX = 'ztq:queue:priority:'
+
+def get_queue_registry(queue_key):
+    """ 返回 (登记集合, 队列名), 不需要登记的队列返回 (None, None) """
+    if queue_key.startswith(PRIORITY_QUEUE_PREFIX):
+        return QUEUE_REGISTRIES[0][1], queue_key[len(PRIORITY_QUEUE_PREFIX):].rsplit(':', 1)[0]
+    for prefix, registry in QUEUE_REGISTRIES:
+        if queue_key.startswith(prefix):
+            return registry, queue_key[len(prefix):]
+    return None, None
+
+def _get_registered_queues(prefix, registry):
+    queue_names = set()
+    for system in get_all_systems():
+        rebuild_registry(registry, prefix, system=system)
+        queue_names.update(get_set(registry, system=system, serialized_type='string'))
+    return list(queue_names)
 
 def get_all_task_queue():
-    """返回所有原子队列的key
+    """返回所有登记过的原子队列名
             返回类型:list
     """
-    task_queue = "ztq:queue:task:"
-    return get_keys(task_queue)
+    return _get_registered_queues(*QUEUE_REGISTRIES[0])
 
 def get_all_error_queue():
-    """返回所有原子队列的key
+    """返回所有登记过的错误队列名
             返回类型:list
     """
-    task_queue = "ztq:queue:error:"
-    return get_keys(task_queue)
+    return _get_registered_queues(*QUEUE_REGISTRIES[1])
 
-def get_task_hash(queue_name):
-    """ 得到 一个 task_md5 -> task 的字典对象 """
-    return get_hash('ztq:hash:task:' + queue_name)
+def get_task_hash(queue_name, system=None):
+    """ 得到 一个 task_md5 -> task 的字典对象
+
+    system 为None时是队列的主system, 分布在多个system上的队列见 get_queue_system
+    """
+    return get_hash('ztq:hash:task:' + queue_name, 
+            system=system or get_queue_system(queue_name),
+            serialized_type=QUEUE_SERIALIZERS.get(queue_name, 'json'))
+
+def get_running_hash(queue_name, system=None):
+    """ 正在运行的任务索引: task_md5 -> [worker, thread], 任务开始、结束时更新 """
+    return get_hash('ztq:hash:running:' + queue_name, 
+            system=system or get_queue_system(queue_name))
+
+def get_task_id_key():
+    """ 服务端生成任务id的计数器, 见 task.set_queue_identity """
+    return 'ztq:id:task'
 
 def get_task_set(queue_name, serialized_type='json'):
     """ 得到 一个 task_md5 -> task 的字典对象 """
     return get_set('ztq:set:task:' + queue_name, serialized_type=serialized_type)
 
-def get_task_queue(queue_name):
-    """根据传入参数queue_name
+def get_task_queue(queue_name, system=None, priority=0):
+    """根据传入参数queue_name, priority 是优先级(见 set_queue_priorities), 0 是默认的任务队列
 
     {"func":'transform',
      'args':(),
@@ -62,7 +197,29 @@ def get_task_queue(queue_name):
     """
     #ListFu
     atom_queue = "ztq:queue:task:" + queue_name
-    return get_queue(atom_queue, serialized_type='string')
+    if priority:
+        atom_queue = '%s%s:%d' % (PRIORITY_QUEUE_PREFIX, queue_name, priority)
+    return get_queue(atom_queue, system=system or get_queue_system(queue_name), 
+            serialized_type='string')
+
+def get_task_queues(queue_name):
+    """ 队列在所有system上、所有优先级的任务队列, 用于统计 """
+    levels = range(get_queue_priorities(queue_name) - 1, -1, -1)
+    return [get_task_queue(queue_name, system, priority) 
+                for system in get_queue_systems(queue_name) for priority in levels]
+
+# 优先级hash中记录过期位置个数的字段, 不会和task_md5重复
+PRIORITY_STALE_FIELD = 'ztq:stale'
+
+def get_priority_hash(queue_name, system=None):
+    """ 任务当前的优先级: task_md5 -> 优先级, 没有的是0
+
+    调整优先级时把task_md5放到新的列表, 修改这里的优先级, 原来列表中的就过期了, 出队时跳过;
+    '-1' 表示可靠模式下正在处理, 不能调整;
+    PRIORITY_STALE_FIELD 是各个列表中过期位置的个数, 用于计算队列的实际长度
+    """
+    return get_hash('ztq:hash:priority:' + queue_name, 
+            system=system or get_queue_system(queue_name), serialized_type='string')
 
 def get_command_queue(name):
     """ 同步配置、状态报告、杀死转换线程
@@ -120,22 +277,63 @@ def get_work_log_queue():
       }
     """
     work__log_queue = "ztq:queue:worker_log"
-    return get_limit_queue(work__log_queue, 200)
+    return get_limit_queue(work__log_queue, 200, serialized_type=STATE_SERIALIZER)
 
-def get_error_hash(queue_name, system='default'):
+def get_error_hash(queue_name, system=None):
     """ json格式和work_log相同 """
     error_queue = 'ztq:hash:error:' + queue_name
-    return get_hash(error_queue, system=system)
+    return get_hash(error_queue, system=system or get_queue_system(queue_name), 
+            serialized_type=QUEUE_SERIALIZERS.get(queue_name, 'json'))
 
-def get_error_queue(queue_name, system='default'):
+def get_error_queue(queue_name, system=None):
     """ json格式和work_log相同 """
     error_queue = 'ztq:queue:error:' + queue_name
-    return get_queue(error_queue, system=system, serialized_type='string')
+    return get_queue(error_queue, system=system or get_queue_system(queue_name), 
+            serialized_type='string')
 
-def get_buffer_queue(queue_name, system='default'):
-    """ json格式和work_log相同 """
+def get_error_queues(queue_name):
+    """ 队列在所有system上的错误队列 """
+    return [get_error_queue(queue_name, system) for system in get_queue_systems(queue_name)]
+
+def get_buffer_queue(queue_name, system=None):
+    """ buffer中的task_md5列表, 老的数据是task(json格式和work_log相同) """
     buffer_queue = 'ztq:queue:buffer:' + queue_name
-    return get_queue(buffer_queue, system=system)
+    return get_queue(buffer_queue, system=system or get_queue_system(queue_name))
+
+def get_buffer_hash(queue_name, system=None):
+    """ buffer中的 task_md5 -> task """
+    return get_hash('ztq:hash:buffer:' + queue_name, 
+            system=system or get_queue_system(queue_name),
+            serialized_type=QUEUE_SERIALIZERS.get(queue_name, 'json'))
+
+def get_buffer_signal_queue(queue_name, system=None):
+    """ 通知管理这个buffer队列的buffer线程的信号列表, 最多一个信号 """
+    return get_queue('ztq:queue:signal:buffer:' + queue_name, 
+            system=system or get_queue_system(queue_name), serialized_type='string')
+
+def get_delayed_hash(queue_name, system=None):
+    """ 延时任务的 task_md5 -> task """
+    return get_hash('ztq:hash:delayed:' + queue_name, 
+            system=system or get_queue_system(queue_name),
+            serialized_type=QUEUE_SERIALIZERS.get(queue_name, 'json'))
+
+def get_delayed_priority_hash(queue_name, system=None):
+    """ 延时任务到期后放入的优先级: task_md5 -> 优先级, 没有的是0 """
+    return get_hash('ztq:hash:delayed_priority:' + queue_name, 
+            system=system or get_queue_system(queue_name), serialized_type='string')
+
+def get_delayed_set(queue_name, system=None):
+    """ 延时任务的 task_md5, score 是到期时间 """
+    return get_sorted_set('ztq:zset:delayed:' + queue_name, 
+            system=system or get_queue_system(queue_name), serialized_type='string')
+
+def get_delayed_index(system='default'):
+    """ 这个system上有延时任务的队列名, score 是队列中最早的到期时间 """
+    return get_sorted_set('ztq:zset:delayed', system=system, serialized_type='string')
+
+def get_delayed_signal_queue(system='default'):
+    """ 加入了比所有延时任务都早到期的任务时, 通知延时任务线程, 最多一个信号 """
+    return get_queue('ztq:queue:signal:delayed', system=system, serialized_type='string')
 
 def get_system_log_queue():
     """
@@ -158,8 +356,7 @@ def get_all_worker():
     """返回正在运行中的转换器列表
             返回类似:list
     """
-    prefix = 'ztq:state:worker:'
-    return get_keys(prefix)
+    return get_worker_state().keys()
 
 def get_worker_state():
     """ transformer在如下2种状况下会，会由指令线程上报转换器的状态::
@@ -181,7 +378,21 @@ def get_worker_state():
         转换器状态信息，主要用于监控转换器是否良性工作，会在监控界面中显示。
     """
     prefix = 'ztq:state:worker:'
-    return get_dict(prefix)
+    registry = 'ztq:set:worker'
+    rebuild_registry(registry, prefix)
+    return get_dict(prefix, registry=registry)
+
+# 工作线程状态放在hash中时hash的过期时间(秒), None 表示每个线程一个key, 见 use_job_state_hash
+JOB_STATE_EXPIRE = None
+
+def use_job_state_hash(expire=24*3600):
+    """ 一个worker的工作线程状态都放到一个hash中: ztq:hash:job:<worker>
+
+    每次写入都刷新过期时间, worker异常退出后状态会自动清除,
+    过期时间需要大于最长的任务执行时间。worker和控制台需要使用相同的方式
+    """
+    global JOB_STATE_EXPIRE
+    JOB_STATE_EXPIRE = expire
 
 def get_job_state(worker_job_name):
     """ 转换器w01，第0号转换线程的当前转换任务信息
@@ -203,8 +414,54 @@ def get_job_state(worker_job_name):
          }
       }
     """
+    if JOB_STATE_EXPIRE:
+        return get_hash('ztq:hash:job:%s' % worker_job_name, 
+                serialized_type=STATE_SERIALIZER, expire=JOB_STATE_EXPIRE)
     prefix = 'ztq:state:job:%s:' % worker_job_name
-    return get_dict(prefix)
+    return get_dict(prefix, serialized_type=STATE_SERIALIZER, 
+            registry='ztq:set:job:%s' % worker_job_name)
+
+def get_prefetch_state(worker_name):
+    """ 工作线程预取了还没有执行的任务: 线程名 -> {'queue':队列名, 'tasks':[task, ...]}
+
+    worker异常退出后, 重新启动时放回队列
+    """
+    return get_hash('ztq:hash:prefetch:%s' % worker_name, serialized_type=STATE_SERIALIZER)
+
+def get_processing_queue(queue_name, consumer, system=None):
+    """ 可靠队列模式下, 某个worker进程(consumer)已经取出、还没有完成的task_md5列表
+
+    consumer 是worker进程的唯一标识, 格式为 别名:进程号
+    """
+    processing_queue = 'ztq:queue:processing:%s:%s' % (queue_name, consumer)
+    return get_queue(processing_queue, system=system or get_queue_system(queue_name), 
+            serialized_type='string')
+
+def get_processing_set(system='default'):
+    """ 登记这个system上所有的处理中列表, 成员格式为 [queue_name, consumer] """
+    return get_set('ztq:set:processing', system=system)
+
+def get_heartbeat_key(consumer):
+    """ worker进程的心跳, 带过期时间, 过期表示这个进程已经不存在了 """
+    return 'ztq:heartbeat:' + consumer
+
+def set_heartbeat(consumer, expire):
+    set_key(get_heartbeat_key(consumer), int(time.time()), expire=expire)
+
+def get_rate_bucket_key(queue_name):
+    """ 队列限速的令牌桶, hash的 tokens: 剩余令牌数, ts: 上次取令牌的时间
+
+    限流对所有worker有效, 总是在default上, 不随队列分片
+    """
+    return 'ztq:hash:ratelimit:' + queue_name
+
+def get_semaphore_set(queue_name):
+    """ 队列限制并发数的信号量, 成员是持有者(worker进程:线程名), score 是租约到期时间 """
+    return get_sorted_set('ztq:zset:semaphore:' + queue_name, serialized_type='string')
+
+def get_semaphore_signal_queue(queue_name):
+    """ 释放信号量时通知等待的工作线程, 最多和并发数一样多的信号 """
+    return get_queue('ztq:queue:signal:semaphore:' + queue_name, serialized_type='string')
 
 # config -------------------------------------------------------------------
 def get_dispatcher_config():
@@ -219,20 +476,53 @@ def get_dispatcher_config():
      }
     """
     prefix = 'ztq:config:dispatcher'
-    return get_key(prefix)
+    # 读本地缓存, 返回复本, 修改后需要调用 set_dispatcher_config
+    return copy.deepcopy(get_cached(prefix, lambda: get_key(prefix)))
 
 def set_dispatcher_config(value):
     prefix = 'ztq:config:dispatcher'
-    return set_key(prefix, value)
+    result = set_key(prefix, value)
+    invalidate_cache(prefix)
+    return result
 
 def get_queue_config():
     """记录queue的基本信息
     {'title':'sys_cron-0',  #可选
     'tags':(['sys_cron']),  #可选
-    'weight':5}             #可选
+    'weight':5,             #可选
+    'rate_limit':50,        #可选, 所有worker每秒最多执行的任务数
+    'rate_burst':50,        #可选, 令牌桶的容量, 默认和 rate_limit 一样(至少1个)
+    'concurrency':8,        #可选, 所有worker最多同时执行的任务数
+    'concurrency_lease':600}#可选, 并发数的租约秒数, worker崩溃后过期释放
     """
     prefix = 'ztq:config:queue:'
-    return get_dict(prefix)
+    return get_cached_dict(prefix)
+
+# 队列限流的配置项
+QUEUE_LIMIT_NAMES = ('rate_limit', 'rate_burst', 'concurrency', 'concurrency_lease')
+
+def set_queue_limits(queue_name, rate_limit=None, rate_burst=None, 
+                     concurrency=None, concurrency_lease=None):
+    """ 设置队列的限流, 保存在队列配置中, 值为None表示不限制
+
+    rate_limit: 所有worker每秒最多执行的任务数(令牌桶)
+    concurrency: 所有worker最多同时执行的任务数(分布式信号量)
+    """
+    queue_config = get_queue_config()
+    config = queue_config.get(queue_name, {}) or {'name':queue_name, 'title':queue_name}
+    for name, value in zip(QUEUE_LIMIT_NAMES, 
+            (rate_limit, rate_burst, concurrency, concurrency_lease)):
+        if value is None:
+            config.pop(name, None)
+        else:
+            config[name] = value
+    queue_config[queue_name] = config
+
+def get_queue_limits(queue_name):
+    """ 队列的限流配置, 没有限流时返回空字典, 读本地缓存 """
+    config = get_queue_config().get(queue_name, {}) or {}
+    return dict((name, config[name]) for name in QUEUE_LIMIT_NAMES 
+                    if config.get(name, None) is not None)
 
 def get_worker_config():
     """ 配置工作线程：处理哪些队列，几个线程，间隔时间::
@@ -243,7 +533,7 @@ def get_worker_config():
     }
     """
     prefix = 'ztq:config:worker:'
-    return get_dict(prefix)
+    return get_cached_dict(prefix)
 
 def get_driver_config():
     """
@@ -253,8 +543,24 @@ def get_driver_config():
     return get_dict(prefix)
 
 def get_cron_set():
-    """ 定时任务list
-    TODO
-    """
+    """ 旧版本的定时任务集合, 启动定时线程时迁移到 get_cron_hash """
     return get_set('ztq:set:cron')
+
+def get_cron_hash():
+    """ 定时任务 cron_id -> {'func_name':, 'cron_info':, 'queue':, 'args':, 'kw':} """
+    return get_hash('ztq:hash:cron')
+
+def get_invalid_cron_hash():
+    """ 无法执行的定时任务(比如表达式错误), 从定时任务中移出来, 保留下来便于排查
+    cron_id -> 定时任务, 加上 'error': 错误信息
+    """
+    return get_hash('ztq:hash:cron:invalid')
+
+def get_cron_index():
+    """ 定时任务的 cron_id, score 是下次执行的时间 """
+    return get_sorted_set('ztq:zset:cron', serialized_type='string')
+
+def get_cron_signal_queue():
+    """ 加入了比所有定时任务都早执行的任务时, 通知定时线程, 最多一个信号 """
+    return get_queue('ztq:queue:signal:cron', serialized_type='string')
   
@@ -1,8 +1,17 @@
 #coding:utf-8
 
 import redis
-from redis.sentinel import Sentinel
+from redis.sentinel import Sentinel, SentinelConnectionPool
 import pickle
+import copy
+import time
+import zlib
+import threading
+import struct
+import bisect
+from hashlib import sha1, md5
+from contextlib import contextmanager
+from itertools import islice
 try:
     import json
 except :
@@ -12,6 +21,7 @@ import UserDict, UserList
 
 ConnectionError = redis.exceptions.ConnectionError
 ResponseError = redis.exceptions.ResponseError
+NoScriptError = redis.exceptions.NoScriptError
 
 # 是否使用sentinel
 USE_SENTINEL = False
@@ -21,6 +31,10 @@ DEFAULT_SENTINEL_NAME = None
 DEFAULT_ENCODING = 'UTF-8' # sys.getdefaultencoding()
 #--- System related ----------------------------------------------
 SYSTEMS = {}
+# 阻塞命令(BRPOP等)使用的客户端, 使用单独的连接池, 没有读超时
+BLOCKING_SYSTEMS = {}
+# 不使用sentinel时, 用于只读查询的从库客户端, 见 setup_replica
+REPLICA_SYSTEMS = {}
 # 当前 hash key
 CURRENT_HASH_KEY = 0
 
@@ -32,16 +46,146 @@ class UnknownSystemError(Exception):
     def __repr__(self):
         return repr('Unknown system name: %s' % self.name)
 
+#--- Connection pools ----------------------------------------------
+# 连接池的默认配置, 见 set_pool_options
+POOL_OPTIONS = {
+        'max_connections': None,
+        'pool_timeout': None,
+        'blocking_max_connections': None,
+        'health_check_interval': 0,
+        'socket_keepalive': True,
+        }
+
+def set_pool_options(**options):
+    """ 设置之后 setup_redis/setup_sentinel 创建的连接池的默认配置
+
+    max_connections: 最大连接数, None 表示不限制
+    pool_timeout: 不为None并且限制了最大连接数时使用阻塞的连接池, 连接用完后最多等待的秒数, 超时抛出ConnectionError
+    blocking_max_connections: 阻塞命令(BRPOP等)连接池的最大连接数, 每个工作线程占用一个, None 表示不限制
+    health_check_interval: 连接空闲这么多秒之后, 使用前先PING检查, 0 表示不检查
+    socket_keepalive: 是否打开TCP keepalive, 尽快发现切换后失效的连接
+    """
+    for key in options:
+        if key not in POOL_OPTIONS:
+            raise TypeError('unknown pool option: %s' % key)
+    POOL_OPTIONS.update(options)
+
+def read_pool_options(settings):
+    """ 从 worker.ini/app.ini 的配置中读取连接池的配置, 空的配置项忽略 """
+    options = {}
+    for key, convert in (('max_connections', int), ('pool_timeout', float),
+                         ('blocking_max_connections', int), ('health_check_interval', int)):
+        value = (settings.get(key, '') or '').strip()
+        if value:
+            options[key] = convert(value)
+    return options
+
+class PoolStatsMixin(object):
+    """ 统计连接池的使用情况: 借出的连接数, 取得连接的等待时间 """
+
+    def __init__(self, *args, **kw):
+        super(PoolStatsMixin, self).__init__(*args, **kw)
+        self._stats_lock = threading.Lock()
+        self.stats = {'checked_out':0, 'max_checked_out':0, 'gets':0, 
+                      'wait_total':0.0, 'wait_max':0.0}
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        connection = super(PoolStatsMixin, self).get_connection(command_name, *keys, **options)
+        wait = time.time() - start
+        with self._stats_lock:
+            stats = self.stats
+            stats['gets'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+            stats['checked_out'] += 1
+            stats['max_checked_out'] = max(stats['max_checked_out'], stats['checked_out'])
+        return connection
+
+    def release(self, connection):
+        super(PoolStatsMixin, self).release(connection)
+        with self._stats_lock:
+            self.stats['checked_out'] -= 1
+
+class StatsConnectionPool(PoolStatsMixin, redis.ConnectionPool): pass
+class StatsBlockingConnectionPool(PoolStatsMixin, redis.BlockingConnectionPool): pass
+class StatsSentinelConnectionPool(PoolStatsMixin, SentinelConnectionPool): pass
+
+def _connection_kw(options, kw):
+    """ 连接的参数 """
+    kw = dict(kw)
+    kw.setdefault('socket_keepalive', options['socket_keepalive'])
+    # redis-py 3.3 之后才支持
+    if options['health_check_interval']:
+        kw['health_check_interval'] = options['health_check_interval']
+    if 'unix_socket_path' in kw:
+        kw['path'] = kw.pop('unix_socket_path')
+        kw['connection_class'] = redis.UnixDomainSocketConnection
+        kw.pop('host', None); kw.pop('port', None)
+        kw.pop('socket_keepalive', None)
+    return kw
+
+def _make_pool(max_connections, pool_timeout, **kw):
+    # 没有限制最大连接数时不会用完, 不需要阻塞的连接池;
+    # 阻塞命令的连接被工作线程一直占用, 限制了数量会让多出的线程等待超时
+    if pool_timeout is not None and max_connections:
+        return StatsBlockingConnectionPool(max_connections=max_connections, 
+                timeout=pool_timeout, **kw)
+    return StatsConnectionPool(max_connections=max_connections, **kw)
+
 def setup_redis(name, host, port, db = 0, **kw):
+    """ kw 是连接的参数(比如socket_timeout), 也可以是 set_pool_options 中的配置
+
+    阻塞命令使用单独的连接池, 不使用socket_timeout
+    """
     # 若使用该方法启动队列服务
     # 则默认禁用 sentinel
     global USE_SENTINEL
 
     if USE_SENTINEL == True:
         SYSTEMS.clear()
+        BLOCKING_SYSTEMS.clear()
         USE_SENTINEL = False
-
-    SYSTEMS[name] = redis.Redis(host=host, port=port, db=db, **kw)
+    # 换了主库, 原来的从库和缓存也不能用了
+    REPLICA_SYSTEMS.pop(name, None)
+    _CACHE.invalidate(name)
+
+    options = dict(POOL_OPTIONS)
+    for key in POOL_OPTIONS:
+        if key in kw: options[key] = kw.pop(key)
+    kw = _connection_kw(options, dict(kw, host=host, port=port, db=db))
+
+    SYSTEMS[name] = redis.Redis(connection_pool=_make_pool(
+            options['max_connections'], options['pool_timeout'], **kw))
+    kw.pop('socket_timeout', None)
+    BLOCKING_SYSTEMS[name] = redis.Redis(connection_pool=_make_pool(
+            options['blocking_max_connections'], options['pool_timeout'], **kw))
+
+def setup_replica(name, host, port, db = 0, **kw):
+    """ 不使用sentinel时, 为 setup_redis 设置的system指定一个从库, 
+    在 read_from_replica 中的只读查询发给这个从库。需要在 setup_redis 之后调用
+    """
+    options = dict(POOL_OPTIONS)
+    for key in POOL_OPTIONS:
+        if key in kw: options[key] = kw.pop(key)
+    kw = _connection_kw(options, dict(kw, host=host, port=port, db=db))
+    REPLICA_SYSTEMS[name] = redis.Redis(connection_pool=_make_pool(
+            options['max_connections'], options['pool_timeout'], **kw))
+
+def get_pool_stats(system='default'):
+    """ 连接池的统计信息, 用于监控: {客户端名: stats} """
+    if USE_SENTINEL:
+        clients = SYSTEMS.get(system, {}).get('redis', {})
+        return dict(('%s:%s%s' % (key[0], key[1] and 'master' or 'slave', 
+                                  key[2] and ':blocking' or ''),
+                     dict(client.connection_pool.stats))
+                    for key, client in clients.items())
+    result = {}
+    for key, clients in (('default', SYSTEMS), ('blocking', BLOCKING_SYSTEMS), 
+                         ('replica', REPLICA_SYSTEMS)):
+        if system in clients:
+            result[key] = dict(getattr(clients[system].connection_pool, 'stats', {}))
+    return result
 
 def setup_sentinel(name, hosts, services, db = 0, socket_timeout = 0.1):
     """
@@ -51,6 +195,8 @@ def setup_sentinel(name, hosts, services, db = 0, socket_timeout = 0.1):
         ['service_name1', 'service_name2',]
     @db as int, 使用的redis数据库
     @socket_timeout as float, 超时时间，默认值 0.1
+
+    连接池使用 set_pool_options 的配置, sentinel 不支持阻塞的连接池(pool_timeout)
     """
     global USE_SENTINEL
 
@@ -74,6 +220,7 @@ def setup_sentinel(name, hosts, services, db = 0, socket_timeout = 0.1):
             # 使用其他库都不行，暂时不知道原因
             'db'        : 0,
             'redis'     : {},
+            'pool_kw'   : _connection_kw(POOL_OPTIONS, {}),
         }
 
 def set_default_sentinel(name):
@@ -95,7 +242,8 @@ def _get_sentinel_service(system = 'default'):
     # 当默认名称被设置时，始终返回默认名称
     global DEFAULT_SENTINEL_NAME, CURRENT_HASH_KEY
 
-    if DEFAULT_SENTINEL_NAME:
+    if DEFAULT_SENTINEL_NAME and (system not in SYSTEMS or \
+            DEFAULT_SENTINEL_NAME in SYSTEMS[system]['services']):
         return DEFAULT_SENTINEL_NAME
 
     import random
@@ -106,29 +254,356 @@ def _get_sentinel_service(system = 'default'):
     # 根据hash key获取对应的
     return services[CURRENT_HASH_KEY % len(services)]
 
-def get_redis(system = 'default', is_master = True):
-    global USE_SENTINEL
-    if USE_SENTINEL:
-        service = _get_sentinel_service(system)
-        assert(service)
+def _get_sentinel_redis(system, is_master, blocking=False):
+    service = _get_sentinel_service(system)
+    assert(service)
+    clients = SYSTEMS[system]['redis']
+    # redis客户端实例key
+    instance_key = (service, is_master, blocking)
+    # 同一个python进程，同一个service下，保证只有一个redis实例被创建
+    # 保证连接池的最大使用
+    client = clients.get(instance_key)
+    if client is None:
         # 获取 sentinel 实例
         sentinel = SYSTEMS[system]['sentinel']
-        # redis客户端实例key
-        instance_key = '%(service)s:%(type)s' % {
-                    'service'   : service,
-                    'type'      : 'master' if is_master else 'slave',
-                }
-        # 同一个python进程，同一个service下，保证只有一个redis实例被创建
-        # 保证连接池的最大使用
-        if instance_key not in SYSTEMS[system]['redis']:
-            redis_new = sentinel.master_for if is_master else sentinel.slave_for
-            SYSTEMS[system]['redis'][instance_key] = redis_new(service, db = \
-                    SYSTEMS[system]['db'])
-
-        return SYSTEMS[system]['redis'][instance_key]
+        redis_new = sentinel.master_for if is_master else sentinel.slave_for
+        kw = dict(SYSTEMS[system]['pool_kw'])
+        kw['max_connections'] = POOL_OPTIONS['blocking_max_connections' if blocking 
+                                             else 'max_connections'] or 2 ** 31
+        if blocking:
+            # 阻塞命令没有读超时
+            kw['socket_timeout'] = None
+        client = clients[instance_key] = redis_new(service, db=SYSTEMS[system]['db'], 
+                connection_pool_class=StatsSentinelConnectionPool, **kw)
+    return client
+
+def get_redis(system = 'default', is_master = True):
+    # 在 write_batch 中, 写操作放到批量写的pipeline中
+    pipes = getattr(_local, 'pipes', None)
+    if pipes and system in pipes and is_master:
+        return pipes[system]
+
+    if USE_SENTINEL:
+        return _get_sentinel_redis(system, is_master)
     else:
         return SYSTEMS[system]
 
+def get_blocking_redis(system = 'default'):
+    """ 用于 BRPOP/BLPOP/BRPOPLPUSH 等阻塞命令的客户端, 使用单独的连接池 """
+    if USE_SENTINEL:
+        return _get_sentinel_redis(system, True, blocking=True)
+    return BLOCKING_SYSTEMS.get(system) or SYSTEMS[system]
+
+#--- Shards ----------------------------------------------
+class HashRing(object):
+    """ 一致性hash环, 每个节点在环上有replicas个虚拟节点,
+    增加、删除节点时只有少部分的key需要换节点
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        points = sorted((_ring_point('%s#%d' % (node, i)), node) 
+                            for node in self.nodes for i in xrange(replicas))
+        self._points = [point for point, node in points]
+        self._nodes = [node for point, node in points]
+
+    def get_node(self, key):
+        if isinstance(key, unicode): key = key.encode('utf-8')
+        index = bisect.bisect(self._points, _ring_point(key))
+        return self._nodes[index % len(self._nodes)]
+
+def _ring_point(key):
+    return struct.unpack('>I', md5(key).digest()[:4])[0]
+
+# 分片的一致性hash环, None 表示不分片, 都使用 default
+SHARD_RING = None
+
+def setup_shards(systems, replicas=160):
+    """ 把队列分片到多个system上, 按队列名(或者队列的分片key)的一致性hash选择system
+
+    system 需要先用 setup_redis/setup_sentinel 设置好, 比如::
+
+        setup_redis('default', 'redis1', 6379)
+        setup_redis('shard2', 'redis2', 6379)
+        setup_shards(['default', 'shard2'])
+
+    使用sentinel时, 每个服务名单独 setup_sentinel 成一个system。
+    worker状态、配置、日志等不属于队列的数据总是放在 default 上
+    """
+    global SHARD_RING
+    SHARD_RING = HashRing(systems, replicas) if systems else None
+
+def get_shard_systems():
+    """ 所有分片的system """
+    return list(SHARD_RING.nodes) if SHARD_RING is not None else ['default']
+
+def get_shard(key):
+    """ key 所在的system """
+    return SHARD_RING.get_node(key) if SHARD_RING is not None else 'default'
+
+#--- Write batch ----------------------------------------------
+# 线程局部变量, pipes: system -> 当前线程批量写的pipeline
+_local = threading.local()
+
+@contextmanager
+def write_batch(system='default'):
+    """ 批量写: with 中对这个system的写操作都放到一个pipeline中, 退出时一次发给服务器
+
+    with 中只能写, 不能读(读到的是pipeline对象), 出错时放弃所有的写操作。
+    可以嵌套, 内层的写操作在最外层退出时发送::
+
+        with write_batch():
+            get_work_log_queue().push(task)
+            push_task('ztq_core.demo.send', 'x')
+    """
+    pipes = getattr(_local, 'pipes', None)
+    if pipes is None:
+        pipes = _local.pipes = {}
+    if system in pipes:
+        yield pipes[system]
+        return
+
+    client = get_redis(system)
+    pipe = client.pipeline(transaction=False)
+    pipes[system] = pipe
+    try:
+        yield pipe
+    finally:
+        del pipes[system]
+    execute_pipeline(pipe, client)
+
+def in_write_batch(system='default'):
+    pipes = getattr(_local, 'pipes', None)
+    return bool(pipes) and system in pipes
+
+def _get_pipeline(system):
+    """ 返回 (pipeline, 是否需要自己执行)
+        在 write_batch 中时返回批量写的pipeline, 由 write_batch 负责执行
+    """
+    if in_write_batch(system):
+        return get_redis(system), False
+    return get_redis(system).pipeline(), True
+
+#--- Read from replica ----------------------------------------------
+# 从库落后主库的最大秒数, 超过了就读主库。
+# 主库默认每10秒ping一次从库, 所以空闲时从库和主库最后通讯的时间也可能到10秒
+REPLICA_MAX_LAG = 15
+# 检查从库状态的间隔(秒)
+REPLICA_CHECK_INTERVAL = 1
+# id(从库的连接池) -> (检查时间, 是否可用)
+_REPLICA_CHECKS = {}
+
+@contextmanager
+def read_from_replica(max_lag=None):
+    """ with 中的只读查询(长度、列表、hash 的读取等)发给从库, 写操作仍然发给主库
+
+    用于控制台、监控这些可以接受短暂延迟的读取, 减少主库的压力。
+    从库不可用, 或者落后主库超过 max_lag 秒时读主库。可以嵌套::
+
+        with read_from_replica():
+            len(get_task_queue('mail'))
+    """
+    previous = getattr(_local, 'replica_lag', None)
+    _local.replica_lag = REPLICA_MAX_LAG if max_lag is None else max_lag
+    try:
+        yield
+    finally:
+        _local.replica_lag = previous
+
+def _check_replica(client, max_lag):
+    """ 从库是否可用, 并且落后主库不超过 max_lag 秒 """
+    try:
+        info = client.info('replication')
+    except redis.exceptions.RedisError:
+        return False
+    # 哨兵找不到可用的从库时, 连接的是主库
+    if info.get('role') != 'slave': return True
+    if info.get('master_link_status') != 'up' or info.get('master_sync_in_progress'):
+        return False
+    return 0 <= info.get('master_last_io_seconds_ago', -1) <= max_lag
+
+def get_read_redis(system = 'default', max_lag = None):
+    """ 只读查询使用的客户端
+
+    在 read_from_replica 中, 或者指定了 max_lag 时, 返回可用的从库, 否则返回主库
+    """
+    if max_lag is None:
+        max_lag = getattr(_local, 'replica_lag', None)
+        if max_lag is None:
+            return get_redis(system)
+
+    if USE_SENTINEL:
+        client = _get_sentinel_redis(system, False)
+    else:
+        client = REPLICA_SYSTEMS.get(system)
+        if client is None:
+            return get_redis(system)
+
+    # 检查的结果缓存一会儿, 不用每次查询都检查
+    key = (id(client.connection_pool), max_lag)
+    now = time.time()
+    checked = _REPLICA_CHECKS.get(key)
+    if checked is None or now - checked[0] > REPLICA_CHECK_INTERVAL:
+        checked = _REPLICA_CHECKS[key] = (now, _check_replica(client, max_lag))
+    return client if checked[1] else get_redis(system)
+
+#--- Local cache ----------------------------------------------
+# 失效本地缓存的pub/sub频道, 消息是缓存的key, 为空表示全部失效
+CACHE_CHANNEL = 'ztq:channel:cache'
+# 本地缓存的过期时间(秒), 没有收到失效消息时最多这么久之后重新读取, 0 表示不缓存
+CACHE_TTL = 5
+
+def set_cache_ttl(ttl):
+    global CACHE_TTL
+    CACHE_TTL = ttl
+
+class LocalCache(object):
+    """ 进程内带过期时间的缓存: (system, key) -> value """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+        # 每次失效加1, 读取期间失效了就不保存读到的值
+        self._generation = 0
+
+    def get(self, system, key, loader, ttl):
+        now = time.time()
+        item = self._data.get((system, key), None)
+        if item is not None and item[0] > now:
+            return item[1]
+
+        generation = self._generation
+        value = loader()
+        with self._lock:
+            if generation == self._generation:
+                self._data[(system, key)] = (now + ttl, value)
+        return value
+
+    def invalidate(self, system=None, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is not None:
+                self._data.pop((system, key), None)
+            elif system is None:
+                self._data.clear()
+            else:
+                for cache_key in self._data.keys():
+                    if cache_key[0] == system: del self._data[cache_key]
+
+_CACHE = LocalCache()
+
+def get_cached(key, loader, system='default', ttl=None):
+    """ 从本地缓存读取, 没有或者过期了就用 loader() 读取 """
+    ttl = CACHE_TTL if ttl is None else ttl
+    if not ttl: return loader()
+    return _CACHE.get(system, key, loader, ttl)
+
+def invalidate_cache(key=None, system='default', publish=True):
+    """ 失效本进程的缓存, publish 时通知所有订阅了失效消息的进程 """
+    _CACHE.invalidate(system, key)
+    if publish:
+        get_redis(system).publish(CACHE_CHANNEL, key or '')
+
+class CacheListener(threading.Thread):
+    """ 订阅失效消息, 失效本地缓存; 连接断开时全部失效, 重新订阅 """
+
+    def __init__(self, system='default'):
+        super(CacheListener, self).__init__(name='ztq-cache-listener')
+        self.system = system
+        self.setDaemon(True)
+
+    def run(self):
+        while True:
+            try:
+                pubsub = get_blocking_redis(self.system).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CACHE_CHANNEL)
+                # 订阅之前可能错过了失效消息
+                _CACHE.invalidate(self.system)
+                for message in pubsub.listen():
+                    _CACHE.invalidate(self.system, message['data'] or None)
+            except redis.exceptions.RedisError:
+                _CACHE.invalidate(self.system)
+                time.sleep(1)
+
+# system -> CacheListener
+CACHE_LISTENERS = {}
+
+def start_cache_listener(system='default'):
+    """ 启动订阅失效消息的线程, 每个system只启动一个 """
+    if system not in CACHE_LISTENERS:
+        listener = CACHE_LISTENERS[system] = CacheListener(system)
+        listener.start()
+
+#--- Lua scripts ----------------------------------------------
+# 已注册的脚本, name -> ScriptFu
+SCRIPTS = {}
+
+class ScriptFu(object):
+    """ 服务端执行的lua脚本
+
+    第一次调用时通过 SCRIPT LOAD 加载, 之后使用 EVALSHA 调用,
+    如果redis重启或者切换导致脚本丢失(NOSCRIPT), 自动重新加载后再执行
+    """
+
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.sha = sha1(source).hexdigest()
+
+    def __call__(self, keys=(), args=(), system='default', client=None):
+        client = client or get_redis(system)
+        keys_and_args = tuple(keys) + tuple(args)
+        try:
+            return client.evalsha(self.sha, len(keys), *keys_and_args)
+        except NoScriptError:
+            client.script_load(self.source)
+            return client.evalsha(self.sha, len(keys), *keys_and_args)
+
+    def load(self, system='default'):
+        """ 预先加载脚本 """
+        return get_redis(system).script_load(self.source)
+
+def register_script(name, source):
+    """ 注册一个lua脚本, 返回可调用的ScriptFu对象
+
+    调用方法::
+
+        push = register_script('push', 'return redis.call(...)')
+        push(keys=(key1, key2), args=(arg1,))
+    """
+    script = SCRIPTS[name] = ScriptFu(name, source)
+    return script
+
+def get_script(name):
+    return SCRIPTS[name]
+
+def execute_pipeline(pipe, client):
+    """ 执行pipeline, 返回结果列表
+
+    pipeline 中的 EVALSHA 如果遇到 NOSCRIPT, 重新加载这些脚本后, 从第一个失败的命令开始,
+    按原来的顺序把后面的命令全部再执行一次, 不会改变脚本和其他命令的先后顺序;
+    后面已经成功了的命令会执行两次, pipeline 中的写操作需要可以重复执行。其余的错误直接抛出
+    """
+    command_stack = list(pipe.command_stack)
+    results = pipe.execute(raise_on_error=False)
+
+    noscript = [index for index, result in enumerate(results) 
+                        if isinstance(result, NoScriptError)]
+    if noscript:
+        shas = set(command_stack[index][0][1] for index in noscript)
+        for script in SCRIPTS.values():
+            if script.sha in shas:
+                client.script_load(script.source)
+        retry = client.pipeline(transaction=False)
+        for args, options in command_stack[noscript[0]:]:
+            retry.execute_command(*args, **options)
+        results[noscript[0]:] = retry.execute(raise_on_error=False)
+
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
 #--- Decorators ----------------------------------------------
 def get_list(name, system='default',serialized_type='json'):
     return ListFu(name, system, serialized_type=serialized_type)
@@ -139,18 +614,24 @@ def get_queue(name, system='default',serialized_type='json'):
 def get_limit_queue(name, length, system='default',serialized_type='json'):
     return LimitQueueFu(name, length, system, serialized_type=serialized_type)
 
-def get_hash(name, system='default',serialized_type='json'):
-    return HashFu(name, system, serialized_type=serialized_type)
+def get_hash(name, system='default',serialized_type='json', expire=None):
+    return HashFu(name, system, serialized_type=serialized_type, expire=expire)
 
 def get_set(name, system='default',serialized_type='json'):
     return SetFu(name, system, serialized_type=serialized_type)
 
-def get_dict(name, system='default',serialized_type='json'):
-    return DictFu(name, system, serialized_type=serialized_type)
+def get_sorted_set(name, system='default',serialized_type='json'):
+    return SortedSetFu(name, system, serialized_type=serialized_type)
+
+def get_dict(name, system='default',serialized_type='json', registry=None):
+    return DictFu(name, system, serialized_type=serialized_type, registry=registry)
+
+def get_cached_dict(name, system='default',serialized_type='json', ttl=None):
+    return CachedDictFu(name, system, serialized_type=serialized_type, ttl=ttl)
 
 def get_key(name, system='default',serialized_type='json'):
     loads = load_method[serialized_type]
-    value = get_redis(system).get(name)
+    value = get_read_redis(system).get(name)
     try:
         return loads(value)
     except:return value
@@ -158,15 +639,73 @@ def get_key(name, system='default',serialized_type='json'):
 def del_key(name, system='default'):
     get_redis(system).delete(name)
     
+# SCAN 每次遍历的个数, MGET 每次读取的个数
+SCAN_COUNT = 1000
+MGET_CHUNK_SIZE = 500
+# 遍历list、hash时每页读取的个数, 批量写入时每次发送的个数
+PAGE_SIZE = 1000
+
+def scan_keys(pattern, system='default'):
+    """ 用SCAN增量的遍历key, 不会像KEYS一样阻塞整个redis, 结果中没有重复 """
+    seen = set()
+    for key in get_read_redis(system).scan_iter(match=pattern, count=SCAN_COUNT):
+        if key in seen: continue
+        seen.add(key)
+        yield key
+
 def get_keys(name, system='default'):
-    for key in get_redis(system).keys(name + "*"):
+    for key in scan_keys(name + "*", system):
         key_name = key[len(name):]
         yield key_name
+
+# 已经补全过的登记集合
+REBUILT_REGISTRIES = 'ztq:set:registry'
+# 本进程中已经检查过的登记集合
+_CHECKED_REGISTRIES = set()
+
+def rebuild_registry(registry, prefix, system='default'):
+    """ 第一次使用登记集合时(比如从老版本升级), 用SCAN找到以prefix开头的key补全登记
+
+    登记的是去掉prefix的名字, 整个系统只补全一次, 每个进程对每个redis只检查一次;
+    SCAN完成后才标记为补全过了, 中途出错的下次重新补全, 多个进程同时补全也没有关系
+    """
+    client = get_redis(system)
+    if (id(client), registry) in _CHECKED_REGISTRIES: return
+    if not client.sismember(REBUILT_REGISTRIES, registry):
+        names = [key[len(prefix):] for key in scan_keys(prefix + '*', system)]
+        if names:
+            client.sadd(registry, *names)
+        client.sadd(REBUILT_REGISTRIES, registry)
+    _CHECKED_REGISTRIES.add((id(client), registry))
+
+# 从登记集合中删除已经不存在的key, 检查和删除是原子的, 不会删除刚刚重新写入的
+# KEYS[1]: 登记集合, KEYS[2]...: 完整的key, ARGV: 对应的登记的名字
+PRUNE_REGISTRY_SCRIPT = register_script('ztq:prune_registry', """
+local pruned = 0
+for i = 2, #KEYS do
+    if redis.call('EXISTS', KEYS[i]) == 0 then
+        pruned = pruned + redis.call('SREM', KEYS[1], ARGV[i - 1])
+    end
+end
+return pruned
+""")
+
+def mget_values(keys, system='default'):
+    """ 分块用MGET读取, 返回和keys对应的值的列表 """
+    client = get_read_redis(system)
+    values = []
+    for start in xrange(0, len(keys), MGET_CHUNK_SIZE):
+        values.extend(client.mget(keys[start:start + MGET_CHUNK_SIZE]))
+    return values
    
-def set_key(name, value, system='default',serialized_type='json'):
+def set_key(name, value, system='default',serialized_type='json', expire=None):
+    """ expire: 过期时间(秒), 为None时永不过期 """
     dumps = dump_method[serialized_type]
     value = dumps(value)
-    get_redis(system).set(name, value)
+    if expire:
+        get_redis(system).execute_command('SET', name, value, 'EX', int(expire))
+    else:
+        get_redis(system).set(name, value)
 
 #---serialize data type----------------------------------------
 def _convert_persistent_obj(obj):
@@ -187,6 +726,107 @@ load_method = {'json':json.loads,
                'pickle':pickle.loads,
                'string':str
                }
+
+#--- Serializers ----------------------------------------------
+# 通过 register_serializer 注册的序列化方式, 数据前面有4个字节的头:
+#   SERIALIZE_HEADER + codec代码(1字节) + 压缩代码(1字节, '-' 表示没有压缩)
+# 读取时根据头来解码, 没有头的是老格式的数据, 这样滚动升级的时候新老格式可以共存。
+# json和pickle的数据不会以 '\x00' 开头
+SERIALIZE_HEADER = '\x00z'
+NO_COMPRESS = '-'
+
+# name -> (code, dumps, loads), code -> name
+CODECS = {}
+CODEC_NAMES = {}
+# name -> (code, compress, decompress), code -> name
+COMPRESSORS = {}
+COMPRESSOR_NAMES = {}
+
+def register_codec(name, code, dumps, loads):
+    """ 注册一种编码, code 是写在数据头中的1个字符, 不能修改 """
+    CODECS[name] = (code, dumps, loads)
+    CODEC_NAMES[code] = name
+
+def register_compressor(name, code, compress, decompress):
+    """ 注册一种压缩方式, code 是写在数据头中的1个字符, 不能修改 """
+    COMPRESSORS[name] = (code, compress, decompress)
+    COMPRESSOR_NAMES[code] = name
+
+def _loads_any(data, legacy_loads):
+    """ 有头的数据根据头解码, 否则使用老格式的 legacy_loads """
+    if not isinstance(data, str) or not data.startswith(SERIALIZE_HEADER):
+        return legacy_loads(data)
+    codec_code, compress_code = data[2], data[3]
+    data = data[4:]
+    if compress_code != NO_COMPRESS:
+        data = COMPRESSORS[COMPRESSOR_NAMES[compress_code]][2](data)
+    return CODECS[CODEC_NAMES[codec_code]][2](data)
+
+def register_serializer(name, codec, compressor=None, threshold=1024, legacy='json'):
+    """ 注册一种序列化方式, 之后可以作为 serialized_type 使用::
+
+        register_serializer('msgpack+lz4', 'msgpack', 'lz4', threshold=512)
+        get_hash('ztq:hash:task:thumbnail', serialized_type='msgpack+lz4')
+
+    codec: register_codec 注册的编码
+    compressor: register_compressor 注册的压缩方式, 数据不小于threshold字节时才压缩
+    legacy: 读到没有头的老数据时使用的序列化方式
+    """
+    codec_code, codec_dumps = CODECS[codec][:2]
+    if compressor is not None:
+        compress_code, compress = COMPRESSORS[compressor][:2]
+
+    def dumps(item):
+        data = codec_dumps(item)
+        if compressor is not None and len(data) >= threshold:
+            return SERIALIZE_HEADER + codec_code + compress_code + compress(data)
+        return SERIALIZE_HEADER + codec_code + NO_COMPRESS + data
+
+    legacy_loads = load_method[legacy]
+    dump_method[name] = dumps
+    load_method[name] = lambda data: _loads_any(data, legacy_loads)
+
+register_codec('json', 'j', 
+        lambda item: json.dumps(item, encoding=DEFAULT_ENCODING, 
+            default=_convert_persistent_obj), 
+        json.loads)
+register_codec('pickle', 'p', lambda item: pickle.dumps(item, 2), pickle.loads)
+register_compressor('zlib', 'z', zlib.compress, zlib.decompress)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+else:
+    def _msgpack_loads(data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except TypeError:
+            # 老版本的msgpack
+            return msgpack.unpackb(data, encoding='utf-8')
+    register_codec('msgpack', 'm', 
+            lambda item: msgpack.packb(item, default=_convert_persistent_obj), 
+            _msgpack_loads)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_compressor('lz4', '4', lz4.frame.compress, lz4.frame.decompress)
+
+# 老的json、pickle格式也能读取新格式的数据, 'string' 不做任何转换
+load_method['json'] = lambda data: _loads_any(data, json.loads)
+load_method['pickle'] = lambda data: _loads_any(data, pickle.loads)
+
+register_serializer('json+zlib', 'json', 'zlib')
+register_serializer('pickle2', 'pickle', legacy='pickle')
+register_serializer('pickle2+zlib', 'pickle', 'zlib', legacy='pickle')
+if msgpack is not None:
+    register_serializer('msgpack', 'msgpack')
+    register_serializer('msgpack+zlib', 'msgpack', 'zlib')
+    if 'lz4' in COMPRESSORS:
+        register_serializer('msgpack+lz4', 'msgpack', 'lz4')
     
 #--- Data impl. ----------------------------------------------
 class ListFu(object):
@@ -203,8 +843,13 @@ class ListFu(object):
         get_redis(self.system).lpush(self.name, item)
 
     def extend(self, iterable):
-        for item in iterable:
-            self.append(item)
+        """ 和依次append的结果一样, 每PAGE_SIZE个用一个LPUSH写入 """
+        client = get_redis(self.system)
+        items = iter(iterable)
+        while True:
+            chunk = [self.dumps(item) for item in islice(items, PAGE_SIZE)]
+            if not chunk: break
+            client.lpush(self.name, *chunk)
     
     def remove(self, value):
         value = self.dumps(value)
@@ -214,66 +859,81 @@ class ListFu(object):
         if index:
             raise ValueError('Not supported')
         serialized_data = get_redis(self.system).rpop(self.name)
-        if serialized_data[1]:
-            item = self.loads(serialized_data[1])
-            return item
+        if serialized_data:
+            return self.loads(serialized_data)
         else: return None
 
     def __len__(self):
-        return get_redis(self.system).llen(self.name)
+        return get_read_redis(self.system).llen(self.name)
 
     def __iter__(self):
-        client = get_redis(self.system)
+        """ 每次用LRANGE读取一页 """
+        client = get_read_redis(self.system)
         i = 0
         while True:
-            items = client.lrange(self.name, i, i+30)
-            if len(items) == 0:
-                break
-                #raise StopIteration
+            items = client.lrange(self.name, i, i + PAGE_SIZE - 1)
             for item in items:
                 yield self.loads(item)
-            i += 30
+            if len(items) < PAGE_SIZE:
+                break
+            i += PAGE_SIZE
 
     def __getitem__(self, index):
-        client = get_redis(self.system)
+        client = get_read_redis(self.system)
         value = client.lindex(self.name, index)
         return self.loads(value) if value else None
 
     def __getslice__(self, i, j):
-        client = get_redis(self.system)
+        client = get_read_redis(self.system)
         items = client.lrange(self.name, i, j)
         for item in items:
             yield self.loads(item)
 
 class HashFu:
+    """ expire 不为空时, 每次写入都会重新设置整个hash的过期时间(秒) """
 
-    def __init__(self, name, system, serialized_type='json'):
+    def __init__(self, name, system, serialized_type='json', expire=None):
         self.name = name
         self.system = system
+        self.expire = expire
         self.dumps = dump_method[serialized_type]
         self.loads = load_method[serialized_type]
 
     def get(self, key, default=None):
-        value = get_redis(self.system).hget(self.name, key)
+        value = get_read_redis(self.system).hget(self.name, key)
         try:
             return self.loads(value)
         except: return default
         
     def items(self):
-        for key in self.keys():
-            # key_list 不是实时的数据
-            # 这个任务可能已经被取走了（当监视这个队列的工作线程有多个的时候）
-            value = self.get(key)
-            if value is None: continue
-
-            yield key, value
+        """ 用HSCAN每次读取一页, 不会长时间阻塞redis """
+        seen = set()
+        for key, value in get_read_redis(self.system).hscan_iter(self.name, count=PAGE_SIZE):
+            # HSCAN 可能返回重复的数据
+            if key in seen: continue
+            seen.add(key)
+            try:
+                yield key, self.loads(value)
+            except: continue
 
     def keys(self):
-        return get_redis(self.system).hkeys(self.name) or []
+        return get_read_redis(self.system).hkeys(self.name) or []
 
     def values(self):
-        _values = self.loads(get_redis(self.system).hvals(self.name))
-        return _values or []
+        return [value for key, value in self.items()]
+
+    def get_many(self, keys):
+        """ 用HMGET读取多个值, 返回和keys对应的列表, 不存在的为None """
+        client = get_read_redis(self.system)
+        keys = list(keys)
+        values = []
+        for start in xrange(0, len(keys), PAGE_SIZE):
+            for value in client.hmget(self.name, keys[start:start + PAGE_SIZE]):
+                try:
+                    values.append(self.loads(value) if value is not None else None)
+                except:
+                    values.append(None)
+        return values
 
     def pop(self, key):
         pline = get_redis(self.system).pipeline()
@@ -287,7 +947,7 @@ class HashFu:
             return None
 
     def __len__(self):
-        return get_redis(self.system).hlen(self.name) or 0
+        return get_read_redis(self.system).hlen(self.name) or 0
 
     def __getitem__(self, key):
         val = self.get(key)
@@ -297,29 +957,41 @@ class HashFu:
 
     def __setitem__(self, key, value):
         value = self.dumps(value)
-        return get_redis(self.system).hset(self.name, key, value)
+        if not self.expire:
+            return get_redis(self.system).hset(self.name, key, value)
+
+        pline, own = _get_pipeline(self.system)
+        pline.hset(self.name, key, value).expire(self.name, int(self.expire))
+        if own: pline.execute()
 
     def __delitem__(self, key):
         get_redis(self.system).hdel(self.name, key)
 
     def __contains__(self, key):
-        return get_redis(self.system).hexists(self.name, key)
+        return get_read_redis(self.system).hexists(self.name, key)
 
-    def update(self, new_dict, **kw):
+    def update(self, new_dict=None, **kw):
+        """ 每PAGE_SIZE个用一个HMSET写入 """
         update = {}
 
         if new_dict and hasattr(new_dict, 'keys'):
-            for key in new_dict:
+            for key in new_dict.keys():
                 update[key] = self.dumps(new_dict[key])
         elif new_dict:
             for key, value in new_dict:
-                update[key] = self.dumps(key)
+                update[key] = self.dumps(value)
 
         for key in kw:
-            update[key] = self.dumps(key[key])
+            update[key] = self.dumps(kw[key])
 
-        if update:
-            get_redis(self.system).hmset(self.name, update)
+        if not update: return
+        pline, own = _get_pipeline(self.system)
+        items = update.items()
+        for start in xrange(0, len(items), PAGE_SIZE):
+            pline.hmset(self.name, dict(items[start:start + PAGE_SIZE]))
+        if self.expire:
+            pline.expire(self.name, int(self.expire))
+        if own: pline.execute()
 
 class SetFu:
 
@@ -343,58 +1015,147 @@ class SetFu:
         return self.loads(value)
 
     def __iter__(self):
-        client = get_redis(self.system)
+        client = get_read_redis(self.system)
         for item in client.smembers(self.name):
             yield self.loads(item)
 
     def __len__(self):
-        return len(get_redis(self.system).smembers(self.name))
+        return get_read_redis(self.system).scard(self.name)
 
     def __contains__(self, item):
         item = self.dumps(item)
-        return get_redis(self.system).sismember(self.name, item)
+        return get_read_redis(self.system).sismember(self.name, item)
+
+class SortedSetFu:
+    """ 有序集合, score 一般是时间戳 """
+
+    def __init__(self, name, system, serialized_type='json'):
+        self.name = name
+        self.system = system
+        self.dumps = dump_method[serialized_type]
+        self.loads = load_method[serialized_type]
+
+    def add(self, item, score):
+        item = self.dumps(item)
+        get_redis(self.system).zadd(self.name, {item: score})
+
+    def remove(self, item):
+        item = self.dumps(item)
+        get_redis(self.system).zrem(self.name, item)
+
+    def score(self, item):
+        item = self.dumps(item)
+        return get_read_redis(self.system).zscore(self.name, item)
+
+    def first(self):
+        """ score 最小的 (item, score), 为空时返回None """
+        items = get_read_redis(self.system).zrange(self.name, 0, 0, withscores=True)
+        if not items: return None
+        return self.loads(items[0][0]), items[0][1]
+
+    def range_by_score(self, min='-inf', max='+inf', start=None, num=None, withscores=False):
+        """ score 在 [min, max] 之间的, start/num 用于分页 """
+        items = get_read_redis(self.system).zrangebyscore(self.name, min, max, 
+                start=start, num=num, withscores=withscores)
+        if withscores:
+            return [(self.loads(item), score) for item, score in items]
+        return [self.loads(item) for item in items]
+
+    def __iter__(self):
+        """ 按score从小到大, 每次用ZRANGE读取一页 """
+        client = get_read_redis(self.system)
+        i = 0
+        while True:
+            items = client.zrange(self.name, i, i + PAGE_SIZE - 1)
+            for item in items:
+                yield self.loads(item)
+            if len(items) < PAGE_SIZE:
+                break
+            i += PAGE_SIZE
+
+    def __len__(self):
+        return get_read_redis(self.system).zcard(self.name)
+
+    def __contains__(self, item):
+        return self.score(item) is not None
 
 class DictFu:
+    """ 以name为前缀的一组key
+
+    registry 是登记这些key的集合的名字, 写入和删除时同时维护登记,
+    遍历时读取登记的集合; 没有登记集合时用SCAN遍历
+    """
     
-    def __init__(self, name, system, serialized_type='json'):
+    def __init__(self, name, system, serialized_type='json', registry=None):
         self.name = name
         self.system = system
+        self.registry = registry
         self.dumps = dump_method[serialized_type]
         self.loads = load_method[serialized_type]
     
     def get(self, key, default=None):
-        value = get_redis(self.system).get(self.name+key)
+        value = get_read_redis(self.system).get(self.name+key)
         try:
             return self.loads(value)
         except: return default
         
     def set(self, key, value):
         value = self.dumps(value)
-        get_redis(self.system).set(self.name+key, value)
+        if self.registry is None:
+            get_redis(self.system).set(self.name+key, value)
+            return
+
+        pline, own = _get_pipeline(self.system)
+        pline.set(self.name+key, value).sadd(self.registry, key)
+        if own: pline.execute()
     
     def __delitem__(self, key):
-        get_redis(self.system).delete(self.name+key)
+        if self.registry is None:
+            get_redis(self.system).delete(self.name+key)
+            return
+
+        pline, own = _get_pipeline(self.system)
+        pline.delete(self.name+key).srem(self.registry, key)
+        if own: pline.execute()
     
     def __len__(self):
-        listkey = get_redis(self.system).keys(self.name+"*")
-        return len(listkey) or 0
+        if self.registry is not None:
+            return get_read_redis(self.system).scard(self.registry) or 0
+        return len(self.keys())
 
     def keys(self):
-        prefix_len = len(self.name)
-        return [key[prefix_len:] for key in get_redis(self.system).keys(self.name + "*")]
+        if self.registry is not None:
+            return list(get_read_redis(self.system).smembers(self.registry))
+        return list(get_keys(self.name, self.system))
 
     def items(self):
-        # XXX self.get 每次都要连结redis， 这样不好
-        key_list = get_redis(self.system).keys(self.name+"*")
-        for key in key_list:
-            key_name = key[len(self.name):]
-
+        key_list = self.keys()
+        values = mget_values([self.name + key_name for key_name in key_list], self.system)
+        result = []
+        missing = []
+        for key_name, value in zip(key_list, values):
             # key_list 不是实时的数据
             # 这个任务可能已经被取走了（当监视这个队列的工作线程有多个的时候）
-            value = self.get(key_name)
-            if value is None: continue
-
-            yield key_name, value
+            if value is None:
+                missing.append(key_name)
+                continue
+            try:
+                result.append((key_name, self.loads(value)))
+            except: continue
+        if missing and self.registry is not None:
+            # key已经不存在了(比如过期了), 从登记中删除, 否则 __len__ 和 keys 一直包括它们
+            self.prune(missing)
+        return result
+
+    def prune(self, key_names):
+        """ 从登记集合中删除已经不存在的key, 返回删除的个数 """
+        pruned = 0
+        for start in xrange(0, len(key_names), MGET_CHUNK_SIZE):
+            chunk = key_names[start:start + MGET_CHUNK_SIZE]
+            pruned += PRUNE_REGISTRY_SCRIPT(
+                    keys=[self.registry] + [self.name + key_name for key_name in chunk], 
+                    args=chunk, system=self.system)
+        return pruned
     
     def __getitem__(self, key=''):
         val = self.get(key, None)
@@ -406,7 +1167,46 @@ class DictFu:
         self.set(key, value)
     
     def __contains__(self, key):
-        return get_redis(self.system).exists(self.name+key)
+        return get_read_redis(self.system).exists(self.name+key)
+
+class CachedDictFu(DictFu):
+    """ 读取本地缓存的DictFu, 用于很少修改、经常读取的配置
+
+    整个字典一起缓存, 读到的是复本; 写入时更新服务器, 并通知所有进程失效缓存
+    """
+
+    def __init__(self, name, system, serialized_type='json', registry=None, ttl=None):
+        DictFu.__init__(self, name, system, serialized_type, registry)
+        self.ttl = ttl
+        # 直接读写服务器的DictFu
+        self.source = DictFu(name, system, serialized_type, registry)
+
+    def _cached(self):
+        return get_cached(self.name, lambda: dict(self.source.items()), self.system, self.ttl)
+
+    def get(self, key, default=None):
+        value = self._cached().get(key, None)
+        return default if value is None else copy.deepcopy(value)
+
+    def set(self, key, value):
+        self.source.set(key, value)
+        invalidate_cache(self.name, self.system)
+
+    def __delitem__(self, key):
+        del self.source[key]
+        invalidate_cache(self.name, self.system)
+
+    def __len__(self):
+        return len(self._cached())
+
+    def keys(self):
+        return self._cached().keys()
+
+    def items(self):
+        return copy.deepcopy(self._cached().items())
+
+    def __contains__(self, key):
+        return key in self._cached()
 
 class QueueFu(ListFu):
 
@@ -428,12 +1228,12 @@ class QueueFu(ListFu):
         """
         if from_right:
             if timeout >= 0:
-                serialized_data = get_redis(self.system).brpop(self.name, timeout)
+                serialized_data = get_blocking_redis(self.system).brpop(self.name, timeout)
             else:
                 serialized_data = get_redis(self.system).rpop(self.name)
         else:
             if timeout >= 0:
-                serialized_data = get_redis(self.system).blpop(self.name, timeout)
+                serialized_data = get_blocking_redis(self.system).blpop(self.name, timeout)
             else:
                 serialized_data = get_redis(self.system).lpop(self.name)
 
@@ -449,13 +1249,17 @@ class QueueFu(ListFu):
         return None
      
     def reverse(self):
-        """倒序输出结果 
+        """倒序输出结果, 从右边开始每次用LRANGE读取一页
         """
-        client = get_redis(self.system)
-        length = client.llen(self.name)
-        for index in xrange(length-1, -1, -1):
-            item = client.lindex(self.name, index)
-            yield self.loads(item)
+        client = get_read_redis(self.system)
+        end = -1
+        while True:
+            items = client.lrange(self.name, end - PAGE_SIZE + 1, end)
+            for item in reversed(items):
+                yield self.loads(item)
+            if len(items) < PAGE_SIZE:
+                break
+            end -= PAGE_SIZE
         
 class LimitQueueFu(QueueFu):
     """此队列类用于控制队列长度，主要用于日志
@@ -469,8 +1273,8 @@ class LimitQueueFu(QueueFu):
         #get_redis(self.system).ltrim(self.name, 0, self.length)
 
         item = self.dumps(item)
-        pline = get_redis(self.system).pipeline()
+        pline, own = _get_pipeline(self.system)
         pline.lpush(self.name, item).ltrim(self.name, 0, self.length)
-        pline.execute()
+        if own: pline.execute()
 
     # 获取一个随机数
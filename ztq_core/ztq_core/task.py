@@ -4,12 +4,559 @@
 
 import model
 import time
+import math
+import random
+import struct
+import zlib
 from threading import Thread
 from hashlib import md5
-from redis_wrap import dump_method
+import itertools
+from itertools import islice
+from redis_wrap import dump_method, register_script, get_redis, get_blocking_redis, \
+        execute_pipeline
 
 task_registry = {}
 
+# 有优先级的队列, 出队时跳过了过期的位置, 减少优先级hash中记录的过期个数(见 model.get_priority_hash)
+DROP_STALE_LUA = """
+local function drop_stale(key, count)
+    if count <= 0 then
+        return
+    end
+    local stale = tonumber(redis.call('HGET', key, 'ztq:stale') or '0')
+    if stale > count then
+        redis.call('HSET', key, 'ztq:stale', stale - count)
+    elseif stale > 0 then
+        redis.call('HDEL', key, 'ztq:stale')
+    end
+end
+"""
+
+# 入队脚本: 写入hash, 如果是新任务就push到队列, 一次往返完成
+# KEYS[1]: task hash, KEYS[2]: task queue, KEYS[3]: 任务id计数器(服务端生成id时), KEYS[4]: 队列的登记集合
+# KEYS[5]: 优先级hash(有优先级的队列)
+# ARGV[1]: task_md5, 为空表示用计数器生成, ARGV[2]: 序列化后的task, ARGV[3]: 1 表示从左边push
+# ARGV[4]: 登记的队列名, 为空表示不需要登记, ARGV[5]: 优先级(有优先级的队列), 可以为空
+# ARGV[6]: 生成的id的后缀(分布在多个system上的队列)
+PUSH_JOB_SCRIPT = register_script('ztq:push_job', """
+local task_md5 = ARGV[1]
+if task_md5 == '' then
+    task_md5 = '#' .. redis.call('INCR', KEYS[3]) .. (ARGV[6] or '')
+end
+if redis.call('HSET', KEYS[1], task_md5, ARGV[2]) == 0 then
+    -- task_md5已经存在
+    return 0
+end
+if ARGV[5] and ARGV[5] ~= '' then
+    if ARGV[5] == '0' then
+        redis.call('HDEL', KEYS[5], task_md5)
+    else
+        redis.call('HSET', KEYS[5], task_md5, ARGV[5])
+    end
+end
+if ARGV[3] == '1' then
+    redis.call('LPUSH', KEYS[2], task_md5)
+else
+    redis.call('RPUSH', KEYS[2], task_md5)
+end
+if ARGV[4] ~= '' then
+    redis.call('SADD', KEYS[4], ARGV[4])
+end
+return 1
+""")
+
+# 非阻塞出队脚本: 按顺序从多个队列中pop出task_md5, 同时从hash中取出并删除task
+# KEYS: task queue1, task hash1, 优先级hash1, task queue2, task hash2, 优先级hash2, ...
+# ARGV[1]: 1 表示从右边pop, ARGV[2], ARGV[3], ...: 每个队列的优先级, 为空表示没有优先级
+# 返回 {队列序号, task_md5, task}, 队列都为空时返回nil, task已不存在时task为nil
+# 已经调整到其他优先级的task_md5是过期的, 直接跳过
+POP_JOB_SCRIPT = register_script('ztq:pop_job', DROP_STALE_LUA + """
+for i = 1, #KEYS, 3 do
+    local index = (i + 2) / 3
+    local level = ARGV[index + 1]
+    while true do
+        local task_md5
+        if ARGV[1] == '1' then
+            task_md5 = redis.call('RPOP', KEYS[i])
+        else
+            task_md5 = redis.call('LPOP', KEYS[i])
+        end
+        if not task_md5 then
+            break
+        end
+        local current = level
+        if level ~= '' and task_md5 ~= '' then
+            current = redis.call('HGET', KEYS[i + 2], task_md5) or '0'
+        end
+        if current == level then
+            if level ~= '' then
+                redis.call('HDEL', KEYS[i + 2], task_md5)
+            end
+            local task = redis.call('HGET', KEYS[i + 1], task_md5)
+            if task then
+                redis.call('HDEL', KEYS[i + 1], task_md5)
+            elseif level ~= '' and task_md5 ~= '' then
+                drop_stale(KEYS[i + 2], 1)
+            end
+            return {index, task_md5, task}
+        end
+        drop_stale(KEYS[i + 2], 1)
+    end
+end
+return nil
+""")
+
+# 预取脚本: 一次取出最多 ARGV[1] 个task, 同时从hash中取出并删除
+# KEYS[1]: task queue, KEYS[2]: task hash, KEYS[3]: 优先级hash(有优先级的队列)
+# ARGV[1]: 个数, ARGV[2]: 1 表示从右边取, ARGV[3]: 优先级(有优先级的队列)
+# 返回 {是否取到了空的task_md5, 按出队顺序排列的task...}, 
+# 已经不存在的task、过期的优先级和空的task_md5(用来唤醒工作线程的)被跳过
+POP_JOBS_SCRIPT = register_script('ztq:pop_jobs', DROP_STALE_LUA + """
+local count = tonumber(ARGV[1])
+local woken = 0
+local md5s, first, last, step
+if ARGV[2] == '1' then
+    md5s = redis.call('LRANGE', KEYS[1], -count, -1)
+    redis.call('LTRIM', KEYS[1], 0, -count - 1)
+    first, last, step = #md5s, 1, -1
+else
+    md5s = redis.call('LRANGE', KEYS[1], 0, count - 1)
+    redis.call('LTRIM', KEYS[1], count, -1)
+    first, last, step = 1, #md5s, 1
+end
+local fields = {}
+for i = first, last, step do
+    if md5s[i] ~= '' then
+        table.insert(fields, md5s[i])
+    else
+        woken = 1
+    end
+end
+if ARGV[3] and #fields > 0 then
+    local levels = redis.call('HMGET', KEYS[3], unpack(fields))
+    local valid = {}
+    for i = 1, #fields do
+        if (levels[i] or '0') == ARGV[3] then
+            table.insert(valid, fields[i])
+        end
+    end
+    drop_stale(KEYS[3], #fields - #valid)
+    fields = valid
+    if #fields > 0 then
+        redis.call('HDEL', KEYS[3], unpack(fields))
+    end
+end
+if #fields == 0 then
+    return {woken}
+end
+local tasks = redis.call('HMGET', KEYS[2], unpack(fields))
+redis.call('HDEL', KEYS[2], unpack(fields))
+local result = {woken}
+for i = 1, #fields do
+    if tasks[i] then
+        table.insert(result, tasks[i])
+    end
+end
+if ARGV[3] then
+    drop_stale(KEYS[3], #fields - #result + 1)
+end
+return result
+""")
+
+# 取出指定task_md5对应的task: 阻塞pop唤醒之后, 或者直接指定task_md5时使用
+# KEYS[1]: task queue, KEYS[2]: task hash, KEYS[3]: 优先级hash(有优先级的队列)
+# ARGV[1]: task_md5, ARGV[2]: 1 表示需要从队列中删除task_md5, ARGV[3]: 优先级(有优先级的队列)
+TAKE_JOB_SCRIPT = register_script('ztq:take_job', DROP_STALE_LUA + """
+if ARGV[3] then
+    if (redis.call('HGET', KEYS[3], ARGV[1]) or '0') ~= ARGV[3] then
+        -- 已经调整到了其他优先级, 这是过期的位置
+        if ARGV[2] ~= '1' then
+            drop_stale(KEYS[3], 1)
+        end
+        return nil
+    end
+    redis.call('HDEL', KEYS[3], ARGV[1])
+end
+local stale = 0
+if ARGV[2] == '1' then
+    -- 同一个列表中可能还有过期的位置, 一起删除了
+    stale = redis.call('LREM', KEYS[1], 0, ARGV[1]) - 1
+end
+local task = redis.call('HGET', KEYS[2], ARGV[1])
+if task then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    stale = stale + 1
+end
+if ARGV[3] then
+    drop_stale(KEYS[3], stale)
+end
+return task
+""")
+
+# 把buffer中的任务放到任务队列, 任务队列中最多保持 ARGV[1] 个任务
+# KEYS[1]: buffer queue, KEYS[2]: buffer hash, KEYS[3]: task queue, KEYS[4]: task hash, KEYS[5]: 队列的登记集合
+# KEYS[6]: 优先级hash, KEYS[7]...: 其他优先级的任务列表(有优先级的队列)
+# ARGV[1]: 任务数上限, ARGV[2]: 其他分片上的任务数, ARGV[3]: 登记的队列名, ARGV[4]: 1 表示只取出, 由客户端放到任务队列
+# 返回 {移动的个数, task_md5, task, ...}: 只取出的和老格式的任务返回给客户端, 老格式的task_md5为空
+BUFFER_MOVE_SCRIPT = register_script('ztq:buffer_move', """
+-- 任务数是所有优先级列表的长度, 减去其中过期的位置
+local length = redis.call('LLEN', KEYS[3])
+if KEYS[6] then
+    for i = 7, #KEYS do
+        length = length + redis.call('LLEN', KEYS[i])
+    end
+    length = math.max(length - tonumber(redis.call('HGET', KEYS[6], 'ztq:stale') or '0'), 0)
+end
+local free = tonumber(ARGV[1]) - tonumber(ARGV[2]) - length
+local moved = 0
+local result = {}
+while free > 0 do
+    local task_md5 = redis.call('RPOP', KEYS[1])
+    if not task_md5 then
+        break
+    end
+    local task = redis.call('HGET', KEYS[2], task_md5)
+    if not task then
+        -- 老格式, 列表中是整个任务
+        table.insert(result, '')
+        table.insert(result, task_md5)
+    else
+        redis.call('HDEL', KEYS[2], task_md5)
+        if ARGV[4] == '1' then
+            table.insert(result, task_md5)
+            table.insert(result, task)
+        elseif redis.call('HSET', KEYS[4], task_md5, task) == 1 then
+            redis.call('LPUSH', KEYS[3], task_md5)
+            moved = moved + 1
+        end
+    end
+    free = free - 1
+end
+if moved > 0 and ARGV[3] ~= '' then
+    redis.call('SADD', KEYS[5], ARGV[3])
+end
+table.insert(result, 1, moved)
+return result
+""")
+
+# 通知buffer线程: 每个buffer队列一个信号列表, 已经有信号时不再加入, 信号列表不会无限增长
+# KEYS[1]: buffer queue, KEYS[2]: 信号列表
+# ARGV[1]: 1 表示buffer为空时不通知
+SIGNAL_BUFFER_SCRIPT = register_script('ztq:signal_buffer', """
+if ARGV[1] == '1' and redis.call('LLEN', KEYS[1]) == 0 then
+    return 0
+end
+if redis.call('LLEN', KEYS[2]) == 0 then
+    redis.call('LPUSH', KEYS[2], 1)
+    return 1
+end
+return 0
+""")
+
+# 加入延时任务: 写入hash和有序集合, 维护索引中这个队列最早的到期时间
+# KEYS[1]: delayed hash, KEYS[2]: delayed 有序集合, KEYS[3]: 任务id计数器, KEYS[4]: 延时索引, KEYS[5]: 信号列表
+# KEYS[6]: 延时任务的优先级hash
+# ARGV[1]: task_md5, 为空表示用计数器生成, ARGV[2]: 序列化后的task, ARGV[3]: 到期时间, ARGV[4]: 队列名
+# ARGV[5]: 生成的id的后缀(分布在多个system上的队列), ARGV[6]: 到期后放入的优先级
+# 返回1表示新加入, 0表示已经存在(保留较早的到期时间)
+DELAY_JOB_SCRIPT = register_script('ztq:delay_job', """
+local task_md5 = ARGV[1]
+if task_md5 == '' then
+    task_md5 = '#' .. redis.call('INCR', KEYS[3]) .. ARGV[5]
+end
+local eta = tonumber(ARGV[3])
+local new = redis.call('HSET', KEYS[1], task_md5, ARGV[2])
+if ARGV[6] == '0' then
+    redis.call('HDEL', KEYS[6], task_md5)
+else
+    redis.call('HSET', KEYS[6], task_md5, ARGV[6])
+end
+local score = redis.call('ZSCORE', KEYS[2], task_md5)
+if score and tonumber(score) <= eta then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[3], task_md5)
+local first = redis.call('ZSCORE', KEYS[4], ARGV[4])
+if not first or eta < tonumber(first) then
+    -- 比所有队列的延时任务都早到期, 通知延时任务线程重新计算等待时间
+    local head = redis.call('ZRANGE', KEYS[4], 0, 0, 'WITHSCORES')
+    redis.call('ZADD', KEYS[4], ARGV[3], ARGV[4])
+    if #head == 0 or eta < tonumber(head[2]) then
+        redis.call('DEL', KEYS[5])
+        redis.call('LPUSH', KEYS[5], ARGV[3])
+    end
+end
+return new
+""")
+
+# 把到期的延时任务放到任务队列, 一次最多 ARGV[2] 个, 然后更新索引
+# KEYS[1]: delayed 有序集合, KEYS[2]: delayed hash, KEYS[3]: task queue, KEYS[4]: task hash,
+# KEYS[5]: 队列的登记集合, KEYS[6]: 延时索引, KEYS[7]: 延时任务的优先级hash,
+# KEYS[8]: 优先级hash, KEYS[9]...: 优先级1, 2, ...的任务列表(有优先级的队列)
+# ARGV[1]: 当前时间, ARGV[2]: 一次最多移动的个数, ARGV[3]: 登记的队列名, ARGV[4]: 队列名
+# 返回 {移动的个数, 取出的个数, 剩下的最早到期时间}, 没有剩下的任务时没有第3项
+PROMOTE_DELAYED_SCRIPT = register_script('ztq:promote_delayed', """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local moved = 0
+for i, task_md5 in ipairs(due) do
+    redis.call('ZREM', KEYS[1], task_md5)
+    local task = redis.call('HGET', KEYS[2], task_md5)
+    local level = redis.call('HGET', KEYS[7], task_md5)
+    if level then
+        redis.call('HDEL', KEYS[7], task_md5)
+        -- 队列已经没有这个优先级了, 放到默认优先级
+        if not KEYS[8 + tonumber(level)] then
+            level = nil
+        end
+    end
+    if task then
+        redis.call('HDEL', KEYS[2], task_md5)
+        if redis.call('HSET', KEYS[4], task_md5, task) == 1 then
+            if level then
+                redis.call('HSET', KEYS[8], task_md5, level)
+                redis.call('LPUSH', KEYS[8 + tonumber(level)], task_md5)
+            else
+                redis.call('LPUSH', KEYS[3], task_md5)
+            end
+            moved = moved + 1
+        end
+    end
+end
+if moved > 0 and ARGV[3] ~= '' then
+    redis.call('SADD', KEYS[5], ARGV[3])
+end
+local head = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+if #head == 0 then
+    redis.call('ZREM', KEYS[6], ARGV[4])
+    return {moved, #due}
+end
+redis.call('ZADD', KEYS[6], head[2], ARGV[4])
+return {moved, #due, head[2]}
+""")
+
+# 重做错误队列中的任务: 从出队端取出客户端读到的一批, 换成重置了运行信息的任务,
+# 放回任务队列, 或者间隔一段时间依次放到延时任务中
+# KEYS[1]: error queue, KEYS[2]: error hash, KEYS[3]: task queue, KEYS[4]: task hash, KEYS[5]: 队列的登记集合,
+# KEYS[6]: delayed 有序集合, KEYS[7]: delayed hash, KEYS[8]: 延时索引, KEYS[9]: 信号列表
+# ARGV[1]: 登记的队列名, ARGV[2]: 队列名
+# ARGV[3]: 第一个任务的到期时间, 为空表示直接放回任务队列, ARGV[4]: 相邻任务到期时间的间隔
+# ARGV[5], ARGV[6] ...: 按出队顺序的 task_md5, 新的任务; 出队端已经不是这个任务时停止
+# 返回 {取出的个数, 重做的个数}
+REDO_ERRORS_SCRIPT = register_script('ztq:redo_errors', """
+local eta = tonumber(ARGV[3])
+local interval = tonumber(ARGV[4])
+local first = eta
+local popped = 0
+local moved = 0
+for i = 5, #ARGV, 2 do
+    local task_md5 = redis.call('RPOP', KEYS[1])
+    if task_md5 ~= ARGV[i] then
+        if task_md5 then
+            redis.call('RPUSH', KEYS[1], task_md5)
+        end
+        break
+    end
+    popped = popped + 1
+    -- 已经被删除了的错误不再重做
+    if redis.call('HDEL', KEYS[2], task_md5) == 1 and ARGV[i + 1] ~= '' then
+        local task = ARGV[i + 1]
+        if not eta then
+            if redis.call('HSET', KEYS[4], task_md5, task) == 1 then
+                redis.call('LPUSH', KEYS[3], task_md5)
+            end
+        else
+            redis.call('HSET', KEYS[7], task_md5, task)
+            redis.call('ZADD', KEYS[6], eta, task_md5)
+            eta = eta + interval
+        end
+        moved = moved + 1
+    end
+end
+if moved == 0 then
+    return {popped, 0}
+end
+if not first then
+    if ARGV[1] ~= '' then
+        redis.call('SADD', KEYS[5], ARGV[1])
+    end
+    return {popped, moved}
+end
+local score = redis.call('ZSCORE', KEYS[8], ARGV[2])
+if not score or first < tonumber(score) then
+    local head = redis.call('ZRANGE', KEYS[8], 0, 0, 'WITHSCORES')
+    redis.call('ZADD', KEYS[8], first, ARGV[2])
+    if #head == 0 or first < tonumber(head[2]) then
+        redis.call('DEL', KEYS[9])
+        redis.call('LPUSH', KEYS[9], first)
+    end
+end
+return {popped, moved}
+""")
+
+# 可靠队列模式出队: task_md5 移到consumer的处理中列表, hash中的task保留到确认完成
+# KEYS[1]: task queue, KEYS[2]: 处理中列表, KEYS[3]: task hash, KEYS[4]: 处理中列表的登记
+# KEYS[5]: 优先级hash(有优先级的队列)
+# ARGV[1]: 1 从右边取, 0 从左边取, 为空表示 ARGV[3] 已经被阻塞方式移到了处理中列表
+# ARGV[2]: 登记的成员, ARGV[3]: task_md5, ARGV[4]: 优先级(有优先级的队列)
+CLAIM_JOB_SCRIPT = register_script('ztq:claim_job', DROP_STALE_LUA + """
+local task_md5 = ARGV[3]
+if ARGV[1] ~= '' then
+    if ARGV[1] == '1' then
+        task_md5 = redis.call('RPOP', KEYS[1])
+    else
+        task_md5 = redis.call('LPOP', KEYS[1])
+    end
+    if not task_md5 then
+        return nil
+    end
+    redis.call('LPUSH', KEYS[2], task_md5)
+end
+redis.call('SADD', KEYS[4], ARGV[2])
+if ARGV[4] and task_md5 ~= '' then
+    if (redis.call('HGET', KEYS[5], task_md5) or '0') ~= ARGV[4] then
+        -- 过期的优先级
+        redis.call('LREM', KEYS[2], 1, task_md5)
+        drop_stale(KEYS[5], 1)
+        return {task_md5, false}
+    end
+    -- 正在处理, 不能再调整优先级
+    redis.call('HSET', KEYS[5], task_md5, '-1')
+end
+local task = redis.call('HGET', KEYS[3], task_md5)
+if not task then
+    -- 任务已经不存在了, 不需要处理
+    redis.call('LREM', KEYS[2], 1, task_md5)
+    if ARGV[4] and task_md5 ~= '' then
+        redis.call('HDEL', KEYS[5], task_md5)
+        drop_stale(KEYS[5], 1)
+    end
+end
+return {task_md5, task}
+""")
+
+# 确认任务完成: 从处理中列表和hash中删除
+# KEYS[1]: 处理中列表, KEYS[2]: task hash, KEYS[3]: 优先级hash
+# ARGV[1]: task_md5
+ACK_JOB_SCRIPT = register_script('ztq:ack_job', """
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+return redis.call('HDEL', KEYS[2], ARGV[1])
+""")
+
+# 心跳已经过期的worker进程, 把它处理中的任务放回到队列(默认优先级)的出队端
+# KEYS[1]: 处理中列表, KEYS[2]: task queue, KEYS[3]: 心跳, KEYS[4]: 处理中列表的登记, KEYS[5]: 优先级hash
+# ARGV[1]: 登记的成员
+REQUEUE_JOB_SCRIPT = register_script('ztq:requeue_job', """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return -1
+end
+local count = 0
+local task_md5 = redis.call('LPOP', KEYS[1])
+while task_md5 do
+    redis.call('HDEL', KEYS[5], task_md5)
+    redis.call('RPUSH', KEYS[2], task_md5)
+    count = count + 1
+    task_md5 = redis.call('LPOP', KEYS[1])
+end
+redis.call('SREM', KEYS[4], ARGV[1])
+return count
+""")
+
+# 调整任务的优先级: task_md5 放到新的优先级列表, 原来位置上的过期了, 出队时跳过, 不需要LREM
+# 过期位置的个数记在优先级hash中, 用于计算队列的实际长度
+# KEYS[1]: task hash, KEYS[2]: 优先级hash, KEYS[3]: 新的优先级列表
+# ARGV[1]: task_md5, ARGV[2]: 新的优先级, ARGV[3]: 1 表示放到出队端
+# 返回1表示调整了, 0表示任务不在队列中、正在处理或者已经是这个优先级
+SET_PRIORITY_SCRIPT = register_script('ztq:set_priority', """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local current = redis.call('HGET', KEYS[2], ARGV[1]) or '0'
+if current == '-1' or current == ARGV[2] then
+    return 0
+end
+if ARGV[2] == '0' then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+end
+if ARGV[3] == '1' then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+else
+    redis.call('LPUSH', KEYS[3], ARGV[1])
+end
+redis.call('HINCRBY', KEYS[2], 'ztq:stale', 1)
+return 1
+""")
+
+# 取得队列的执行许可: 并发数和令牌都满足时才一起占用, 用服务器时间, 所有worker一致
+# KEYS[1]: 令牌桶hash, KEYS[2]: 信号量有序集合
+# ARGV[1]: 每秒的令牌数, 为空表示不限速, ARGV[2]: 令牌桶容量, ARGV[3]: 需要的令牌数
+# ARGV[4]: 最大并发数, 为空表示不限制, ARGV[5]: 租约秒数, ARGV[6]...: 持有者, 每个任务一个, 可以没有
+# 返回 {0, 0} 表示取得了, {1, 秒数} 表示并发数满了, 最早的租约还有多久过期, {2, 秒数} 表示还要等多久才有足够的令牌
+ACQUIRE_CAPACITY_SCRIPT = register_script('ztq:acquire_capacity', """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local limit = tonumber(ARGV[4])
+if limit and #ARGV > 5 then
+    -- 清除过期的租约, 已经持有的再次取得时只是续租
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    local used = redis.call('ZCARD', KEYS[2])
+    for i = 6, #ARGV do
+        if not redis.call('ZSCORE', KEYS[2], ARGV[i]) then
+            used = used + 1
+        end
+    end
+    if used > limit then
+        local head = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+        return {1, tostring(tonumber(head[2]) - now)}
+    end
+end
+local rate = tonumber(ARGV[1])
+local count = tonumber(ARGV[3])
+if rate and count > 0 then
+    local burst = tonumber(ARGV[2])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    tokens = math.min(burst, tokens + elapsed * rate)
+    if tokens < count then
+        return {2, tostring((count - tokens) / rate)}
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens - count), 'ts', tostring(now))
+    -- 令牌桶装满之后就和不存在一样了
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+end
+if limit then
+    for i = 6, #ARGV do
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[5]), ARGV[i])
+    end
+end
+return {0, '0'}
+""")
+
+# 释放并发数, 释放了几个就通知几个等待的工作线程
+# KEYS[1]: 信号量有序集合, KEYS[2]: 信号列表
+# ARGV[1]: 最大并发数, 信号最多这么多个, ARGV[2]...: 持有者
+# 返回释放的个数
+RELEASE_CAPACITY_SCRIPT = register_script('ztq:release_capacity', """
+local released = 0
+for i = 2, #ARGV do
+    if redis.call('ZREM', KEYS[1], ARGV[i]) == 1 then
+        redis.call('LPUSH', KEYS[2], 1)
+        released = released + 1
+    end
+end
+if released > 0 then
+    redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[1]) - 1)
+end
+return released
+""")
+
 def register(func, func_name = None):
     """ 注册task
 
@@ -33,7 +580,50 @@ def split_full_func_name(full_func_name):
     else:
         return splitted_func_name
 
+def split_queue_names(queue_spec):
+    """ 一个工作线程可以同时监视多个队列, 多个队列用逗号分开, 按优先级排序::
+
+        'mail,default,index'
+
+    也可以给队列指定权重, 每次取任务时按权重随机决定优先顺序::
+
+        'mail*3,default*1'
+
+    返回 [(queue_name, weight), ...], 没有指定权重时weight为None
+    """
+    queues = []
+    for queue_name in queue_spec.split(','):
+        queue_name = queue_name.strip()
+        if not queue_name: continue
+        weight = None
+        if '*' in queue_name:
+            queue_name, weight = queue_name.rsplit('*', 1)
+            queue_name, weight = queue_name.strip(), max(int(weight), 0)
+        queues.append((queue_name, weight))
+    return queues
+
+def order_queue_names(queues):
+    """ 得到这次取任务时队列的优先顺序
+
+    queues 是 split_queue_names 的返回值, 没有权重的按原来顺序, 有权重时按权重随机排序
+    """
+    if not [weight for queue_name, weight in queues if weight is not None]:
+        return [queue_name for queue_name, weight in queues]
+
+    pending = [(queue_name, 1 if weight is None else weight) 
+                    for queue_name, weight in queues]
+    ordered = []
+    while pending:
+        point = random.uniform(0, sum(weight for queue_name, weight in pending))
+        for index, (queue_name, weight) in enumerate(pending):
+            point -= weight
+            if point <= 0 and weight: break
+        ordered.append(pending.pop(index)[0])
+    return ordered
+
 def gen_task(func_name, *args, **kw):
+    key = kw.pop('ztq_key', None)
+
     callback = kw.pop('ztq_callback', '')
     callback_args = kw.pop('ztq_callback_args', ()) 
     callback_kw = kw.pop('ztq_callback_kw', {})
@@ -45,7 +635,7 @@ def gen_task(func_name, *args, **kw):
     pcallback = kw.pop('ztq_pcallback', '')
     pcallback_args = kw.pop('ztq_pcallback_args', ()) 
     pcallback_kw = kw.pop('ztq_pcallback_kw', {})
-    return {'func':func_name,
+    task = {'func':func_name,
                 'args':args,
                 'kw':kw, 
 
@@ -61,18 +651,177 @@ def gen_task(func_name, *args, **kw):
                 'pcallback_args':pcallback_args,
                 'pcallback_kw':pcallback_kw,
             }
+    # 去重的key, 只在指定的时候才有
+    if key is not None: task['key'] = key
+    return task
+
+# 任务标识的计算方法, 输入是任务(不含runtime)规范化的json
+IDENTITY_METHODS = {
+        'md5': lambda value: md5(value).digest(),
+        # 比md5快, 不同的任务有很小的概率被当作同一个任务
+        'crc32': lambda value: struct.pack('>i', zlib.crc32(value)),
+        }
+
+# 队列的任务标识方式, queue_name -> 'md5' | 'crc32' | 'server'
+QUEUE_IDENTITY = {}
 
-def _get_task_md5(task):
-    """ 得到task(dict) 的md5值 """
-    #_value = json.dumps(task, sort_keys=True)
-    _value = dump_method['json'](task)
+def set_queue_identity(queue_name, method):
+    """ 设置队列的任务标识方式
 
-    return md5(_value).digest()
+    - md5: 默认, 整个任务规范化json的md5, 相同的任务在队列中只有一个
+    - crc32: 用crc32代替md5
+    - server: 由服务端生成递增的id, 不去重, 不需要序列化整个任务
+
+    加入任务时指定了 ztq_key 的, 总是用key的md5作为标识, 只按key去重::
+
+        send_mail(to, body, ztq_key=to)
+    """
+    if method != 'server' and method not in IDENTITY_METHODS:
+        raise ValueError('unknown task identity method: %s' % method)
+    QUEUE_IDENTITY[queue_name] = method
+
+def get_task_id(queue_name, task):
+    """ 得到task(dict) 的标识(task_md5), 不包括runtime和process, 返回''表示由服务端生成 """
+    key = task.get('key', None)
+    if key is not None:
+        if isinstance(key, unicode): key = key.encode('utf-8')
+        return md5(str(key)).digest()
+
+    method = QUEUE_IDENTITY.get(queue_name, 'md5')
+    if method == 'server': return ''
+    task = dict((name, value) for name, value in task.iteritems() 
+                    if name not in ('runtime', 'process'))
+    return IDENTITY_METHODS[method](dump_method['json'](task))
 
 def push_buffer_task(full_func_name, *args, **kw):
+    """ 加入buffer队列, 由buffer线程根据任务队列的拥塞情况放到任务队列
+
+    和任务队列一样, buffer中是task_md5的列表和hash, 相同的任务只有一个
+    """
     queue_name, func_name = split_full_func_name(full_func_name)
+    if _pop_eta(kw) is not None:
+        # buffer按任务队列的拥塞情况放入, 不能再按时间放入
+        raise ValueError('buffer task does not support ztq_eta or ztq_countdown, use push_task')
     task = gen_task(func_name, *args, **kw)
-    model.get_buffer_queue(queue_name).push(task)
+    task_md5 = get_task_id(queue_name, task)
+    task['runtime'] = {'create':int(time.time()), 'queue':queue_name}
+
+    buffer_queue = model.get_buffer_queue(queue_name)
+    system = buffer_queue.system
+    client = get_redis(system)
+    pipe = client.pipeline(transaction=False)
+    _push_job(model.get_buffer_hash(queue_name), buffer_queue, task_md5, task, client=pipe)
+    _signal_buffer(queue_name, False, client=pipe)
+    return execute_pipeline(pipe, client)[0]
+
+def get_queue_length(queue_name, system=None):
+    """ 队列中等待执行的任务数, 不指定system时是所有分片的合计
+
+    有优先级的队列是各个优先级列表的长度减去其中过期的位置(见 model.get_priority_hash)
+    """
+    systems = [system] if system else model.get_queue_systems(queue_name)
+    levels = model.get_queue_priorities(queue_name)
+    length = 0
+    for system in systems:
+        queues = [model.get_task_queue(queue_name, system, priority) for priority in range(levels)]
+        if levels == 1:
+            length += len(queues[0])
+            continue
+        pipe = get_redis(system).pipeline(transaction=False)
+        for queue in queues:
+            pipe.llen(queue.name)
+        pipe.hget(model.get_priority_hash(queue_name, system).name, model.PRIORITY_STALE_FIELD)
+        values = pipe.execute()
+        length += max(sum(values[:-1]) - int(values[-1] or 0), 0)
+    return length
+
+def signal_buffer(queue_name):
+    """ 任务队列有了空位(任务完成了), 如果buffer中有任务, 通知buffer线程 """
+    return _signal_buffer(queue_name, True)
+
+def _signal_buffer(queue_name, only_pending, client=None):
+    system = model.get_queue_system(queue_name)
+    return SIGNAL_BUFFER_SCRIPT(
+            keys=(model.get_buffer_queue(queue_name, system).name, 
+                  model.get_buffer_signal_queue(queue_name, system).name),
+            args=(only_pending and 1 or 0,), system=system, client=client)
+
+def wait_buffer_signal(queue_names, timeout=0):
+    """ 阻塞等待这些buffer队列的信号, 返回收到信号的队列名, 超时返回None
+
+    只在这些队列的信号列表上等待, 不会取走其他buffer线程管理的队列的信号;
+    取出信号之后再加入的信号会留在列表中, 不会丢失。
+    多个system时轮流在每个system上等待一小段时间
+    """
+    groups = {}
+    for queue_name in queue_names:
+        groups.setdefault(model.get_queue_system(queue_name), []).append(queue_name)
+    systems = _rotate(sorted(groups))
+    wait = timeout
+    if len(systems) > 1:
+        wait = SHARD_POP_TIMEOUT if not timeout else min(timeout, SHARD_POP_TIMEOUT)
+    for system in systems:
+        signal_queues = [model.get_buffer_signal_queue(queue_name, system).name 
+                            for queue_name in groups[system]]
+        popped = get_blocking_redis(system).brpop(signal_queues, wait)
+        if popped:
+            return groups[system][signal_queues.index(popped[0])]
+    return None
+
+def _wait_signal(get_signal_queue, systems, timeout=0):
+    """ 在各个system的信号列表上阻塞等待, 返回 (system, 信号), 超时返回 (None, None) """
+    systems = _rotate(list(systems))
+    wait = timeout
+    if len(systems) > 1:
+        wait = SHARD_POP_TIMEOUT if not timeout else min(timeout, SHARD_POP_TIMEOUT)
+    for system in systems:
+        signal_queue = get_signal_queue(system)
+        popped = get_blocking_redis(system).brpop(signal_queue.name, wait)
+        if popped:
+            return system, popped[1]
+    return None, None
+
+def promote_buffer(queue_name, limit):
+    """ 把buffer中的任务放到任务队列, 任务队列(所有分片)中最多limit个任务
+
+    一次往返原子的完成; 分布在多个分片上的队列, 任务取出后由客户端按任务标识放到各个分片
+    返回放到任务队列的任务数
+    """
+    systems = model.get_queue_systems(queue_name)
+    system = systems[0]
+    spread = len(systems) > 1
+    others = 0
+    if spread:
+        others = sum(get_queue_length(queue_name, other) for other in systems[1:])
+
+    buffer_queue = model.get_buffer_queue(queue_name, system)
+    buffer_hash = model.get_buffer_hash(queue_name, system)
+    task_queue = model.get_task_queue(queue_name, system)
+    registry, registered_name = model.get_queue_registry(task_queue.name)
+    keys = (buffer_queue.name, buffer_hash.name, task_queue.name, 
+            model.get_task_hash(queue_name, system).name, registry)
+    levels = model.get_queue_priorities(queue_name)
+    if levels > 1:
+        keys += (model.get_priority_hash(queue_name, system).name,) + tuple(
+                model.get_task_queue(queue_name, system, priority).name 
+                    for priority in range(1, levels))
+    result = BUFFER_MOVE_SCRIPT(keys=keys, 
+            args=(limit, others, registered_name, spread and 1 or 0), system=system)
+
+    moved, values = result[0], result[1:]
+    jobs = []
+    for task_md5, value in zip(values[::2], values[1::2]):
+        if task_md5:
+            task = buffer_hash.loads(value)
+        else:
+            # 老格式的buffer, 列表中是整个任务
+            task = buffer_queue.loads(value)
+            task.setdefault('runtime', {'create':int(time.time()), 'queue':queue_name})
+            task_md5 = get_task_id(queue_name, task)
+        jobs.append((task_md5, task))
+    if jobs:
+        moved += len([pushed for pushed in _push_jobs(queue_name, jobs) if pushed])
+    return moved
 
 def push_task(full_func_name, *args, **kw):
     """
@@ -82,24 +831,348 @@ def push_task(full_func_name, *args, **kw):
 
      task_regitry.push(u'foo:echo', aaa, bb, foo='bar', 
             callback='foo:callback', callback_args=(12,32,3), callback_kw={}) 
+
+    ztq_eta(时间戳) 或 ztq_countdown(秒) 指定到期时间, 先放到延时任务中,
+    到期后由延时任务线程放到任务队列::
+
+     push_task(u'foo:echo', aaa, ztq_countdown=60)
+
+    ztq_priority 指定优先级, 队列需要先设置优先级个数(set_queue_priorities)::
+
+     push_task(u'foo:echo', aaa, ztq_priority=2)
     """
     queue_name, func_name = split_full_func_name(full_func_name)
     to_right = kw.pop('ztq_first', False)
+    priority = kw.pop('ztq_priority', 0)
+    eta = _pop_eta(kw)
     # 队列运行相关信息
     runtime = kw.pop('runtime', \
             {'create':int(time.time()), 'queue':queue_name})
 
     task = gen_task(func_name, *args, **kw)
-    task_md5 = _get_task_md5(task)
-
-    task_hash = model.get_task_hash(queue_name)
+    task_md5 = get_task_id(queue_name, task)
 
-    # 因为queue队列有worker不停在监视,必须先将hash的内容push,在将queue的内容push
     task['runtime'] = runtime
-    if task_hash.__setitem__(task_md5, task) == 1:
-        # 如果返回值等于0， 说明task_md5已经存在
-        queue = model.get_task_queue(queue_name)
-        queue.push(task_md5, to_left=not to_right)
+    system = model.get_queue_system(queue_name, task_md5)
+    queue, priority_hash = _get_priority_queue(queue_name, system, priority)
+    if eta is not None and eta > time.time():
+        return _delay_job(queue_name, system, task_md5, task, eta, priority=priority)
+    return _push_job(model.get_task_hash(queue_name, system), 
+            queue, task_md5, task, not to_right, 
+            priority_hash=priority_hash, priority=priority)
+
+def _pop_eta(kw):
+    """ 从参数中取出 ztq_eta 或 ztq_countdown, 返回到期的时间戳, 没有指定时返回None """
+    eta = kw.pop('ztq_eta', None)
+    countdown = kw.pop('ztq_countdown', None)
+    if countdown is not None:
+        eta = time.time() + countdown
+    return eta
+
+def _get_priority_queue(queue_name, system, priority=0):
+    """ 返回 (优先级对应的任务列表, 优先级hash), 没有设置优先级的队列优先级hash为None """
+    levels = model.get_queue_priorities(queue_name)
+    if not 0 <= priority < levels:
+        raise ValueError('queue %s has no priority %s' % (queue_name, priority))
+    if levels == 1:
+        return model.get_task_queue(queue_name, system), None
+    return (model.get_task_queue(queue_name, system, priority), 
+            model.get_priority_hash(queue_name, system))
+
+def set_task_priority(queue_name, task_md5, priority, to_front=False):
+    """ 调整队列中任务的优先级, 常数时间完成, 不需要在列表中查找删除
+
+    to_front 表示放到新优先级的出队端, 否则放到入队端
+    返回是否调整了, 任务不在队列中、正在处理或者已经是这个优先级时返回False
+    """
+    system = model.get_queue_system(queue_name, task_md5)
+    queue, priority_hash = _get_priority_queue(queue_name, system, priority)
+    if priority_hash is None:
+        raise ValueError('queue %s has no priority levels' % queue_name)
+    return bool(SET_PRIORITY_SCRIPT(
+            keys=(model.get_task_hash(queue_name, system).name, priority_hash.name, queue.name),
+            args=(task_md5, priority, to_front and 1 or 0), system=system))
+
+def _delay_job(queue_name, system, task_md5, task, eta, client=None, priority=0):
+    """ 加入延时任务, 到期后放到priority优先级, 返回1表示新加入, 0表示已经存在 """
+    delayed_hash = model.get_delayed_hash(queue_name, system)
+    return DELAY_JOB_SCRIPT(
+            keys=(delayed_hash.name, model.get_delayed_set(queue_name, system).name, 
+                  model.get_task_id_key(), model.get_delayed_index(system).name, 
+                  model.get_delayed_signal_queue(system).name, 
+                  model.get_delayed_priority_hash(queue_name, system).name),
+            args=(task_md5, delayed_hash.dumps(task), repr(float(eta)), queue_name, 
+                  model.get_task_id_suffix(queue_name, system), priority),
+            system=system, client=client)
+
+# 延时任务每次脚本移动的个数, 每次移动的队列数
+DELAYED_BATCH_SIZE = 500
+DELAYED_QUEUE_BATCH = 100
+
+def promote_delayed(system='default', batch_size=DELAYED_BATCH_SIZE):
+    """ 把这个system上到期的延时任务放到任务队列
+
+    索引中只有到期的队列会被处理, 每个队列每次脚本最多移动 batch_size 个, 不会扫描没有到期的任务
+    返回 (移动的个数, 最早的到期时间), 没有延时任务时到期时间为None
+    """
+    index = model.get_delayed_index(system)
+    moved = 0
+    while True:
+        now = time.time()
+        queue_names = index.range_by_score('-inf', now, start=0, num=DELAYED_QUEUE_BATCH)
+        if not queue_names: break
+        for queue_name in queue_names:
+            task_queue = model.get_task_queue(queue_name, system)
+            registry, registered_name = model.get_queue_registry(task_queue.name)
+            keys = (model.get_delayed_set(queue_name, system).name, 
+                    model.get_delayed_hash(queue_name, system).name, 
+                    task_queue.name, model.get_task_hash(queue_name, system).name, 
+                    registry, index.name, 
+                    model.get_delayed_priority_hash(queue_name, system).name)
+            levels = model.get_queue_priorities(queue_name)
+            if levels > 1:
+                keys += (model.get_priority_hash(queue_name, system).name,) + tuple(
+                        model.get_task_queue(queue_name, system, priority).name 
+                            for priority in range(1, levels))
+            while True:
+                result = PROMOTE_DELAYED_SCRIPT(keys=keys, 
+                        args=(repr(now), batch_size, registered_name, queue_name), system=system)
+                moved += result[0]
+                if result[1] < batch_size: break
+
+    first = index.first()
+    return moved, first[1] if first is not None else None
+
+def retry_task(queue_name, task, countdown):
+    """ 出错的任务 countdown 秒后重试, 放到延时任务中, 到期后还是出队时的优先级 """
+    task_md5 = get_task_id(queue_name, task)
+    system = model.get_queue_system(queue_name, task_md5)
+    priority = min(task.get('runtime', {}).get('priority', 0), 
+                   model.get_queue_priorities(queue_name) - 1)
+    return _delay_job(queue_name, system, task_md5, task, time.time() + countdown, 
+                      priority=priority)
+
+def _set_runtime_priority(task, priority):
+    """ 有优先级的队列, 在runtime中记录任务出队时的优先级, 重试时放回这个优先级 """
+    priority = int(priority)
+    if priority:
+        task.setdefault('runtime', {})['priority'] = priority
+    else:
+        task.get('runtime', {}).pop('priority', None)
+    return task
+
+# 重做错误队列时, 每次脚本处理的个数
+REDO_BATCH_SIZE = 1000
+
+def redo_errors(queue_name, rate=None, batch_size=REDO_BATCH_SIZE):
+    """ 把错误队列的任务放回任务队列重做, 每批在服务端原子的完成
+
+    任务的运行信息(出错原因、worker、结束时间等)重置为新加入队列的任务, 需要在客户端解码
+    rate 为每秒放回的任务数, 指定后按这个速度依次放到延时任务中, 避免大量任务同时涌向worker
+    返回重做的任务数
+    """
+    interval = 1.0 / rate if rate else 0
+    start = time.time()
+    redone = 0
+    for system in model.get_queue_systems(queue_name):
+        error_queue = model.get_error_queue(queue_name, system)
+        error_hash = model.get_error_hash(queue_name, system)
+        task_hash = model.get_task_hash(queue_name, system)
+        task_queue = model.get_task_queue(queue_name, system)
+        registry, registered_name = model.get_queue_registry(task_queue.name)
+        keys = (error_queue.name, error_hash.name, 
+                task_queue.name, task_hash.name, registry, 
+                model.get_delayed_set(queue_name, system).name, 
+                model.get_delayed_hash(queue_name, system).name, 
+                model.get_delayed_index(system).name, 
+                model.get_delayed_signal_queue(system).name)
+        client = get_redis(system)
+        while True:
+            # 出队端的一批, 按出队的顺序
+            task_md5s = client.lrange(error_queue.name, -batch_size, -1)[::-1]
+            if not task_md5s: break
+            values = client.hmget(error_hash.name, task_md5s)
+            args = []
+            for task_md5, value in zip(task_md5s, values):
+                try:
+                    task = error_hash.loads(value) if value is not None else None
+                except:
+                    task = None
+                if task is not None:
+                    task['runtime'] = {'queue':queue_name, 'create':int(time.time())}
+                    value = task_hash.dumps(task)
+                else:
+                    value = ''
+                args.extend((task_md5, value))
+
+            eta = repr(start + redone * interval) if rate else ''
+            popped, count = REDO_ERRORS_SCRIPT(keys=keys, 
+                    args=(registered_name, queue_name, eta, repr(interval)) + tuple(args), 
+                    system=system)
+            redone += count
+            # 没有取完时错误队列被修改了, 重新读取
+            if not popped: break
+    return redone
+
+def wait_delayed_signal(systems=('default',), timeout=0):
+    """ 阻塞等待加入了更早到期的延时任务, 返回这个system, 超时返回None """
+    return _wait_signal(model.get_delayed_signal_queue, systems, timeout)[0]
+
+# 并发数的默认租约秒数, 超过的任务可能让并发数超出限制
+CONCURRENCY_LEASE = 600
+
+def _get_capacity_holders(holder, count, concurrency):
+    """ 每个任务占用一个并发数, 持有者是 holder, holder#1, holder#2 ...
+
+    一次执行的任务数超过了并发数时, 最多占用全部的并发数
+    """
+    count = min(count, concurrency)
+    return [holder] + ['%s#%d' % (holder, index) for index in range(1, count)]
+
+def acquire_capacity(queue_name, holder, count=1, timeout=0, acquired=None):
+    """ 按队列配置的限流(见 model.set_queue_limits), 取得执行count个任务的许可
+
+    holder 是持有者的唯一标识(worker进程:线程名)。
+    每个任务占用一个并发数、一个令牌, 先一起取得并发数和令牌桶容量以内的令牌, 超过容量的令牌之后分几次取得。
+    并发数满了在信号列表上阻塞等待释放, 令牌不够时睡眠到有足够的令牌, 不会空转。
+    acquired 是这个持有者已经取得的许可时, 再补足到count个任务, 没有取得时原来的许可不变。
+    timeout 小于0不等待, 0 一直等待。
+    返回取得的许可 (任务数, 最大并发数, 持有者), 执行完把它传给 release_capacity; 没有取得时返回None
+    """
+    held_count, held_concurrency, held = acquired or (0, None, ())
+    limits = model.get_queue_limits(queue_name)
+    if not limits: return (count, held_concurrency, held)
+
+    rate = limits.get('rate_limit', None)
+    burst = limits.get('rate_burst', None) or max(rate or 0, 1)
+    concurrency = limits.get('concurrency', None)
+    lease = limits.get('concurrency_lease', None) or CONCURRENCY_LEASE
+    holders = _get_capacity_holders(holder, count, concurrency) if concurrency else []
+    # 已经持有的再次取得时只是续租, 不占用新的并发数
+    acquiring = [name for name in holders if name not in held]
+    keys = (model.get_rate_bucket_key(queue_name), model.get_semaphore_set(queue_name).name)
+    deadline = time.time() + timeout if timeout > 0 else None
+    # 还需要的令牌数
+    remaining = max(count - held_count, 0) if rate else 0
+    first = True
+    while True:
+        # 一次要的令牌不能超过令牌桶的容量
+        tokens = min(remaining, burst)
+        status, wait = ACQUIRE_CAPACITY_SCRIPT(keys=keys, 
+                args=(rate or '', burst, tokens, concurrency or '', lease) + 
+                     tuple(holders if first else ()))
+        if not status:
+            remaining -= tokens
+            # 之后只需要取令牌
+            first = False
+            if remaining <= 0:
+                return (count, concurrency or held_concurrency, 
+                        tuple(held) + tuple(acquiring))
+            continue
+
+        if timeout < 0 or (deadline is not None and deadline <= time.time()):
+            if not first:
+                # 只取得了一部分令牌, 放弃新取得的并发数
+                release_capacity(queue_name, (count, concurrency, acquiring))
+            return None
+
+        wait = float(wait)
+        if deadline is not None:
+            wait = min(wait, deadline - time.time())
+        if status == 1:
+            # 阻塞等待释放的信号, 最多等到最早的租约过期, 阻塞时间只能是整数秒
+            signal_queue = model.get_semaphore_signal_queue(queue_name)
+            get_blocking_redis().brpop(signal_queue.name, max(1, int(math.ceil(wait))))
+        else:
+            time.sleep(wait)
+
+def release_capacity(queue_name, capacity):
+    """ 任务执行完, 释放 acquire_capacity 取得的许可占用的并发数, 返回释放的个数
+
+    按取得时的并发数和持有者释放, 中间修改了队列的限流配置也不会释放错
+    """
+    if not capacity: return 0
+    count, concurrency, holders = capacity
+    if not concurrency or not holders: return 0
+    keys = (model.get_semaphore_set(queue_name).name, 
+            model.get_semaphore_signal_queue(queue_name).name)
+    return RELEASE_CAPACITY_SCRIPT(keys=keys, args=(concurrency,) + tuple(holders))
+
+# 批量加入队列时, 每次pipeline发送的任务数
+PUSH_CHUNK_SIZE = 500
+
+def push_tasks(full_func_name, tasks, **kw):
+    """ 批量加入队列, tasks 是 (args, kw) 的序列
+
+    按 ztq_chunk_size 分块, 每块通过一个pipeline一次往返发送,
+    kw 中的参数(比如回调、ztq_first)对全部任务有效::
+
+     push_tasks(u'foo:echo', [((1,), {}), ((2,), {'c':3})], ztq_chunk_size=1000)
+
+    ztq_eta 或 ztq_countdown 可以对全部任务指定, 也可以在单个任务的kw中指定,
+    到期时间在将来的任务放到延时任务中::
+
+     push_tasks(u'foo:echo', [((1,), {}), ((2,), {'ztq_countdown':60})])
+
+    返回每个任务是否新加入了队列的列表, False 说明这个任务已经存在
+    """
+    queue_name, func_name = split_full_func_name(full_func_name)
+    to_right = kw.pop('ztq_first', False)
+    priority = kw.pop('ztq_priority', 0)
+    chunk_size = kw.pop('ztq_chunk_size', PUSH_CHUNK_SIZE)
+    eta = _pop_eta(kw)
+
+    results = []
+    tasks = iter(tasks)
+    while True:
+        chunk = list(islice(tasks, chunk_size))
+        if not chunk: break
+
+        jobs, etas = [], []
+        for args, task_kw in chunk:
+            item_kw = dict(kw)
+            item_kw.update(task_kw)
+            item_eta = _pop_eta(item_kw)
+            runtime = item_kw.pop('runtime', \
+                    {'create':int(time.time()), 'queue':queue_name})
+            task = gen_task(func_name, *args, **item_kw)
+            task_md5 = get_task_id(queue_name, task)
+            task['runtime'] = runtime
+            jobs.append((task_md5, task))
+            etas.append(item_eta if item_eta is not None else eta)
+
+        results.extend(bool(result) for result in 
+                _push_jobs(queue_name, jobs, not to_right, priority, etas))
+    return results
+
+def _push_jobs(queue_name, jobs, to_left=True, priority=0, etas=None):
+    """ jobs 是 (task_md5, task) 的列表, 每个system用一个pipeline发送
+
+    etas 是对应的到期时间列表, 到期时间在将来的放到延时任务中
+    返回按jobs顺序排列的 _push_job(或 _delay_job) 的结果
+    """
+    pipes = {}
+    now = time.time()
+    for index, (task_md5, task) in enumerate(jobs):
+        system = model.get_queue_system(queue_name, task_md5)
+        if system not in pipes:
+            pipes[system] = (get_redis(system).pipeline(transaction=False), [])
+        pipe, indexes = pipes[system]
+        eta = etas[index] if etas is not None else None
+        if eta is not None and eta > now:
+            _delay_job(queue_name, system, task_md5, task, eta, client=pipe, priority=priority)
+        else:
+            queue, priority_hash = _get_priority_queue(queue_name, system, priority)
+            _push_job(model.get_task_hash(queue_name, system), queue, 
+                    task_md5, task, to_left, client=pipe, 
+                    priority_hash=priority_hash, priority=priority)
+        indexes.append(index)
+
+    results = [None] * len(jobs)
+    for system, (pipe, indexes) in pipes.items():
+        for index, result in zip(indexes, execute_pipeline(pipe, get_redis(system))):
+            results[index] = result
+    return results
 
 def push_runtime_task(queue_name, task):
     """ 直接将task push 到 redis """
@@ -110,39 +1183,357 @@ def push_runtime_error(queue_name, error):
 
 def _push_runtime_job(queue_name, task, get_hash, get_queue):
     to_left = task.get('kw', {}).pop('to_left', True)
-    runtime = task.pop('runtime') 
+    task_md5 = get_task_id(queue_name, task)
+    system = model.get_queue_system(queue_name, task_md5)
+    return _push_job(get_hash(queue_name, system), get_queue(queue_name, system), 
+            task_md5, task, to_left)
 
-    task_md5 = _get_task_md5(task)
-    task_hash = get_hash(queue_name)
+def _push_job(task_hash, queue, task_md5, task, to_left=True, client=None, 
+        priority_hash=None, priority=0):
+    """ 在服务端原子的完成 hash写入 和 队列push
 
-    # 因为queue队列有worker不停在监视,必须先将hash的内容push,在将queue的内容push
-    task['runtime'] = runtime
-    if task_hash.__setitem__(task_md5, task) == 1:
-        # 如果返回值等于0， 说明task_md5已经存在
-        queue = get_queue(queue_name)
-        queue.push(task_md5, to_left=to_left)
+    返回1表示新加入了队列, 返回0说明task_md5已经存在
+    task_md5 为''时由服务端生成递增的id
+    client 可以是一个pipeline
+    有优先级的队列, queue 是优先级对应的列表, 同时在priority_hash中记录优先级
+    """
+    registry, queue_name = model.get_queue_registry(queue.name)
+    keys = (task_hash.name, queue.name, model.get_task_id_key(), registry or queue.name)
+    args = (task_md5, task_hash.dumps(task), to_left and 1 or 0, queue_name or '')
+    if priority_hash is not None:
+        keys += (priority_hash.name,)
+        args += (priority,)
+    suffix = model.get_task_id_suffix(queue_name, task_hash.system) \
+                if not task_md5 and queue_name else ''
+    if suffix:
+        # 生成的id带上所在的system, 之后按id找到这个system
+        if priority_hash is None: args += ('',)
+        args += (suffix,)
+    return PUSH_JOB_SCRIPT(keys=keys, args=args, system=task_hash.system, client=client)
 
 def pop_task(queue_name, task_md5=None, timeout=0, from_right=True):
     """ 取出，并删除 """
     return _pop_job(queue_name, task_md5, 
-            model.get_task_hash, model.get_task_queue, timeout, from_right)
+            model.get_task_hash, model.get_task_queue, timeout, from_right, priorities=True)
+
+def pop_any_task(queue_names, timeout=0, from_right=True):
+    """ 从多个队列中取出一个任务, 排在前面的队列优先
+
+    队列都为空时, 用一个BRPOP同时阻塞等待所有的队列。
+    队列在不同的system上时, 只在同一个system上的队列之间保证优先顺序
+    返回 (queue_name, task), 超时返回 (None, None)
+    """
+    return _pop_any_job(queue_names, 
+            model.get_task_hash, model.get_task_queue, timeout, from_right, priorities=True)
+
+def pop_tasks(queue_name, count, timeout=0, from_right=True):
+    """ 一次往返取出最多count个任务, 用于预取
+
+    队列为空时, 和pop_task一样阻塞等待一个任务(timeout小于0时不等待)
+    返回按出队顺序排列的任务列表, 超时返回空列表;
+    取到了用来唤醒工作线程的空任务时, 不再阻塞等待, 让工作线程检查是否需要退出
+    """
+    levels = model.get_queue_priorities(queue_name)
+    woken = False
+    for system in _rotate(model.get_queue_systems(queue_name)):
+        task_hash = model.get_task_hash(queue_name, system)
+        # 从高到低, 每个优先级一次往返, 高优先级的不够时用低优先级的补足
+        tasks = []
+        for priority in range(levels - 1, -1, -1):
+            queue, priority_hash = _get_priority_queue(queue_name, system, priority)
+            keys = (queue.name, task_hash.name)
+            args = (count - len(tasks), from_right and 1 or 0)
+            if priority_hash is not None:
+                keys += (priority_hash.name,)
+                args += (priority,)
+            values = POP_JOBS_SCRIPT(keys=keys, args=args, system=system)
+            woken = woken or values[0] == 1
+            if priority_hash is not None:
+                tasks.extend(_set_runtime_priority(task_hash.loads(value), priority) 
+                                for value in values[1:])
+            else:
+                tasks.extend(task_hash.loads(value) for value in values[1:])
+            if len(tasks) >= count: break
+        if tasks: return tasks
+
+    if timeout < 0 or woken: return []
+    task = pop_task(queue_name, timeout=timeout, from_right=from_right)
+    return [task] if task is not None else []
+
+def requeue_tasks(queue_name, tasks, from_right=True):
+    """ 把预取了但是没有执行的任务放回队列的出队端, 保持原来的出队顺序
+
+    from_right 是取任务时的方向, 每个system用一个pipeline发送
+    """
+    # 后出队的先放回去
+    _push_jobs(queue_name, [(get_task_id(queue_name, task), task) 
+                                for task in reversed(tasks)], not from_right)
 
 def pop_error(queue_name, task_md5=None, timeout=0, from_right=True):
     return _pop_job(queue_name, task_md5, 
             model.get_error_hash, model.get_error_queue, timeout, from_right)
 
-def _pop_job(queue_name, task_md5, get_hash, get_queue, timeout=0, from_right=True):
+def _pop_job(queue_name, task_md5, get_hash, get_queue, timeout=0, from_right=True, 
+        priorities=False):
+    """ 出队, 队列pop和hash的取出删除在服务端原子完成
 
-    if not task_md5:
-        task_md5 = get_queue(queue_name).pop(timeout=timeout, \
-                from_right=from_right)
-    else:
-        get_queue(queue_name).remove(task_md5)
+    timeout 小于0 时非阻塞, 一次往返;
+    否则先非阻塞尝试, 队列为空时才阻塞等待, 唤醒后再用一次往返取出task
+    priorities 表示队列可能有多个优先级(任务队列)
+    """
+    if task_md5:
+        system = model.get_queue_system(queue_name, task_md5)
+        task_hash = get_hash(queue_name, system)
+        keys, args = (task_hash.name,), (task_md5, 1)
+        if priorities and model.get_queue_priorities(queue_name) > 1:
+            # 从任务当前优先级的列表中删除
+            priority_hash = model.get_priority_hash(queue_name, system)
+            priority = get_redis(system).hget(priority_hash.name, task_md5) or '0'
+            if priority == '-1': return None # 可靠模式下正在处理
+            queue = get_queue(queue_name, system, int(priority))
+            keys, args = keys + (priority_hash.name,), args + (priority,)
+        else:
+            queue = get_queue(queue_name, system)
+        value = TAKE_JOB_SCRIPT(keys=(queue.name,) + keys, args=args, system=system)
+        if not value: return None
+        task = task_hash.loads(value)
+        return _set_runtime_priority(task, args[2]) if len(args) > 2 else task
+
+    return _pop_any_job([queue_name], get_hash, get_queue, timeout, from_right, 
+            priorities)[1]
+
+# 分片时, 在每个system上阻塞等待的最长时间(秒)
+SHARD_POP_TIMEOUT = 1
+
+_rotate_counter = itertools.count()
+
+def _rotate(systems):
+    """ 轮流从不同的system开始, 让各个分片上的任务都能被取到 """
+    if len(systems) < 2: return systems
+    start = next(_rotate_counter) % len(systems)
+    return systems[start:] + systems[:start]
+
+def _group_by_system(queue_names):
+    """ 按system分组: [(system, [queue_name, ...]), ...], 保持队列的优先顺序 """
+    groups = []
+    for queue_name in queue_names:
+        for system in model.get_queue_systems(queue_name):
+            for group_system, group in groups:
+                if group_system == system: 
+                    group.append(queue_name)
+                    break
+            else:
+                groups.append((system, [queue_name]))
+    return groups
+
+def _pop_any_job(queue_names, get_hash, get_queue, timeout=0, from_right=True, 
+        priorities=False):
+    """ 队列在多个system上时, 轮流非阻塞的取, 都为空时轮流在每个system上阻塞等待一小段时间,
+    一轮之后还没有取到就返回, 这时最多等待 SHARD_POP_TIMEOUT * system数 秒
+    """
+    groups = _rotate(_group_by_system(queue_names))
+    if len(groups) == 1:
+        return _pop_system_job(groups[0][0], groups[0][1], 
+                get_hash, get_queue, timeout, from_right, priorities)
+
+    for system, names in groups:
+        queue_name, task = _pop_system_job(system, names, 
+                get_hash, get_queue, -1, from_right, priorities)
+        if task is not None: return queue_name, task
+    if timeout < 0: return None, None
+
+    deadline = time.time() + timeout
+    for system, names in groups:
+        wait = SHARD_POP_TIMEOUT
+        if timeout:
+            wait = min(wait, int(math.ceil(deadline - time.time())))
+            if wait <= 0: break
+        queue_name, task = _pop_system_job(system, names, 
+                get_hash, get_queue, wait, from_right, priorities)
+        if task is not None: return queue_name, task
+    return None, None
+
+def _pop_system_job(system, queue_names, get_hash, get_queue, timeout=0, from_right=True, 
+        priorities=False):
+    """ 从一个system上的多个队列中取出一个任务
+
+    有优先级的队列展开成从高到低的各个优先级列表, 阻塞等待时也按这个顺序
+    """
+    # (队列名, 列表, hash, 优先级hash的key, 优先级), 没有优先级时优先级为''
+    entries = []
+    for queue_name in queue_names:
+        task_hash = get_hash(queue_name, system)
+        levels = model.get_queue_priorities(queue_name) if priorities else 1
+        if levels == 1:
+            entries.append((queue_name, get_queue(queue_name, system), task_hash, 
+                            task_hash.name, ''))
+            continue
+        priority_key = model.get_priority_hash(queue_name, system).name
+        for priority in range(levels - 1, -1, -1):
+            entries.append((queue_name, get_queue(queue_name, system, priority), task_hash, 
+                            priority_key, str(priority)))
+    queue_keys = [queue.name for queue_name, queue, task_hash, priority_key, priority in entries]
+    keys = []
+    args = [from_right and 1 or 0]
+    for queue_name, queue, task_hash, priority_key, priority in entries:
+        keys.extend((queue.name, task_hash.name, priority_key))
+        args.append(priority)
+
+    while True:
+        popped = POP_JOB_SCRIPT(keys=keys, args=args, system=system)
+        if popped:
+            index, task_md5, value = popped
+            queue_name, task_hash = entries[index - 1][0], entries[index - 1][2]
+            # 空的task_md5是用来唤醒工作线程的
+            if not task_md5: return None, None
+            # hash中已经没有这个任务了，继续取下一个
+            if value is None: continue
+            task = task_hash.loads(value)
+            if entries[index - 1][4]: _set_runtime_priority(task, entries[index - 1][4])
+            return queue_name, task
+
+        if timeout < 0: return None, None
+
+        # 队列都为空，阻塞等待
+        client = get_blocking_redis(system)
+        if from_right:
+            popped = client.brpop(queue_keys, timeout)
+        else:
+            popped = client.blpop(queue_keys, timeout)
+        if not popped: return None, None # 可能超时了
+
+        queue_key, task_md5 = popped
+        if not task_md5: return None, None
+
+        queue_name, queue, task_hash, priority_key, priority = \
+                entries[queue_keys.index(queue_key)]
+        keys, args = (queue_key, task_hash.name), (task_md5, 0)
+        if priority:
+            keys, args = keys + (priority_key,), args + (priority,)
+        value = TAKE_JOB_SCRIPT(keys=keys, args=args, system=system)
+        if not value: return None, None
+        task = task_hash.loads(value)
+        if priority: _set_runtime_priority(task, priority)
+        return queue_name, task
 
-    if not task_md5: return None # 可能超时了
+def claim_task(queue_name, consumer, timeout=0, from_right=True):
+    """ 可靠队列模式的出队
 
-    task_hash = get_hash(queue_name)
-    return task_hash.pop(task_md5)
+    task_md5 被原子的移到consumer的处理中列表, hash中的task一直保留到 ack_task,
+    worker进程在这之间崩溃, 任务会被 requeue_dead_consumers 放回队列。
+    队列为空时使用 BRPOPLPUSH/BLMOVE 阻塞等待
+
+    队列分布在多个system上时, 和 pop_any_task 一样轮流从各个system取;
+    有优先级的队列从高到低依次取, 都为空时在默认优先级上阻塞等待, 每次最多等待 SHARD_POP_TIMEOUT 秒,
+    之后再检查一遍高优先级
+
+    返回 (task_md5, task), 超时返回 (None, None)
+    """
+    systems = _rotate(model.get_queue_systems(queue_name))
+    if len(systems) == 1:
+        return _claim_system_task(systems[0], queue_name, consumer, timeout, from_right)
+
+    for system in systems:
+        task_md5, task = _claim_system_task(system, queue_name, consumer, -1, from_right)
+        if task is not None: return task_md5, task
+    if timeout < 0: return None, None
+
+    deadline = time.time() + timeout
+    for system in systems:
+        wait = SHARD_POP_TIMEOUT
+        if timeout:
+            wait = min(wait, int(math.ceil(deadline - time.time())))
+            if wait <= 0: break
+        task_md5, task = _claim_system_task(system, queue_name, consumer, wait, from_right)
+        if task is not None: return task_md5, task
+    return None, None
+
+def _claim_system_task(system, queue_name, consumer, timeout=0, from_right=True):
+    processing = model.get_processing_queue(queue_name, consumer, system)
+    task_hash = model.get_task_hash(queue_name, system)
+    registry = model.get_processing_set(system)
+    member = registry.dumps([queue_name, consumer])
+    client = get_redis(task_hash.system)
+
+    # 从高到低每个优先级的 (任务列表, 脚本的keys, 优先级参数), 最后一个是默认优先级
+    levels = model.get_queue_priorities(queue_name)
+    entries = []
+    for priority in range(levels - 1, -1, -1):
+        queue = model.get_task_queue(queue_name, system, priority)
+        keys, extra = (queue.name, processing.name, task_hash.name, registry.name), ()
+        if levels > 1:
+            keys += (model.get_priority_hash(queue_name, system).name,)
+            extra = (priority,)
+        entries.append((queue, keys, extra))
+    deadline = time.time() + timeout if timeout > 0 else None
+
+    while True:
+        for queue, keys, extra in entries:
+            claimed = CLAIM_JOB_SCRIPT(keys=keys, 
+                    args=(from_right and 1 or 0, member, '') + extra, client=client)
+            if claimed: break
+        if not claimed:
+            if timeout < 0: return None, None
+
+            # 队列为空，阻塞等待
+            wait = SHARD_POP_TIMEOUT if levels > 1 else timeout
+            if deadline is not None:
+                wait = min(wait, int(math.ceil(deadline - time.time())))
+                if wait <= 0: return None, None
+            blocking_client = get_blocking_redis(task_hash.system)
+            if from_right:
+                task_md5 = blocking_client.brpoplpush(queue.name, processing.name, wait)
+            else:
+                task_md5 = blocking_client.execute_command('BLMOVE', queue.name, 
+                        processing.name, 'LEFT', 'LEFT', wait)
+            if task_md5 is None: 
+                # 超时了, 有优先级时再检查一遍高优先级
+                if levels > 1 and (deadline is None or time.time() < deadline): continue
+                return None, None
+
+            claimed = CLAIM_JOB_SCRIPT(keys=keys, 
+                    args=('', member, task_md5) + extra, client=client)
+
+        task_md5, value = claimed
+        # 空的task_md5是用来唤醒工作线程的
+        if not task_md5: return None, None
+        # hash中已经没有这个任务了，继续取下一个
+        if value is None: continue
+        task = task_hash.loads(value)
+        if extra: _set_runtime_priority(task, extra[0])
+        return task_md5, task
+
+def ack_task(queue_name, task_md5, consumer):
+    """ 可靠队列模式下, 确认任务已经完成 """
+    system = model.get_queue_system(queue_name, task_md5)
+    processing = model.get_processing_queue(queue_name, consumer, system)
+    task_hash = model.get_task_hash(queue_name, system)
+    return ACK_JOB_SCRIPT(keys=(processing.name, task_hash.name, 
+                                model.get_priority_hash(queue_name, system).name), 
+            args=(task_md5,), system=system)
+
+def requeue_dead_consumers():
+    """ 心跳已经过期的worker进程, 将它们处理中的任务放回队列的出队端
+
+    返回放回队列的任务数
+    """
+    total = 0
+    for system in model.get_all_systems():
+        registry = model.get_processing_set(system)
+        for queue_name, consumer in registry:
+            heartbeat = model.get_heartbeat_key(consumer)
+            # 心跳在default上, 其他system上的脚本检查不到, 需要先检查
+            if system != 'default' and get_redis().exists(heartbeat):
+                continue
+            keys = (model.get_processing_queue(queue_name, consumer, system).name,
+                    model.get_task_queue(queue_name, system).name,
+                    heartbeat,
+                    registry.name, 
+                    model.get_priority_hash(queue_name, system).name)
+            result = REQUEUE_JOB_SCRIPT(keys=keys, 
+                    args=(registry.dumps([queue_name, consumer]),), system=system)
+            if result > 0: total += result
+    return total
 
 class JobThread(Thread):
     def __init__(self,queue_name):
@@ -166,32 +1557,44 @@ class JobThread(Thread):
 def has_task(queue_name, task, to_front=False):
     """ 检查是否存在某个job
     在queue_name的队列上，在arg_index的位置，对于func_name, 值为arg_value 
-    如果不存在，返回false， 在worker中工作，返回‘work'， 队列中返回’queue'
-    """
-    runtime = task.pop('runtime', None)
-    task_md5 = _get_task_md5(task)
-    if not runtime is None: task['runtime'] = runtime
-
-    # 检查work现在的工作
-    worker_list = model.get_all_worker()
-    for worker_name in worker_list:
-        worker_job = model.get_job_state(worker_name)
-        if not worker_job: continue
-        for thread_name, job in worker_job.items():
-            job.pop('runtime', '')
-            job.pop('process', '')
-            if _get_task_md5(job) == task_md5:
-                return 'running'
+    如果不存在，返回false， 在worker中工作，返回‘work'， 队列中返回’queue'， 延时任务返回'delayed'
+    """
+    task_md5 = get_task_id(queue_name, task)
+    # 服务端生成id的队列不能检查
+    if not task_md5: return 'none'
+
+    # 一次往返同时检查正在运行的任务索引、所在队列和延时任务
+    system = model.get_queue_system(queue_name, task_md5)
+    running = model.get_running_hash(queue_name, system)
+    task_hash = model.get_task_hash(queue_name, system)
+    delayed_hash = model.get_delayed_hash(queue_name, system)
+    client = get_redis(system)
+    pipe = client.pipeline(transaction=False)
+    pipe.hget(running.name, task_md5).hexists(task_hash.name, task_md5)
+    pipe.hexists(delayed_hash.name, task_md5)
+    worker_thread, in_queue, delayed = execute_pipeline(pipe, client)
+
+    if worker_thread:
+        # 检查worker线程的状态, worker异常退出时索引可能没有清除
+        worker_name, thread_name = running.loads(worker_thread)
+        if model.get_job_state(worker_name).get(thread_name) is not None:
+            return 'running'
+        del running[task_md5]
 
     # 检查所在队列
-    queue_name = queue_name 
-    task_hash = model.get_task_hash(queue_name)
-    if task_md5 in task_hash:
-        if to_front: # 调整顺序
-            task_queue = model.get_task_queue(queue_name)
+    if in_queue:
+        levels = model.get_queue_priorities(queue_name)
+        if to_front and levels > 1:
+            # 有优先级的队列调整到最高优先级
+            set_task_priority(queue_name, task_md5, levels - 1, to_front=True)
+        elif to_front: # 调整顺序
+            task_queue = model.get_task_queue(queue_name, system)
             task_queue.remove(task_md5)
             task_queue.push(task_md5, to_left=False)
         return 'queue'
 
+    if delayed:
+        return 'delayed'
+
     return 'none'
 
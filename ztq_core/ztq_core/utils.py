@@ -15,7 +15,7 @@ def set_bgrewriteaof():
     if not has_cron(bgrewriteaof):
         add_cron({'hour':1}, bgrewriteaof)
 
-@async(queue='urlopen')
+@async(queue='urlopen', green=True)
 def async_urlopen(url, params=None):
     try:
         # 将unicode转换成utf8
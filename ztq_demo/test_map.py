@@ -0,0 +1,8 @@
+# encoding: utf-8
+import ztq_core
+from ztq_demo.tasks import index
+
+ztq_core.setup_redis('default','localhost', 6379, 3)
+
+# 批量加入队列, 一次往返
+index.map('data %d' % i for i in range(8))
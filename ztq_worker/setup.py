@@ -31,6 +31,9 @@ setup (
     install_requires = [
         "ztq_core",
         ],
+    extras_require = {
+        'gevent': ['gevent'],
+        },
     entry_points = """\
       [console_scripts]
       ztq_worker = ztq_worker.main:run
@@ -1,6 +1,7 @@
 
 from command_thread import CommandThread
 from job_thread import report_progress, report_job
-from config_manager import register_batch_queue
-from command_execute import start_buffer_thread, init_job_threads
+from config_manager import register_batch_queue, register_reliable_queue, register_process_queue, \
+        register_prefetch_queue, register_retry_queue
+from command_execute import start_buffer_thread, start_reaper_thread, init_job_threads
 
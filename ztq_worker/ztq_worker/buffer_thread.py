@@ -4,7 +4,15 @@ import time
 
 import ztq_core
 
+# 多久没有收到信号就检查一遍所有的buffer队列(秒)，防止信号丢失
+SIGNAL_TIMEOUT = 30
+
 class BufferThread(threading.Thread):
+    """ 把buffer队列的任务放到任务队列，任务队列中最多保持 thread_limit 个任务
+
+        加入buffer和任务完成时会发出信号，线程阻塞等待信号，
+        收到后用一个脚本原子的移动任务，一次移动到任务队列满为止
+    """
 
     def __init__(self, config):
         """ cofnig: {'job-0':{'thread_limit': 50},,,}
@@ -17,59 +25,33 @@ class BufferThread(threading.Thread):
 
         if not self.config: return 
 
+        # 启动时先检查一遍
+        check_all = True
         while not self._stop:
-            for buffer_name, buffer_config in self.config.items():
-
-                # 需要停止
-                if self._stop: return
-
-                self.buffer_queue = ztq_core.get_buffer_queue(buffer_name)
-                self.task_queue = ztq_core.get_task_queue(buffer_name)
-                self.buffer_name = buffer_name
-                self.task_queue_limit = int(buffer_config['thread_limit'])
-
-                while True:
-                    try:
-                        self.start_job()
-                        break
-                    except ztq_core.ConnectionError:
-                        time.sleep(3)
-
-            time.sleep(1)
-
-    def start_job(self):
-        over_task_limit = self.task_queue_limit - len(self.task_queue)
-
-        # 这个任务可能还没有push上去，服务器就挂了，需要在重新push一次
-        if getattr(self, 'buffer_task', None):
-            self.push_buffer_task()
-
-        # 相关的任务线程，处于繁忙状态
-        if over_task_limit <= 0:
-            return
-
-        # 不繁忙，就填充满
-        else:
-            while over_task_limit > 1:
-
-                # 需要停止
-                if self._stop: return
-
-                # 得到一个任务
-                self.buffer_task = self.buffer_queue.pop(timeout=-1)
-                if self.buffer_task is None:
-                    return 
-
-                self.push_buffer_task()
-
-                self.buffer_task = None
-                over_task_limit -= 1
-
-    def push_buffer_task(self):
-        if 'runtime' not in self.buffer_task:
-            self.buffer_task['runtime'] = {}
-
-        ztq_core.push_runtime_task(self.buffer_name, self.buffer_task)
+            try:
+                if check_all:
+                    for buffer_name in self.config.keys():
+                        # 需要停止
+                        if self._stop: return
+                        self.promote(buffer_name)
+                    check_all = False
+
+                # 只等待这个线程管理的buffer队列的信号
+                buffer_name = ztq_core.wait_buffer_signal(self.config.keys(), 
+                                                          timeout=SIGNAL_TIMEOUT)
+                if buffer_name is None:
+                    # 超时了
+                    check_all = True
+                else:
+                    self.promote(buffer_name)
+            except ztq_core.ConnectionError:
+                # 连接断开期间的信号可能丢失了
+                check_all = True
+                time.sleep(3)
+
+    def promote(self, buffer_name):
+        thread_limit = int(self.config[buffer_name]['thread_limit'])
+        ztq_core.promote_buffer(buffer_name, thread_limit)
 
     def stop(self):
         self._stop = True
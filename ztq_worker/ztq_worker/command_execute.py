@@ -4,6 +4,8 @@
 from config_manager import CONFIG
 from job_thread_manager import JobThreadManager
 from buffer_thread import BufferThread
+from reaper_thread import ReaperThread
+from delayed_thread import DelayedThread
 from system_info import get_cpu_style, get_cpu_usage, get_mem_usage
 import os
 import sys
@@ -17,6 +19,12 @@ job_thread_manager = JobThreadManager()
 # buffer 线程
 buffer_thread_instance = None
 
+# 可靠队列的心跳线程
+reaper_thread_instance = None
+
+# 延时任务线程
+delayed_thread_instance = None
+
 def set_job_threads(config_dict):
     """ 根据配置信息和job_thread_manager.threads 的数量差来退出/增加线程
         剩下的修改queue_name, interval
@@ -102,6 +110,7 @@ def report(start_time):
             started=start_time, 
             timestamp=int(time.time()),
             traceback=traceback_dict,
+            pools=ztq_core.get_pool_stats(),
             )
 
 def kill_transform(pid, timestamp):
@@ -141,6 +150,34 @@ def start_buffer_thread(buffer_thread_config):
     buffer_thread_instance = buffer_thread
     sys.stdout.write('start a buffer thread. \n')
 
+def start_reaper_thread():
+    """ 开启可靠队列的心跳线程，定时报告心跳，
+        并将心跳过期的worker进程没有完成的任务放回队列
+    """
+    global reaper_thread_instance
+    if reaper_thread_instance is not None: return
+
+    reaper_thread = ReaperThread()
+    # 必须在工作线程取任务之前报告心跳，否则处理中的任务可能被别的worker放回队列
+    reaper_thread.heartbeat()
+    reaper_thread.setDaemon(True)
+    reaper_thread.start()
+
+    reaper_thread_instance = reaper_thread
+    sys.stdout.write('start a reaper thread. \n')
+
+def start_delayed_thread():
+    """ 开启延时任务线程，把到期的延时任务放到任务队列 """
+    global delayed_thread_instance
+    if delayed_thread_instance is not None: return
+
+    delayed_thread = DelayedThread()
+    delayed_thread.setDaemon(True)
+    delayed_thread.start()
+
+    delayed_thread_instance = delayed_thread
+    sys.stdout.write('start a delayed thread. \n')
+
 def clear_transform_thread(threads=None):
     """ clear job_threads and buffer_thread """
     threads = threads or job_thread_manager.threads
@@ -159,7 +196,8 @@ def clear_transform_thread(threads=None):
     # 让这个线程立刻结束
     for job_thread in job_threads:
         if job_thread.start_job_time == 0:
-            queue_name = job_thread.queue_name
+            # 监视多个队列时，向第一个队列发送就可以
+            queue_name = ztq_core.split_queue_names(job_thread.queue_name)[0][0]
             queue = ztq_core.get_task_queue(queue_name)
             queue.push('')
 
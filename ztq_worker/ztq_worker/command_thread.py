@@ -48,6 +48,8 @@ class CommandThread(Thread):
                     #async_drive_config()
                     pass
                 elif command['command'] == 'updateworker':
+                    # 失效消息可能还没有收到
+                    ztq_core.invalidate_cache('ztq:config:worker:', publish=False)
                     queue = ztq_core.get_worker_config()
                     set_job_threads(queue[self.worker_name])
                 elif command['command'] == 'kill':
@@ -27,14 +27,76 @@ def read_config_file(location=None):
     return CONFIG
 
 
-def register_batch_queue(queue_name, batch_size, batch_func=None):
+def register_batch_queue(queue_name, batch_size, batch_func=None, max_wait=0):
     """ 注册队列是批处理模式
         queue_name: 指定哪个队列为批处理模式
         batch_size: 整形
         batch_func: 方法对象
+        max_wait: 批量执行时，凑够batch_size个任务最多等待的秒数
 
         可以让队列在完成batch_size 后，执行一次 batch_func
+        可以批量执行的任务(@async(batch=True))，一次最多取出batch_size个一起执行
     """
     CONFIG.setdefault('batch_queue', {}).update(
-                {queue_name:{'batch_size':batch_size, 'batch_func':batch_func}})
+                {queue_name:{'batch_size':batch_size, 'batch_func':batch_func,
+                             'max_wait':max_wait}})
+
+def register_reliable_queue(queue_name):
+    """ 注册队列是可靠模式
+        取出的任务在完成前保存在本进程的处理中列表, 进程崩溃后,
+        任务会被其他worker放回队列重新执行
+    """
+    CONFIG.setdefault('reliable_queue', {}).update({queue_name:{}})
+
+def register_process_queue(queue_name, max_tasks_per_child=None, memory_limit=None):
+    """ 注册队列的任务在子进程中执行，用于CPU密集的任务
+        每个工作线程独占一个预先fork的子进程
+        max_tasks_per_child: 子进程执行这么多个任务后，重新fork一个
+        memory_limit: 子进程的内存限制，单位M
+    """
+    CONFIG.setdefault('process_queue', {}).update(
+                {queue_name:{'max_tasks_per_child':max_tasks_per_child, 
+                             'memory_limit':memory_limit}})
+
+def register_prefetch_queue(queue_name, prefetch_count):
+    """ 注册队列的预取个数，用于大量执行很快的小任务
+        工作线程一次往返取出最多prefetch_count个任务，放在本地缓存中依次执行，
+        线程退出时没有执行的任务放回队列。可靠模式的队列不预取
+    """
+    CONFIG.setdefault('prefetch_queue', {}).update({queue_name:prefetch_count})
+
+# 重试策略的默认值
+RETRY_POLICY = {'max_retries': 3, 'countdown': 1, 'max_countdown': 600, 'retry_on': None}
+
+def register_retry_queue(queue_name, max_retries=3, countdown=1, max_countdown=600, retry_on=None):
+    """ 注册队列的任务出错后自动重试，重试次数用完后才放到错误队列
+        max_retries: 最多重试的次数
+        countdown: 第一次重试前等待的秒数，之后每次加倍，最多等待max_countdown秒，
+                   实际等待时间在一半到全部之间随机，避免同时出错的任务同时重试
+        retry_on: 需要重试的异常类型(元组或列表)，为空表示所有的异常都重试
+
+        任务也可以用 @async(retry=...) 单独指定重试策略
+    """
+    CONFIG.setdefault('retry_queue', {}).update(
+                {queue_name:{'max_retries':max_retries, 'countdown':countdown,
+                             'max_countdown':max_countdown, 'retry_on':retry_on}})
+
+def get_retry_policy(queue_name, func):
+    """ 任务的重试策略，任务指定的(@async(retry=...))优先于队列的，没有重试时返回None """
+    retry = getattr(func, '_ztq_retry', None)
+    if retry is None:
+        return CONFIG.get('retry_queue', {}).get(queue_name, None)
+    if not retry:
+        return None # 任务指定了不重试
+
+    policy = dict(RETRY_POLICY)
+    if isinstance(retry, dict):
+        policy.update(retry)
+    else:
+        policy['max_retries'] = int(retry)
+    return policy
+
+def get_consumer_name():
+    """ 当前worker进程的唯一标识: 别名:进程号 """
+    return '%s:%s' % (CONFIG['server']['alias'], os.getpid())
 
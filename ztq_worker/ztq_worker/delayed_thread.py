@@ -0,0 +1,55 @@
+# -*- encoding: utf-8 -*-
+import threading
+import time
+import logging
+
+import ztq_core
+
+logger = logging.getLogger("ztq_worker")
+
+# 没有延时任务时, 最多等待多久检查一次(秒), 防止信号丢失
+MAX_WAIT = 60
+
+class DelayedThread(threading.Thread):
+    """ 把到期的延时任务放到任务队列
+
+        一直睡眠到最早的到期时间, 加入了更早到期的任务时由信号唤醒, 不需要轮询;
+        多个worker同时运行也没有关系, 移动任务是原子的
+    """
+
+    def __init__(self, max_wait=MAX_WAIT):
+        super(DelayedThread, self).__init__()
+        self.max_wait = max_wait
+        self._stop = False
+
+    def run(self):
+        systems = ztq_core.get_all_systems()
+        while not self._stop:
+            try:
+                next_due = None
+                for system in systems:
+                    moved, first = ztq_core.promote_delayed(system)
+                    if first is not None and (next_due is None or first < next_due):
+                        next_due = first
+                self.wait(systems, next_due)
+            except ztq_core.ConnectionError, e:
+                logger.error('ERROR: redis connection error: %s' % str(e))
+                time.sleep(3)
+            except ztq_core.ResponseError, e:
+                logger.error('ERROR: redis response error: %s' % str(e))
+                time.sleep(3)
+
+    def wait(self, systems, next_due):
+        """ 等到 next_due, 或者收到信号 """
+        wait = self.max_wait
+        if next_due is not None:
+            wait = min(wait, next_due - time.time())
+        if wait <= 0: return
+        if wait < 1:
+            # 阻塞命令的超时只能是整数秒
+            time.sleep(wait)
+        else:
+            ztq_core.wait_delayed_signal(systems, timeout=int(wait))
+
+    def stop(self):
+        self._stop = True
@@ -0,0 +1,48 @@
+# -*- encoding: utf-8 -*-
+""" 协程方式运行worker，用于大量等待网络的任务
+
+worker.ini 中配置 runtime = gevent 后，打上gevent补丁，工作线程都变成了协程，
+redis的阻塞调用也不再占用系统线程，一个队列可以开几百个工作协程。
+
+只有用 @async(queue=..., green=True) 标明可以在协程中运行的任务才直接在协程中执行，
+其他的任务放到线程池中执行，避免阻塞所有的协程
+"""
+
+# 是否已经打上gevent补丁
+PATCHED = False
+
+def patch(threadpool_size=None):
+    """ 打上gevent补丁，需要在启动任何工作线程之前调用 """
+    global PATCHED
+    if PATCHED: return
+
+    from gevent import monkey, get_hub
+    monkey.patch_all()
+
+    # 补丁之前创建的线程局部变量，需要换成协程局部变量
+    import threading
+    import job_thread
+    from ztq_core import redis_wrap
+    job_thread.thread_context = threading.local()
+    redis_wrap._local = threading.local()
+
+    if threadpool_size:
+        get_hub().threadpool.maxsize = int(threadpool_size)
+    PATCHED = True
+
+def _run_with_job(job, func, args, kw):
+    """ 在线程池中执行，让任务中的 report_job/report_progress 也能找到当前任务 """
+    import job_thread
+    job_thread.thread_context.job = job
+    try:
+        return func(*args, **kw)
+    finally:
+        del job_thread.thread_context.job
+
+def run_task(job, func, args, kw):
+    """ 执行任务：没有打补丁，或者任务可以在协程中运行时直接执行，否则放到线程池中执行 """
+    if not PATCHED or getattr(func, '_ztq_green', False):
+        return func(*args, **kw)
+
+    from gevent import get_hub
+    return get_hub().threadpool.apply(_run_with_job, (job, func, args, kw))
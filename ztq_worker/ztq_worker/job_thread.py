@@ -1,23 +1,34 @@
 # -*- encoding: utf-8 -*-
 import threading
 import time, sys
+import math
+import random
 import traceback
 import logging
+from collections import deque
 
-from config_manager import CONFIG
+from config_manager import CONFIG, get_consumer_name, get_retry_policy
+from process_pool import ProcessSlot, ProcessTaskError
+import green
 import ztq_core
 
 thread_context = threading.local()
 logger = logging.getLogger("ztq_worker")
 QUEUE_TIMEOUT = 30
+# 等待限流许可时，每隔这么多秒检查一次线程是否要退出
+CAPACITY_TIMEOUT = 5
 
-def report_job(pid=-1, comment='', **kw):
-    """ 报告当前转换进程信息 """
+def report_job(pid=None, comment='', **kw):
+    """ 报告当前转换进程信息
+        pid 为None时，保留之前报告的进程号，-1 表示不能杀
+    """
     if not hasattr(thread_context, 'job'):
         return  # 如果不在线程中，不用报告了
 
     job = thread_context.job
 
+    if pid is None:
+        pid = job['process'].get('pid', -1)
     # 报告转换状态
     job['process'].update({'pid': pid,
                         'start':int(time.time()),
@@ -44,6 +55,58 @@ def report_progress(**kw):
     progress_kw.update(kw)
     progress_func(*progress_args, **progress_kw)
 
+def requeue_prefetched_state(worker_name):
+    """ worker重新启动时，把上次预取了还没有执行的任务放回队列，返回放回的任务数 """
+    count = 0
+    prefetch_state = ztq_core.get_prefetch_state(worker_name)
+    for thread_name, prefetched in prefetch_state.items():
+        ztq_core.requeue_tasks(prefetched['queue'], prefetched['tasks'])
+        del prefetch_state[thread_name]
+        count += len(prefetched['tasks'])
+    return count
+
+def get_error_info(e, with_traceback=True):
+    """ 任务出错的信息，返回 (return_code, reason)
+        with_traceback: 是否是刚捕获的异常，这时reason中有完整的traceback
+    """
+    if isinstance(e, ProcessTaskError):
+        # 子进程中的错误信息
+        return e.return_code, e.reason
+
+    if with_traceback:
+        reason = traceback.format_exception(*sys.exc_info())
+    else:
+        reason = traceback.format_exception_only(type(e), e)
+    # 将错误信息记录到服务器
+    try:
+        return_code = str(e.args[0]) if len(e.args) > 1 else 300
+    except:
+        return_code = 300
+    return return_code, reason
+
+def get_retry_countdown(queue_name, task, e):
+    """ 任务出错后需要重试时，返回重试前等待的秒数，否则返回None """
+    policy = get_retry_policy(queue_name, ztq_core.task_registry.get(task['func']))
+    if not policy: return None
+
+    retries = task['runtime'].get('retries', 0)
+    if retries >= policy['max_retries']: return None
+
+    retry_on = policy['retry_on']
+    if retry_on:
+        # isinstance 只接受异常类型或者元组，配置成列表的也转换成元组
+        retry_on = tuple(retry_on) if isinstance(retry_on, (tuple, list)) else (retry_on,)
+        if isinstance(e, ProcessTaskError):
+            # 子进程中的异常，按异常类型的名字判断
+            if not [cls for cls in retry_on if cls.__name__ in e.exc_names]:
+                return None
+        elif not isinstance(e, retry_on):
+            return None
+
+    # 指数退避，加上随机抖动
+    countdown = min(policy['max_countdown'], policy['countdown'] * 2 ** retries)
+    return random.uniform(countdown / 2.0, countdown)
+
 class JobThread(threading.Thread):
     """ 监视一个原子队列，调用转换引擎取转换
         转换结果记录转换队列，转换出错需要记录出错日志与错误队列
@@ -56,13 +119,41 @@ class JobThread(threading.Thread):
         # _stop 为 True 就会停止这个线程
         self._stop = False
         self.start_job_time = 0  #  记录任务开始时间
+        # 多进程执行时，这个线程独占的子进程
+        self.process_slot = None
+        self.process_config = None
+        # 预取的任务，见 config_manager.register_prefetch_queue
+        self.prefetched = deque()
+        # 预取的任务记录在服务器上，worker异常退出后可以放回队列
+        self.prefetch_saved = False
+        # 正在运行的任务在索引中的标识
+        self.running_ids = []
+        # 当前任务取得的限流许可，任务结束时释放
+        self.capacity = None
 
     def run(self):
         """ 阻塞方式找到任务，并自动调用"""
         # 如果上次有任务在运行还没结束，重新执行
         jobs = ztq_core.get_job_state(CONFIG['server']['alias'])
         if self.name in jobs:
-            self.start_job(jobs[self.name])
+            job = jobs[self.name]
+            # 批量执行的其他任务
+            batch = []
+            while self.get_batch_state_name(len(batch) + 1) in jobs:
+                batch.append(jobs[self.get_batch_state_name(len(batch) + 1)])
+            if job['runtime'].get('queue') in CONFIG.get('reliable_queue', {}):
+                # 可靠队列的任务会被放回队列，不需要在这里重新执行
+                del jobs[self.name]
+            else:
+                queue_name = job['runtime'].get('queue') or self.queue_name
+                # 任务还在工作线程状态中，可以一直等待限流许可
+                self.capacity = self.wait_job_capacity(queue_name, len(batch) + 1)
+                if self.capacity is None:
+                    pass    # 线程要退出了，下次启动时再执行
+                elif batch:
+                    self.start_batch_job([job] + batch, queue_name)
+                else:
+                    self.run_job(job, queue_name)
 
         # 队列批处理模式
         # batch_size: 批处理的阀值，达到这个阀值，就执行一次batch_func
@@ -78,11 +169,7 @@ class JobThread(threading.Thread):
         # 循环执行任务
         while not self._stop:
             try:
-                task = ztq_core.pop_task(
-                        self.queue_name, 
-                        timeout=queue_tiemout, 
-                        from_right=self.from_right
-                        )
+                queue_name, task_md5, task = self.pop_task(queue_tiemout)
             except ztq_core.ConnectionError, e:
                 logger.error('ERROR: redis connection error: %s' % str(e))
                 time.sleep(3)
@@ -104,12 +191,14 @@ class JobThread(threading.Thread):
                 continue
 
             try:
-                self.start_job(task)
+                job_count = self.run_job(task, queue_name, task_md5)
             except Exception, e:
                 logger.error('ERROR: job start error: %s' % str(e))
+                job_count = 1
 
             if batch_size > 0: 
-                if run_job_index >= batch_size - 1:
+                run_job_index += job_count
+                if run_job_index >= batch_size:
                     # 完成了一批任务。执行batch_func
                     run_job_index = 0
                     queue_tiemout = QUEUE_TIMEOUT
@@ -118,63 +207,398 @@ class JobThread(threading.Thread):
                     except Exception, e:
                         logger.error('ERROR: batch execution error: %s' % str(e))
                 else:
-                    run_job_index += 1
                     queue_tiemout = -1
 
             if self.sleep_time:
                 time.sleep(self.sleep_time)
 
-    def start_job(self, task):
-        self.start_job_time = int(time.time())
+        if self.process_slot is not None:
+            self.process_slot.stop()
+        self.requeue_prefetched()
+
+    def pop_task(self, timeout):
+        """ 取一个任务，返回 (queue_name, task_md5, task)
+
+            queue_name 可以是用逗号分开的多个队列，见 ztq_core.split_queue_names，
+            这时在一个阻塞调用中同时等待这些队列。
+            可靠模式只对监视一个队列的工作线程有效，只有这时返回task_md5，任务完成后需要确认
+            配置了预取的队列，一次取出多个任务，先执行本地缓存中的任务
+            取任务之前先取得队列的限流许可，任务不会只留在这个线程的内存中等待许可
+        """
+        queues = ztq_core.split_queue_names(self.queue_name)
+        capacities = self.wait_capacity([name for name, weight in queues])
+        if not capacities:
+            return queues[0][0], None, None     # 线程要退出了
+        queue_name, task = None, None
+        try:
+            queue_name, task_md5, task = self.take_task(
+                    [queue for queue in queues if queue[0] in capacities], timeout)
+        finally:
+            # 释放没有用到的许可
+            for name, capacity in capacities.items():
+                if task is None or name != queue_name:
+                    ztq_core.release_capacity(name, capacity)
+        if task is not None:
+            self.capacity = capacities[queue_name]
+        return queue_name, task_md5, task
+
+    def take_task(self, queues, timeout):
+        """ 从已经取得许可的队列中取一个任务，返回 (queue_name, task_md5, task) """
+        if self.prefetched:
+            return queues[0][0], None, self.prefetched.popleft()
+        if len(ztq_core.split_queue_names(self.queue_name)) > 1:
+            queue_name, task = ztq_core.pop_any_task(
+                    ztq_core.order_queue_names(queues), 
+                    timeout=timeout, 
+                    from_right=self.from_right
+                    )
+            return queue_name, None, task
+
+        queue_name = queues[0][0]
+        if queue_name in CONFIG.get('reliable_queue', {}):
+            # 可靠模式，任务完成后需要确认
+            task_md5, task = ztq_core.claim_task(
+                    queue_name,
+                    get_consumer_name(),
+                    timeout=timeout, 
+                    from_right=self.from_right
+                    )
+            return queue_name, task_md5, task
+
+        prefetch_count = CONFIG.get('prefetch_queue', {}).get(queue_name, 0)
+        if prefetch_count > 1:
+            self.prefetched.extend(ztq_core.pop_tasks(
+                    queue_name,
+                    prefetch_count,
+                    timeout=timeout,
+                    from_right=self.from_right
+                    ))
+            # 开始执行之前先记录下来，每次预取只写一次
+            self.save_prefetched()
+            task = self.prefetched.popleft() if self.prefetched else None
+            return queue_name, None, task
+
+        task = ztq_core.pop_task(
+                queue_name, 
+                timeout=timeout, 
+                from_right=self.from_right
+                )
+        return queue_name, None, task
+
+    def save_prefetched(self):
+        """ 预取之后把本地缓存中的任务记录到服务器上，本地缓存空了时删除记录
+
+            执行每个任务时不再更新记录，worker异常退出后，最后一次预取的任务全部放回队列，
+            其中可能有已经执行了的
+        """
+        if not self.prefetched and not self.prefetch_saved: return
+        prefetch_state = ztq_core.get_prefetch_state(CONFIG['server']['alias'])
+        if self.prefetched:
+            queue_name = ztq_core.split_queue_names(self.queue_name)[0][0]
+            prefetch_state[self.getName()] = {'queue': queue_name, 'tasks': list(self.prefetched)}
+        else:
+            del prefetch_state[self.getName()]
+        self.prefetch_saved = bool(self.prefetched)
+
+    def requeue_prefetched(self):
+        """ 线程退出时，把预取了还没有执行的任务放回队列 """
+        if not self.prefetched: return
+        tasks = list(self.prefetched)
+        self.prefetched.clear()
+        queue_name = ztq_core.split_queue_names(self.queue_name)[0][0]
+        try:
+            ztq_core.requeue_tasks(queue_name, tasks, from_right=self.from_right)
+            self.save_prefetched()
+        except Exception, e:
+            logger.error('ERROR: requeue prefetched tasks error: %s' % str(e))
+
+    def clear_prefetched(self):
+        """ 本地缓存中的任务取完了，删除服务器上的记录，在 write_batch 中调用时和其他写操作一起发送 """
+        if not self.prefetched and self.prefetch_saved:
+            self.save_prefetched()
+
+    def get_process_slot(self, queue_name):
+        """ 队列配置为多进程执行时，返回这个线程独占的子进程，否则返回None """
+        process_config = CONFIG.get('process_queue', {}).get(queue_name, None)
+        if process_config is None: return None
+
+        if self.process_slot is not None and self.process_config != process_config:
+            self.process_slot.stop()
+            self.process_slot = None
+        if self.process_slot is None:
+            self.process_slot = ProcessSlot(**process_config)
+            self.process_config = process_config
+        return self.process_slot
+
+    def run_job(self, task, queue_name=None, task_md5=None):
+        """ 执行取到的任务，返回执行的任务数
+
+            可以批量执行的任务(@async(batch=True))，再从队列中取出同一个方法的任务一起执行
+        """
+        queue_name = queue_name or self.queue_name
+        run_task = ztq_core.task_registry.get(task['func'], None)
+        if not getattr(run_task, '_ztq_batch', False):
+            self.start_job(task, queue_name, task_md5)
+            return 1
+
+        tasks = [task]
+        # 可靠模式、监视多个队列时，一次只执行一个任务
+        if task_md5 is None and queue_name == self.queue_name:
+            batch_config = CONFIG.get('batch_queue', {}).get(queue_name, {})
+            batch_size = batch_config.get('batch_size', None) or 1
+            # 每个任务占用一个并发数，一批不能超过队列的最大并发数
+            concurrency = ztq_core.get_queue_limits(queue_name).get('concurrency', None)
+            if concurrency: batch_size = min(batch_size, concurrency)
+            tasks = self.collect_batch(task, queue_name, batch_size, 
+                    batch_config.get('max_wait', None) or 0)
+        self.start_batch_job(tasks, queue_name, task_md5)
+        return len(tasks)
+
+    def collect_batch(self, task, queue_name, batch_size, max_wait):
+        """ 取出同一个方法的任务，最多batch_size个，最多等待max_wait秒
+
+            取到的其他方法的任务放在本地缓存中，下一次执行
+        """
+        tasks = [task]
+        # 本地缓存中增加了任务时才需要重新记录
+        fetched = False
+        deadline = time.time() + max_wait
+        while len(tasks) < batch_size and not self._stop:
+            if not self.prefetched:
+                fetched = True
+                # 阻塞等待的时间只能是整数秒
+                wait = int(math.ceil(deadline - time.time()))
+                self.prefetched.extend(ztq_core.pop_tasks(
+                        queue_name,
+                        batch_size - len(tasks),
+                        timeout=wait if wait > 0 else -1,
+                        from_right=self.from_right
+                        ))
+                if not self.prefetched: break
+            if self.prefetched[0]['func'] != task['func']: break
+            tasks.append(self.prefetched.popleft())
+        if len(tasks) > 1:
+            # 其他任务也各占用一个并发数和令牌，现在取不到时放回本地缓存，之后一个一个的执行
+            capacity = ztq_core.acquire_capacity(queue_name, self.get_capacity_holder(), 
+                    len(tasks), timeout=-1, acquired=self.capacity)
+            if capacity is not None:
+                self.capacity = capacity
+            else:
+                self.prefetched.extendleft(reversed(tasks[1:]))
+                tasks = tasks[:1]
+                fetched = True
+        if fetched:
+            self.save_prefetched()
+        return tasks
+
+    def index_running(self, queue_name, tasks, task_md5=None):
+        """ 把正在运行的任务加入索引，用于 has_task，在 write_batch 中调用 """
+        value = [CONFIG['server']['alias'], self.getName()]
+        if task_md5 is not None:
+            self.running_ids = [task_md5]
+        else:
+            self.running_ids = [ztq_core.get_task_id(queue_name, task) for task in tasks]
+        for task_id in self.running_ids:
+            if task_id: self.get_running_hash(queue_name, task_id)[task_id] = value
+
+    def get_running_hash(self, queue_name, task_id):
+        """ 运行索引和任务在同一个system上 """
+        return ztq_core.get_running_hash(queue_name, 
+                ztq_core.get_queue_system(queue_name, task_id))
+
+    def get_batch_state_name(self, index):
+        """ 批量执行时，第index个(从0开始)任务在工作线程状态中的名字，第0个就是线程名 """
+        return '%s#%d' % (self.getName(), index) if index else self.getName()
+
+    def get_capacity_holder(self):
+        """ 持有队列并发数的标识: worker进程:线程名 """
+        return '%s:%s' % (get_consumer_name(), self.getName())
+
+    def wait_capacity(self, queue_names):
+        """ 取任务之前，等待队列的限流许可(见 ztq_core.set_queue_limits)，
+            返回 {队列名: 许可}，只从这些队列中取任务
+
+            监视多个队列时，只取现在就有许可的队列，都没有时等待第一个队列。
+            线程要退出时不再等待，返回空字典
+        """
+        holder = self.get_capacity_holder()
+        while not self._stop:
+            capacities = {}
+            for queue_name in queue_names:
+                capacity = ztq_core.acquire_capacity(queue_name, holder, timeout=-1)
+                if capacity is not None:
+                    capacities[queue_name] = capacity
+            if capacities:
+                return capacities
+            capacity = ztq_core.acquire_capacity(queue_names[0], holder, 
+                                                 timeout=CAPACITY_TIMEOUT)
+            if capacity is not None:
+                return {queue_names[0]: capacity}
+        return {}
+
+    def wait_job_capacity(self, queue_name, count):
+        """ 等待执行count个任务的限流许可，线程要退出时不再等待，返回None """
+        while True:
+            capacity = ztq_core.acquire_capacity(queue_name, self.get_capacity_holder(), 
+                                                 count, timeout=CAPACITY_TIMEOUT)
+            if capacity is not None or self._stop:
+                return capacity
+
+    def begin_job(self, task):
+        """ 记录任务开始执行 """
         task['runtime'].update({'worker': CONFIG['server']['alias'],
                                 'thread': self.getName(),
                                 'start': self.start_job_time, })
         # 记录当前在做什么
         task['process'] = {'ident':self.ident}
-        thread_context.job = task
-        try:
-            # started report
-            report_job(comment='start the job')
-            self.run_task = ztq_core.task_registry[task['func']]
-            self.run_task(*task['args'], **task['kw'])
 
-            task['runtime']['return'] = 0
-            task['runtime']['reason'] = 'success'
+    def start_job(self, task, queue_name=None, task_md5=None):
+        """ 执行一个任务
 
-            if task.get('callback', None):
-                callback_args = task.get('callback_args', ())
-                callback_kw = task.get('callback_kw', {})
-                ztq_core.push_task(task['callback'], *callback_args, **callback_kw)
+            开始和结束时对服务器的写操作(状态、回调、错误队列、日志、确认)各用一个pipeline发送
+            task_md5: 可靠模式下取到的任务, 结束时需要确认
+        """
+        queue_name = queue_name or self.queue_name
+        self.start_job_time = int(time.time())
+        self.begin_job(task)
+        thread_context.job = task
+        try:
+            process_slot = self.get_process_slot(queue_name)
+            if process_slot is not None:
+                # 在子进程中执行，报告子进程号，kill指令会杀掉这个子进程
+                process_slot.ensure_started()
+                with ztq_core.write_batch():
+                    report_job(pid=process_slot.pid, comment='start the job')
+                    self.index_running(queue_name, [task], task_md5)
+                    self.clear_prefetched()
+                process_slot.run(task)
+            else:
+                # started report
+                with ztq_core.write_batch():
+                    report_job(comment='start the job')
+                    self.index_running(queue_name, [task], task_md5)
+                    self.clear_prefetched()
+                self.run_task = ztq_core.task_registry[task['func']]
+                green.run_task(task, self.run_task, task['args'], task['kw'])
+            error = None
 
         except Exception, e:
-            reason = traceback.format_exception(*sys.exc_info())
-            # 将错误信息记录到服务器
-            try:
-                return_code = str(e.args[0]) if len(e.args) > 1 else 300
-            except:
-                return_code = 300
-            task['runtime']['return'] = return_code
-            task['runtime']['reason'] = reason[-11:]
-            task['runtime']['end'] = int( time.time() )
-            ztq_core.push_runtime_error(self.queue_name, task)
-            # 错误回调
-            if task.get('fcallback', None):
-                callback_args = task.get('fcallback_args', ())
-                callback_kw = task.get('fcallback_kw', {})
-                callback_kw['return_code'] = return_code
-                callback_kw['return_msg'] = unicode(reason[-1], 'utf-8', 'ignore')
-                ztq_core.push_task(task['fcallback'], *callback_args, **callback_kw)
+            error = get_error_info(e) + (get_retry_countdown(queue_name, task, e),)
             # 在终端打印错误信息
             #reason.insert(0, str(datetime.datetime.today()) + '\n')
-            logger.error(''.join(reason))
-
-        # 任务结束，记录日志
-        task['runtime']['end'] = int( time.time() )
-        ztq_core.get_work_log_queue().push(task)
-        # 删除服务器的转换进程状态信息
-        job_state = ztq_core.get_job_state(task['runtime']['worker'])
-        del job_state[task['runtime']['thread']]
-        self.start_job_time = 0
+            logger.error(''.join(error[1]))
+
+        self.finish_jobs([(task, error)], queue_name, task_md5)
+
+    def start_batch_job(self, tasks, queue_name, task_md5=None):
+        """ 批量执行同一个方法的多个任务
+
+            方法的参数是 [(args, kw), ...]，返回None表示全部成功，
+            或者返回和参数一一对应的列表，其中的异常对象表示这一个任务失败了。
+            方法抛出异常时，全部任务都失败。批量执行的任务总是在工作线程中执行
+        """
+        self.start_job_time = int(time.time())
+        for task in tasks:
+            self.begin_job(task)
+        thread_context.job = tasks[0]
+        try:
+            with ztq_core.write_batch():
+                report_job(comment='start a batch of %d tasks' % len(tasks))
+                # 其他任务也记录到工作线程状态中，控制台可以看到，worker异常退出后重新执行
+                job_state = ztq_core.get_job_state(CONFIG['server']['alias'])
+                for index, task in enumerate(tasks[1:], 1):
+                    task['process'].update({'pid': -1, 'start': self.start_job_time, 
+                            'comment': 'in a batch of %d tasks' % len(tasks)})
+                    job_state[self.get_batch_state_name(index)] = task
+                self.index_running(queue_name, tasks, task_md5)
+                self.clear_prefetched()
+            self.run_task = ztq_core.task_registry[tasks[0]['func']]
+            items = [(task['args'], task['kw']) for task in tasks]
+            results = green.run_task(tasks[0], self.run_task, (items,), {})
+            if results is None:
+                results = ()
+            elif not isinstance(results, (list, tuple)) or len(results) != len(tasks):
+                raise TypeError('batch function %s should return None or a list of %d results, '
+                        'got %r' % (tasks[0]['func'], len(tasks), results))
+
+            errors = []
+            for index, task in enumerate(tasks):
+                result = results[index] if index < len(results) else None
+                if isinstance(result, Exception):
+                    error = get_error_info(result, with_traceback=False) + \
+                            (get_retry_countdown(queue_name, task, result),)
+                    logger.error(''.join(error[1]))
+                else:
+                    error = None
+                errors.append(error)
+
+        except Exception, e:
+            error = get_error_info(e)
+            logger.error(''.join(error[1]))
+            errors = [error + (get_retry_countdown(queue_name, task, e),) for task in tasks]
+
+        self.finish_jobs(zip(tasks, errors), queue_name, task_md5)
+
+    def finish_jobs(self, results, queue_name, task_md5=None):
+        """ 任务结束，在一个pipeline中记录错误队列、回调、日志，删除服务器的转换进程状态信息
+
+            results: [(task, error)]，成功时error为None，否则为 (return_code, reason, countdown)，
+            countdown 不为None时，countdown秒后重试，重试次数用完了才放到错误队列
+        """
+        try:
+            end = int( time.time() )
+            with ztq_core.write_batch():
+                for task, error in results:
+                    task['runtime']['end'] = end
+                    if error is None:
+                        task['runtime']['return'] = 0
+                        task['runtime']['reason'] = 'success'
+                        if task.get('callback', None):
+                            callback_args = task.get('callback_args', ())
+                            callback_kw = task.get('callback_kw', {})
+                            ztq_core.push_task(task['callback'], *callback_args, **callback_kw)
+                    else:
+                        return_code, reason, countdown = error
+                        task['runtime']['return'] = return_code
+                        task['runtime']['reason'] = reason[-11:]
+                        if countdown is not None:
+                            # 放到延时任务中稍后重试
+                            task['runtime']['retries'] = task['runtime'].get('retries', 0) + 1
+                            ztq_core.retry_task(queue_name, task, countdown)
+                        else:
+                            self.push_error(queue_name, task, return_code, reason)
+                    ztq_core.get_work_log_queue().push(task)
+
+                job_state = ztq_core.get_job_state(results[0][0]['runtime']['worker'])
+                del job_state[results[0][0]['runtime']['thread']]
+                for index in range(1, len(results)):
+                    del job_state[self.get_batch_state_name(index)]
+                for task_id in self.running_ids:
+                    if task_id: del self.get_running_hash(queue_name, task_id)[task_id]
+                self.running_ids = []
+                # 任务队列有了空位，通知buffer线程
+                ztq_core.signal_buffer(queue_name)
+                if task_md5 is not None:
+                    ztq_core.ack_task(queue_name, task_md5, get_consumer_name())
+        finally:
+            # 出错时也要释放取得的并发数，通知等待的工作线程
+            ztq_core.release_capacity(queue_name, self.capacity)
+            self.capacity = None
+            self.start_job_time = 0
+
+    def push_error(self, queue_name, task, return_code, reason):
+        """ 放到错误队列，调用错误回调 """
+        # 重做错误队列的任务时，重新计算重试次数
+        if 'retries' in task['runtime']:
+            task['runtime']['retried'] = task['runtime'].pop('retries')
+        ztq_core.push_runtime_error(queue_name, task)
+        # 错误回调
+        if task.get('fcallback', None):
+            callback_args = task.get('fcallback_args', ())
+            callback_kw = task.get('fcallback_kw', {})
+            callback_kw['return_code'] = return_code
+            callback_kw['return_msg'] = unicode(reason[-1], 'utf-8', 'ignore')
+            ztq_core.push_task(task['fcallback'], *callback_args, **callback_kw)
 
     def stop(self):
         """ 结束这个进程，会等待当前转换完成
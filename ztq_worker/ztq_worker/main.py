@@ -2,9 +2,13 @@
 
 import sys, os
 from command_thread import CommandThread
-from config_manager import read_config_file
-from command_execute import init_job_threads, set_job_threads
+from config_manager import read_config_file, register_reliable_queue, register_process_queue, \
+        register_prefetch_queue, register_retry_queue, CONFIG
+from command_execute import init_job_threads, set_job_threads, start_reaper_thread, \
+        start_delayed_thread
 from system_info import get_ip
+from job_thread import requeue_prefetched_state
+import green
 
 import ztq_core
 
@@ -15,6 +19,11 @@ def run():
         conf_file = sys.argv[1]
 
     config = read_config_file(conf_file)
+
+    # 协程方式运行，需要在启动线程之前打上gevent补丁
+    if config['server'].get('runtime', 'thread') == 'gevent':
+        green.patch(config['server'].get('threadpool_size', None))
+
     main(config)
 
 def main(config):
@@ -43,6 +52,8 @@ def main(config):
     enable_sentinel = server['enable_sentinel'].lower() == 'true'
     # 对应的 sentinel service_name
     sentinel_name = server['sentinel_name']
+    # 连接池的配置
+    ztq_core.set_pool_options(**ztq_core.read_pool_options(server))
     if enable_sentinel:
         # 当启用 sentinel 时
         # 配置的host, port, db等信息变为了sentinel的主机信息
@@ -51,16 +62,83 @@ def main(config):
     else:
         ztq_core.setup_redis('default', host=redis_host, port=redis_port, db=redis_db)
 
+    # 队列分片到多个服务器，格式: system名 = host:port:db，使用sentinel时是 system名 = 服务名
+    shards = config.get('shards', {})
+    for shard_name, address in shards.items():
+        if enable_sentinel:
+            ztq_core.setup_sentinel(shard_name, [(redis_host, redis_port)],
+                    [address.strip() or shard_name], db = redis_db)
+        else:
+            host, port, db = (address.strip().split(':') + ['0'])[:3]
+            ztq_core.setup_redis(shard_name, host=host, port=int(port), db=int(db))
+    if shards:
+        ztq_core.setup_shards(['default'] + sorted(shards))
+    # 分布在多个分片上的队列，格式: 队列 = system名 system名 ...
+    for queue_name, systems in config.get('queue_shards', {}).items():
+        ztq_core.set_queue_shards(queue_name, systems.split())
+
+    # 配置的本地缓存，修改配置时通过pub/sub失效
+    config_cache_ttl = server.get('config_cache_ttl', '').strip()
+    if config_cache_ttl:
+        ztq_core.set_cache_ttl(float(config_cache_ttl))
+    ztq_core.start_cache_listener()
+
     # 开启一个命令线程
     alias = server.get('alias', '')
     if not alias:
         alias = get_ip()
         server['alias'] = alias
 
+    # 工作线程状态放到一个带过期时间的hash中，需要和控制台的配置一致
+    job_state_expire = int(server.get('job_state_expire', '') or 0)
+    if job_state_expire:
+        ztq_core.use_job_state_hash(job_state_expire)
+
     command_thread = CommandThread(worker_name=alias)
 
     sys.stdout.write('Starting server in PID %s\n'%os.getpid())
 
+    # 可靠模式的队列
+    for queue_name in server.get('reliable_queues', '').split():
+        register_reliable_queue(queue_name)
+    if CONFIG.get('reliable_queue', None):
+        start_reaper_thread()
+
+    # 把到期的延时任务放到任务队列
+    if server.get('delayed_thread', 'true').lower() == 'true':
+        start_delayed_thread()
+
+    # 在子进程中执行的队列，格式: 队列 = 子进程最多执行的任务数, 内存限制(M)
+    for queue_name, options in config.get('process_queues', {}).items():
+        options = [int(option) for option in options.split(',')] + [0, 0]
+        register_process_queue(queue_name, 
+                max_tasks_per_child=options[0] or None, 
+                memory_limit=options[1] or None)
+
+    # 预取的队列，格式: 队列 = 一次取出的任务数
+    for queue_name, prefetch_count in config.get('prefetch_queues', {}).items():
+        register_prefetch_queue(queue_name, int(prefetch_count))
+
+    # 出错自动重试的队列，格式: 队列 = 最多重试次数, 第一次重试前等待的秒数, 最长等待的秒数
+    for queue_name, options in config.get('retry_queues', {}).items():
+        options = [float(option) for option in options.split(',')]
+        register_retry_queue(queue_name, int(options[0]), *options[1:3])
+
+    # 序列化方式，格式: 队列 = 序列化方式，如 msgpack+zlib
+    for queue_name, serialized_type in config.get('serializers', {}).items():
+        ztq_core.set_queue_serializer(queue_name, serialized_type.strip())
+
+    # 队列的优先级个数，格式: 队列 = 优先级个数
+    for queue_name, levels in config.get('priorities', {}).items():
+        ztq_core.set_queue_priorities(queue_name, int(levels))
+
+    if server.get('state_serializer', ''):
+        ztq_core.set_state_serializer(server['state_serializer'].strip())
+
+    # 上次异常退出时预取了还没有执行的任务，放回队列
+    # 需要在注册了序列化方式、优先级等配置之后，按队列的配置放回
+    requeue_prefetched_state(alias)
+
     worker_state = ztq_core.get_worker_state()
     active_config = server.get('active_config', 'false')
     if active_config.lower() == 'true' and command_thread.worker_name in worker_state:
@@ -73,12 +151,17 @@ def main(config):
         queue_config = ztq_core.get_queue_config()
         # 如果配置有queues，自动启动线程监视
         job_threads = {}
-        for queue_name, sleeps in config['queues'].items():
-            job_threads[queue_name] = [
-                    {'interval': int(sleep)} for sleep in sleeps.split(',')
-                    ]
-            if not queue_config.get(queue_name, []):
-                queue_config[queue_name] = {'name':queue_name, 'title':queue_name, 'widget': 5}
+        # 一组线程可以同时监视多个队列，如 mail,default,index = 0, 0
+        for queue_spec, sleeps in config['queues'].items():
+            job_threads[queue_spec] = []
+            for sleep in sleeps.split(','):
+                # 间隔时间*线程数，如 0*200 表示开200个间隔时间为0的线程
+                sleep, count = (sleep.split('*', 1) + [1])[:2]
+                job_threads[queue_spec].extend(
+                        {'interval': int(sleep)} for i in xrange(int(count)))
+            for queue_name, weight in ztq_core.split_queue_names(queue_spec):
+                if not queue_config.get(queue_name, []):
+                    queue_config[queue_name] = {'name':queue_name, 'title':queue_name, 'widget': 5}
 
         init_job_threads(job_threads)
 
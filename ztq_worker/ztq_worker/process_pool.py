@@ -0,0 +1,134 @@
+# -*- encoding: utf-8 -*-
+""" 多进程执行方式，用于CPU密集的任务
+
+每个工作线程独占一个预先fork的子进程，任务通过管道交给子进程执行，
+执行结果或者异常信息再通过管道返回给工作线程，
+回调、错误回调、错误队列等仍然由工作线程处理
+"""
+import os, sys
+import signal
+import traceback
+from multiprocessing import Process, Pipe
+
+import ztq_core
+
+class ProcessTaskError(Exception):
+    """ 子进程中执行任务出错，或者子进程异常退出
+
+        exc_names: 子进程中异常类型及其父类的名字，用于判断是否需要重试
+    """
+
+    def __init__(self, return_code, reason, exc_names=()):
+        Exception.__init__(self, return_code, reason)
+        self.return_code = return_code
+        self.reason = reason
+        self.exc_names = exc_names
+
+def _set_memory_limit(memory_limit):
+    """ 限制子进程的内存，单位M """
+    try:
+        import resource
+    except ImportError:
+        return # windows 不支持
+    limit = int(memory_limit) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def _child_main(conn, memory_limit):
+    """ 子进程：循环接收任务并执行，收到None后退出 """
+    from job_thread import thread_context
+
+    # Ctrl+C 由父进程处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_limit:
+        _set_memory_limit(memory_limit)
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        task['process']['pid'] = os.getpid()
+        thread_context.job = task
+        try:
+            run_task = ztq_core.task_registry[task['func']]
+            run_task(*task['args'], **task['kw'])
+            conn.send((0, None, None, None))
+        except Exception, e:
+            reason = traceback.format_exception(*sys.exc_info())
+            try:
+                return_code = str(e.args[0]) if len(e.args) > 1 else 300
+            except:
+                return_code = 300
+            exc_names = [cls.__name__ for cls in type(e).__mro__]
+            conn.send((1, return_code, reason, exc_names))
+
+class ProcessSlot(object):
+    """ 一个工作线程独占使用的子进程
+
+        max_tasks_per_child: 子进程执行这么多个任务后，退出并重新fork一个
+        memory_limit: 子进程的内存限制，单位M
+    """
+
+    def __init__(self, max_tasks_per_child=None, memory_limit=None):
+        self.max_tasks_per_child = max_tasks_per_child
+        self.memory_limit = memory_limit
+        self.process = None
+        self.conn = None
+        self.task_count = 0
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else -1
+
+    def start(self):
+        """ fork 子进程 """
+        parent_conn, child_conn = Pipe()
+        process = Process(target=_child_main, args=(child_conn, self.memory_limit))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+
+        self.process = process
+        self.conn = parent_conn
+        self.task_count = 0
+
+    def ensure_started(self):
+        if self.process is None or not self.process.is_alive():
+            self.start()
+
+    def run(self, task):
+        """ 在子进程中执行任务，出错时抛出ProcessTaskError """
+        self.ensure_started()
+        self.conn.send(task)
+        try:
+            status, return_code, reason, exc_names = self.conn.recv()
+        except EOFError:
+            # 子进程被杀死(kill/cancel指令)，或者超出内存限制崩溃了
+            self.process.join()
+            exitcode = self.process.exitcode
+            self.process = None
+            raise ProcessTaskError(300,
+                    ['child process exited with code %s\n' % exitcode])
+
+        self.task_count += 1
+        if self.max_tasks_per_child and self.task_count >= self.max_tasks_per_child:
+            self.stop()
+
+        if status:
+            raise ProcessTaskError(return_code, reason, exc_names)
+
+    def stop(self, timeout=30):
+        """ 通知子进程退出 """
+        if self.process is None: return
+        try:
+            self.conn.send(None)
+        except (IOError, OSError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.process = None
@@ -0,0 +1,44 @@
+# -*- encoding: utf-8 -*-
+import threading
+import time
+import logging
+
+from config_manager import get_consumer_name
+import ztq_core
+
+logger = logging.getLogger("ztq_worker")
+
+# 心跳的间隔时间和过期时间(秒)
+HEARTBEAT_INTERVAL = 10
+HEARTBEAT_EXPIRE = 30
+
+class ReaperThread(threading.Thread):
+    """ 可靠队列模式下，定时报告本进程的心跳，
+        并将心跳已经过期的worker进程没有完成的任务放回队列
+    """
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, expire=HEARTBEAT_EXPIRE):
+        super(ReaperThread, self).__init__()
+        self.interval = interval
+        self.expire = expire
+        self._stop = False
+
+    def heartbeat(self):
+        ztq_core.set_heartbeat(get_consumer_name(), self.expire)
+
+    def run(self):
+        while not self._stop:
+            try:
+                self.heartbeat()
+                count = ztq_core.requeue_dead_consumers()
+                if count:
+                    logger.warning('requeue %s tasks of dead workers' % count)
+            except ztq_core.ConnectionError, e:
+                logger.error('ERROR: redis connection error: %s' % str(e))
+            except ztq_core.ResponseError, e:
+                logger.error('ERROR: redis response error: %s' % str(e))
+
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop = True